@@ -0,0 +1,585 @@
+''' Steganalysis: looking for signs of a hidden LSB payload in images.
+
+Unlike scan.py, which only recognises our own payload header, this looks
+at the pixels themselves, so it also finds payloads hidden by other tools
+(or by us with a key). It computes three classic statistics for every
+color channel:
+
+    chi-square   Hiding random bits evens out the counts of each pair of
+                 values 2i and 2i+1. The result is the probability that
+                 the counts are that even because of a payload (Westfeld
+                 and Pfitzmann).
+    rs           RS analysis: how flipping LSBs changes the smoothness of
+                 small groups of pixels, solved for the share of color
+                 bytes that carry a payload (Fridrich, Goljan and Du).
+    spa          Sample pair analysis: the same estimate from how pairs of
+                 neighbouring values are spread (Dumitrescu, Wu and Wang).
+
+rs and spa estimate the embedding rate: 0 for a clean image, 1 when every
+color byte carries a message bit. Clean images usually come out a few
+percent either side of 0. Their mean is the image's score, and an image
+is suspicious when the score reaches RATE_THRESHOLD. The chi-square test
+is only reported: images with very smooth histograms look "evened out"
+to it even without a payload.
+
+The pixels are read a block of rows at a time. Each statistic works on a
+whole block at once: the color bytes are spread out into 16-bit lanes of
+one big integer, and every comparison and difference is a handful of big
+integer operations (no Python loop over pixels). Once the pixels read so
+far are conclusive - the chi-square test is sure for every channel and the
+score is high (as at the start of an image with a payload hidden in order)
+- the rest of the image isn't read, unless early stopping is turned off.
+Many files are shared out over a pool of worker processes.
+
+    from analysis import analyze_images, AnalysisReport
+    from scan import iter_image_paths
+
+    report = AnalysisReport()
+    for path, result, error in analyze_images(iter_image_paths(['incoming/']), jobs=8, report=report):
+        if result and result['suspicious']:
+            print(path, result['score'])
+    print(report.summary()) '''
+
+import math
+import os
+from collections import Counter, deque
+
+from encode import map_image_file, validate_bmp_basic, read_bmp_header, validate_bmp_header, check_bits_per_pixel
+from encode import gather_carrier_bytes
+from errors import StegoError
+from scan import ScanReport
+
+
+# How many pixels are analyzed at a time (and between early stopping checks)
+ANALYSIS_BLOCK_PIXELS = 64 * 1024
+
+# The chi-square probability (for every channel) and score that make the
+# pixels read so far conclusive, so the rest of the image can be skipped
+CONCLUSIVE_PROBABILITY = 0.999
+CONCLUSIVE_RATE = 0.5
+
+# The score (estimated embedding rate) from which an image is suspicious
+RATE_THRESHOLD = 0.05
+
+# Value pairs with fewer expected samples than this are left out of the
+# chi-square test, since they only add noise
+MIN_EXPECTED_COUNT = 5
+
+# How many files each worker process may have waiting
+ANALYSIS_QUEUE_PER_JOB = 4
+
+# RS analysis looks at groups of this many neighbouring values, and flips
+# the middle two (the mask 0, 1, 1, 0)
+RS_GROUP_SIZE = 4
+RS_MASK = (0, 1, 1, 0)
+
+# Every value gets a 16-bit lane; differences are taken with a guard bit above
+# the largest value so they never borrow from the lane next to them
+LANE_BYTES = 2
+LANE_BITS = 8 * LANE_BYTES
+GUARD_BIT = 10
+COMPARE_BIT = 11
+DIFFERENCE_MASK = (1 << GUARD_BIT) - 1
+
+
+class AnalysisReport(ScanReport):
+    """Counts what a batch analysis found and how fast it went.
+
+    Attributes:
+        files (int): How many files were analyzed.
+        with_payload (int): How many of them look like they hold a payload.
+        failed (int): How many couldn't be read or aren't images we support.
+        bytes_read (int): How many pixel bytes were analyzed from all the files together.
+        stopped_early (int): How many files were only partly read (see analyze_image()).
+        seconds (float): How long the analysis has taken so far.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.stopped_early = 0
+
+    def add(self, details, error):
+        """Counts the result of one file."""
+        if error is None:
+            details = dict(details, has_payload=details['suspicious'])
+            if details['stopped_early']:
+                self.stopped_early += 1
+        super().add(details, error)
+
+    def as_dict(self):
+        """Returns the counts as a plain dictionary (for JSON output)."""
+        return dict(super().as_dict(), stopped_early=self.stopped_early)
+
+    def summary(self):
+        """Returns a one-line summary of the analysis."""
+        return (f"Analyzed {self.files} files in {self.seconds:.2f} s ({self.files_per_second():.1f} files/s): "
+                f"{self.with_payload} suspicious, {self.failed} failed, {self.stopped_early} stopped early, "
+                f"{self.bytes_read / (1024 * 1024):.1f} MB read")
+
+
+class Lanes:
+    """Constants for working on count values packed into 16-bit lanes.
+
+    Every attribute is a big integer with the same value (or pattern of
+    values) in each lane, ready to add, subtract or mask with.
+    """
+
+    def __init__(self, count):
+        self.count = count
+        self.one = repeat_lanes((1,), count)
+        self.guard = repeat_lanes((1 << GUARD_BIT,), count)
+        self.compare = repeat_lanes((1 << COMPARE_BIT,), count)
+        self.half_mask = repeat_lanes((0x7F,), count)
+
+        # Neighbour pairs: every lane but the last starts one
+        self.pairs = self.one ^ (1 << (LANE_BITS * (count - 1)))
+
+        # RS groups: only whole groups count, and the mask flips the middle values
+        whole = count - count % RS_GROUP_SIZE
+        self.groups = repeat_lanes((1,) + (0,) * (RS_GROUP_SIZE - 1), whole)
+        self.flip = repeat_lanes(RS_MASK, whole)
+        self.group_count = whole // RS_GROUP_SIZE
+
+
+class ChannelStats:
+    """The running counts for one color channel of an image.
+
+    Attributes:
+        name (str): 'blue', 'green' or 'red'.
+        histogram (Counter): How often every value appears.
+        rs_counts (list): Regular and singular groups, with the mask and the
+            negative mask, for the image and for the image with every LSB flipped.
+        groups (int): How many RS groups were counted.
+        pair_counts (list): Sample pair counts (X, Y, close pairs) and the number of pairs.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.histogram = Counter()
+        self.rs_counts = [0] * 8
+        self.groups = 0
+        self.pair_counts = [0] * 4
+
+    def add(self, channel_bytes):
+        """Counts one block of this channel's values."""
+        if len(channel_bytes) < 2:
+            return
+        self.histogram.update(channel_bytes)
+
+        lanes = Lanes(len(channel_bytes))
+        values = spread_lanes(channel_bytes)
+        for index, count in enumerate(count_rs_groups(values, lanes) + count_rs_groups(values ^ lanes.one, lanes)):
+            self.rs_counts[index] += count
+        self.groups += lanes.group_count
+        for index, count in enumerate(count_sample_pairs(values, lanes)):
+            self.pair_counts[index] += count
+
+    def chi_square_probability(self):
+        """Returns the chi-square probability that this channel holds a payload."""
+        return chi_square_probability(self.histogram)
+
+    def rs_estimate(self):
+        """Returns the embedding rate RS analysis estimates, or None."""
+        return rs_estimate(self.rs_counts, self.groups)
+
+    def spa_estimate(self):
+        """Returns the embedding rate sample pair analysis estimates, or None."""
+        return spa_estimate(*self.pair_counts)
+
+
+def repeat_lanes(pattern, count):
+    """Packs count lanes, repeating pattern, into one big integer."""
+    pattern_bytes = b''.join(value.to_bytes(LANE_BYTES, 'little') for value in pattern)
+    repeats = -(-count // len(pattern))
+    return int.from_bytes((pattern_bytes * repeats)[:count * LANE_BYTES], 'little')
+
+
+def spread_lanes(data):
+    """Packs bytes into one big integer, one byte per 16-bit lane."""
+    spread = bytearray(len(data) * LANE_BYTES)
+    spread[::LANE_BYTES] = data
+    return int.from_bytes(spread, 'little')
+
+
+def absolute_differences(values, lanes):
+    """Returns |next value - value| in every lane."""
+    following = values >> LANE_BITS
+    up = following + lanes.guard - values
+    down = values + lanes.guard - following
+
+    # The guard bit survives only where the difference isn't negative; below
+    # it is the size of the difference
+    rising = (up >> GUARD_BIT) & lanes.one
+    return (up & (rising * DIFFERENCE_MASK)) | (down & ((lanes.one - rising) * DIFFERENCE_MASK))
+
+
+def group_variation(values, lanes):
+    """Returns how much the values change inside each RS group (in the group's first lane)."""
+    differences = absolute_differences(values, lanes)
+    variation = differences
+    for step in range(1, RS_GROUP_SIZE - 1):
+        variation = variation + (differences >> (LANE_BITS * step))
+    return variation
+
+
+def count_greater(first, second, lanes):
+    """Returns a 1 in every lane where first is bigger than second."""
+    return ((first + lanes.compare - second - lanes.one) >> COMPARE_BIT) & lanes.one
+
+
+def count_rs_groups(values, lanes):
+    """Counts the regular and singular RS groups of one block of values.
+
+    Returns:
+        tuple: (regular, singular) with the mask, then with the negative mask.
+    """
+    variation = group_variation(values, lanes)
+
+    # The mask flips 2i <-> 2i+1. The negative mask flips 2i-1 <-> 2i, which
+    # is the same as adding 1 to every value and flipping 2i <-> 2i+1 (adding
+    # 1 everywhere doesn't change any difference).
+    flipped = group_variation(values ^ lanes.flip, lanes)
+    shifted = group_variation((values + lanes.one) ^ lanes.flip, lanes)
+
+    counts = []
+    for changed in (flipped, shifted):
+        counts.append((count_greater(changed, variation, lanes) & lanes.groups).bit_count())
+        counts.append((count_greater(variation, changed, lanes) & lanes.groups).bit_count())
+    return tuple(counts)
+
+
+def count_sample_pairs(values, lanes):
+    """Counts the sample pairs of one block of values.
+
+    Returns:
+        tuple: (X, Y, close pairs, pairs). X holds the pairs (u, v) where v is
+        even and u < v or v is odd and u > v, Y the ones the other way round,
+        and close pairs the ones where u and v only differ in their LSB.
+    """
+    following = values >> LANE_BITS
+    rising = count_greater(following, values, lanes)
+    falling = count_greater(values, following, lanes)
+    odd = following & lanes.one
+    even = odd ^ lanes.one
+
+    x_pairs = ((even & rising) | (odd & falling)) & lanes.pairs
+    y_pairs = ((even & falling) | (odd & rising)) & lanes.pairs
+
+    # Close pairs have the same value once the LSB is dropped
+    halves = ((values >> 1) & lanes.half_mask) ^ ((following >> 1) & lanes.half_mask)
+    close_pairs = (((halves + lanes.half_mask) >> 7) & lanes.one) ^ lanes.pairs
+
+    return x_pairs.bit_count(), y_pairs.bit_count(), (close_pairs & lanes.pairs).bit_count(), lanes.count - 1
+
+
+def chi_square_probability(histogram):
+    """The chi-square attack: how likely the value counts were evened out by a payload.
+
+    Args:
+        histogram (Counter): How often every value appears.
+
+    Returns:
+        float: Close to 1 if every pair of values 2i, 2i+1 appears about
+        equally often (as after hiding random bits), close to 0 otherwise.
+    """
+    statistic = 0.0
+    categories = 0
+    for low in range(0, 256, 2):
+        expected = (histogram[low] + histogram[low + 1]) / 2
+        if expected < MIN_EXPECTED_COUNT:
+            continue
+        statistic += (histogram[low] - expected) ** 2 / expected
+        categories += 1
+    if categories < 2:
+        return 0.0
+    return chi_square_survival(statistic, categories - 1)
+
+
+def chi_square_survival(statistic, degrees):
+    """Returns the probability of a chi-square value at least this big."""
+    return upper_gamma_ratio(degrees / 2, statistic / 2)
+
+
+def upper_gamma_ratio(a, x):
+    """The regularized upper incomplete gamma function Q(a, x)."""
+    if x <= 0:
+        return 1.0
+    log_front = a * math.log(x) - x - math.lgamma(a)
+    if x < a + 1:
+        # Series for the lower function P(a, x) = 1 - Q(a, x)
+        term = total = 1.0 / a
+        denominator = a
+        while abs(term) > abs(total) * 1e-15:
+            denominator += 1
+            term *= x / denominator
+            total += term
+        return max(0.0, 1.0 - total * math.exp(log_front))
+
+    # Continued fraction for Q(a, x) (modified Lentz's method)
+    tiny = 1e-300
+    b = x + 1 - a
+    c = 1 / tiny
+    d = 1 / b
+    fraction = d
+    for step in range(1, 1000):
+        an = -step * (step - a)
+        b += 2
+        d = an * d + b
+        d = tiny if abs(d) < tiny else d
+        c = b + an / c
+        c = tiny if abs(c) < tiny else c
+        d = 1 / d
+        change = d * c
+        fraction *= change
+        if abs(change - 1) < 1e-15:
+            break
+    return min(1.0, math.exp(log_front) * fraction)
+
+
+def smaller_root(a, b, c):
+    """Returns the root of a*x*x + b*x + c = 0 closest to 0, or None if there is none."""
+    if a == 0:
+        return -c / b if b != 0 else None
+    discriminant = b * b - 4 * a * c
+    if discriminant < 0:
+        return None
+    root = math.sqrt(discriminant)
+    return min((-b + root) / (2 * a), (-b - root) / (2 * a), key=abs)
+
+
+def rs_estimate(rs_counts, groups):
+    """Estimates the embedding rate from RS group counts.
+
+    Args:
+        rs_counts (list): From count_rs_groups(), for the image and then for
+            the image with every LSB flipped.
+        groups (int): How many groups were counted.
+
+    Returns:
+        float: The estimated share of color bytes that carry a payload
+        (between 0 and 1), or None if there weren't enough groups.
+    """
+    if groups == 0:
+        return None
+    regular, singular, negative_regular, negative_singular = [count / groups for count in rs_counts[:4]]
+    flipped_regular, flipped_singular, flipped_negative_regular, flipped_negative_singular = [
+        count / groups for count in rs_counts[4:]]
+
+    d0 = regular - singular
+    d1 = flipped_regular - flipped_singular
+    negative_d0 = negative_regular - negative_singular
+    negative_d1 = flipped_negative_regular - flipped_negative_singular
+
+    x = smaller_root(2 * (d1 + d0), negative_d0 - negative_d1 - d1 - 3 * d0, d0 - negative_d0)
+    if x is None or x == 0.5:
+        return None
+    return min(1.0, max(0.0, x / (x - 0.5)))
+
+
+def spa_estimate(x_pairs, y_pairs, close_pairs, pairs):
+    """Estimates the embedding rate from sample pair counts.
+
+    Returns:
+        float: The estimated share of color bytes that carry a payload
+        (between 0 and 1), or None if there weren't enough pairs.
+    """
+    if pairs == 0 or close_pairs == 0:
+        return None
+    rate = smaller_root(close_pairs / 2, 2 * x_pairs - pairs, y_pairs - x_pairs)
+    if rate is None:
+        # Near a full payload the two roots meet, and noise in the counts can
+        # leave no root at all. The rate where the curve comes closest to 0
+        # is the best guess then.
+        rate = (pairs - 2 * x_pairs) / close_pairs
+    return min(1.0, max(0.0, rate))
+
+
+def channel_names(header_info):
+    """Names the color bytes of a pixel in the order they are used."""
+    if header_info.color_masks is None:
+        return ('blue', 'green', 'red')
+
+    # The masks are red, green and blue, each covering one whole byte
+    names = {}
+    for mask, name in zip(header_info.color_masks, ('red', 'green', 'blue')):
+        names[(mask.bit_length() - 1) // 8] = name
+    return tuple(names[offset] for offset in header_info.channel_offsets)
+
+
+def analyze_image(image_file_path, early_stop=True):
+    """Looks for signs of an LSB payload in one image.
+
+    Args:
+        image_file_path (str): Path to the image file.
+        early_stop (bool): Stop reading once the pixels read so far clearly
+            hold a payload (see is_conclusive()). The estimates then only
+            cover the part that was read.
+
+    Returns:
+        dict: The scores of every channel ('channels'), the highest
+        'chi_square' probability, the 'rs' and 'spa' estimates averaged over
+        the channels, the mean of all the estimates as the overall 'score',
+        whether the image is 'suspicious', and how much of it was read.
+
+    Raises:
+        StegoError: If the image can't be read or used.
+    """
+    img_bytes = map_image_file(image_file_path)
+    try:
+        validate_bmp_basic(img_bytes, image_file_path)
+        header_info = read_bmp_header(img_bytes)
+        validate_bmp_header(header_info, img_bytes)
+        check_bits_per_pixel(header_info)
+
+        channels = [ChannelStats(name) for name in channel_names(header_info)]
+        rows_per_block = max(1, ANALYSIS_BLOCK_PIXELS // header_info.width)
+        carriers_per_row = header_info.width * len(channels)
+
+        # A file cut short is analyzed as far as it goes
+        rows = min(header_info.number_of_rows,
+                   max(0, len(img_bytes) - header_info.pixel_data_offset) // header_info.bytes_per_row)
+
+        stopped_early = False
+        rows_read = 0
+        while rows_read < rows:
+            block_rows = min(rows_per_block, rows - rows_read)
+            color_bytes = gather_carrier_bytes(img_bytes, header_info, rows_read * carriers_per_row,
+                                               block_rows * carriers_per_row)
+            for channel_number, channel in enumerate(channels):
+                channel.add(color_bytes[channel_number::len(channels)])
+            rows_read = rows_read + block_rows
+
+            if early_stop and rows_read < rows and is_conclusive(channels):
+                stopped_early = True
+                break
+    finally:
+        img_bytes.close()
+
+    return summarize_channels(header_info, channels, rows_read, stopped_early)
+
+
+def is_conclusive(channels):
+    """Tells whether the pixels counted so far clearly hold a payload."""
+    if any(channel.chi_square_probability() < CONCLUSIVE_PROBABILITY for channel in channels):
+        return False
+    return combine_estimates(channels) >= CONCLUSIVE_RATE
+
+
+def combine_estimates(channels):
+    """Returns the mean of the rs and spa estimates of every channel (0 without any)."""
+    estimates = []
+    for channel in channels:
+        estimates += [value for value in (channel.rs_estimate(), channel.spa_estimate()) if value is not None]
+    return sum(estimates) / len(estimates) if estimates else 0.0
+
+
+def summarize_channels(header_info, channels, rows_read, stopped_early):
+    """Turns the channel counts into the scores analyze_image() returns."""
+    scores = {}
+    for channel in channels:
+        scores[channel.name] = {
+            'chi_square': channel.chi_square_probability(),
+            'rs': channel.rs_estimate(),
+            'spa': channel.spa_estimate(),
+        }
+
+    def average(name):
+        values = [score[name] for score in scores.values() if score[name] is not None]
+        return sum(values) / len(values) if values else None
+
+    score = combine_estimates(channels)
+
+    return {
+        'width': header_info.width,
+        'height': header_info.height,
+        'bits_per_pixel': header_info.bits_per_pixel,
+        'channels': scores,
+        'chi_square': max(score['chi_square'] for score in scores.values()),
+        'rs': average('rs'),
+        'spa': average('spa'),
+        'score': score,
+        'suspicious': score >= RATE_THRESHOLD,
+        'stopped_early': stopped_early,
+        'pixels_analyzed': rows_read * header_info.width,
+        'bytes_read': rows_read * header_info.bytes_per_row,
+    }
+
+
+def analyze_one(task):
+    """Analyzes one image and catches its errors (runs in a worker process).
+
+    Args:
+        task (tuple): (image path, early_stop).
+
+    Returns:
+        tuple: (path, result from analyze_image() or None, the StegoError or None).
+    """
+    image_file_path, early_stop = task
+    try:
+        return image_file_path, analyze_image(image_file_path, early_stop), None
+    except StegoError as e:
+        return image_file_path, None, e
+
+
+def analyze_images(image_paths, jobs=None, report=None, early_stop=True, stop_after=None):
+    """Analyzes many images using a pool of worker processes.
+
+    Args:
+        image_paths (iterable): The image paths, for example from scan.iter_image_paths().
+        jobs (int): How many worker processes to use (default: number of CPUs).
+        report (AnalysisReport): Counts the results as they come in, if given.
+        early_stop (bool): Stop reading each image once its result is
+            conclusive (see analyze_image()).
+        stop_after (int): Stop the whole batch once this many suspicious
+            images were found, or None to analyze every image.
+
+    Yields:
+        tuple: (path, result from analyze_image() or None, the StegoError or None),
+        in the same order as image_paths.
+    """
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    if jobs < 1:
+        raise ValueError("jobs must be at least 1")
+
+    found = 0
+
+    def finish(result):
+        nonlocal found
+        if report is not None:
+            report.add(result[1], result[2])
+        if result[1] is not None and result[1]['suspicious']:
+            found += 1
+        return result
+
+    def done():
+        return stop_after is not None and found >= stop_after
+
+    tasks = ((image_file_path, early_stop) for image_file_path in image_paths)
+    if jobs == 1:
+        for task in tasks:
+            yield finish(analyze_one(task))
+            if done():
+                return
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    # Keep a limited number of files waiting, like scan.scan_images(); when
+    # the batch stops early the files still waiting are dropped
+    waiting = deque()
+    queue_size = jobs * ANALYSIS_QUEUE_PER_JOB
+    executor = ProcessPoolExecutor(max_workers=jobs)
+    try:
+        for task in tasks:
+            waiting.append(executor.submit(analyze_one, task))
+            if len(waiting) >= queue_size:
+                yield finish(waiting.popleft().result())
+                if done():
+                    return
+        while waiting:
+            yield finish(waiting.popleft().result())
+            if done():
+                return
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
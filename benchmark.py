@@ -0,0 +1,380 @@
+''' Benchmarks for the encoding and decoding hot paths.
+
+Carrier images are generated in memory (random pixels, odd widths so every
+row has padding), so the numbers don't depend on what is on disk. Each
+function is timed on its own, for 24-bit and 32-bit images and for several
+payload sizes, and the results are written to a JSON file.
+
+Throughput is payload bytes (or bits) per second. Peak memory is the most
+extra memory Python allocated during one call - the carrier image itself
+is not counted.
+
+With --startup it instead times how long the programs take to start, each
+in a new Python process: `cli.py decode --help` should stay under
+STARTUP_BUDGET, since scripts often run the command line once per image.
+
+Examples:
+    python benchmark.py                          # tiny, small and medium images
+    python benchmark.py --sizes large huge       # up to hundreds of megapixels
+    python benchmark.py --output new.json --compare old.json
+    python benchmark.py --startup --output startup.json
+
+With --compare the exit code is 1 when anything got slower by more than
+--threshold (default 20%), so it can be used to catch regressions. With
+--startup it is also 1 when the start-up budget is broken. '''
+
+import argparse
+import json
+import os
+import platform
+import random
+import struct
+import subprocess
+import sys
+import time
+import timeit
+import tracemalloc
+from datetime import datetime, timezone
+
+from encode import read_bmp_header, convert_message_to_binary, encode_24bit, encode_32bit, count_available_bits
+from encode import MESSAGE_DELIMITER, PAYLOAD_HEADER_SIZE
+from decode import extract_bits_24bit, extract_bits_32bit, read_payload_header, extract_payload
+from decode import convert_binary_to_text
+
+
+# Exit codes
+EXIT_OK = 0
+EXIT_REGRESSION = 1
+
+# Carrier sizes (width, height). The widths are odd so 24-bit rows need padding.
+CARRIER_SIZES = {
+    'tiny': (17, 13),
+    'small': (641, 479),
+    'medium': (2001, 1499),
+    'large': (10001, 9999),      # about 100 megapixels
+    'huge': (20001, 14999),      # about 300 megapixels
+}
+DEFAULT_SIZES = ['tiny', 'small', 'medium']
+
+# Payload sizes: a fixed number of bytes, or 'full' for as much as fits
+PAYLOAD_SIZES = ['1KiB', '64KiB', 'full']
+
+# Commands timed by --startup, each run in a new Python process. Plain
+# 'python -c pass' is there to show how much of the time is Python itself.
+STARTUP_COMMANDS = {
+    'python': ['-c', 'pass'],
+    'cli.py decode --help': ['cli.py', 'decode', '--help'],
+    'cli.py --help': ['cli.py', '--help'],
+    'import stego': ['-c', 'import stego'],
+    'import main': ['-c', 'import main'],
+}
+
+# The most `cli.py decode --help` may take to start and finish, in seconds
+STARTUP_BUDGET = 0.05
+
+# Start-up times vary a lot from run to run, so each command is run this
+# many times and the best is kept
+STARTUP_RUNS = 20
+
+# Words used to build text payloads (so the text conversion has real work to do)
+PAYLOAD_WORDS = ['log', 'level', 'INFO', 'request', 'handled', 'in', 'ms', 'user', 'id', 'ok',
+                 'café', '日本', 'status', '200', '{', '}', ':', ',']
+
+
+def make_carrier(width, height, bits_per_pixel, seed=0):
+    """Builds a BMP image with random pixels in memory.
+
+    Args:
+        width (int): Width in pixels.
+        height (int): Height in pixels.
+        bits_per_pixel (int): 24 or 32.
+        seed (int): Seed for the random pixels, so runs are repeatable.
+
+    Returns:
+        bytearray: The whole BMP file.
+    """
+    bytes_per_row = (width * (bits_per_pixel // 8) + 3) // 4 * 4
+    pixel_bytes = bytes_per_row * height
+
+    header = b'BM' + struct.pack('<IHHI', 54 + pixel_bytes, 0, 0, 54)
+    header += struct.pack('<IiiHHIIiiII', 40, width, height, 1, bits_per_pixel, 0, pixel_bytes, 2835, 2835, 0, 0)
+
+    img_bytes = bytearray(header)
+    img_bytes += random.Random(seed).randbytes(pixel_bytes)
+    return img_bytes
+
+
+def make_payload(size, seed=0):
+    """Builds a UTF-8 text payload of exactly size bytes.
+
+    Args:
+        size (int): Payload size in bytes.
+        seed (int): Seed for the random words.
+
+    Returns:
+        bytes: The payload.
+    """
+    rnd = random.Random(seed)
+    words = []
+    length = 0
+    while length < size:
+        word = rnd.choice(PAYLOAD_WORDS)
+        words.append(word)
+        length = length + len(word.encode('utf-8')) + 1
+
+    # Cut to size, then drop any half character left at the end
+    payload = ' '.join(words).encode('utf-8')[:size]
+    text = payload.decode('utf-8', errors='ignore')
+    return (text.encode('utf-8') + b' ' * size)[:size]
+
+
+def parse_payload_size(name, max_bytes):
+    """Turns a payload size name like '64KiB' or 'full' into a number of bytes."""
+    if name == 'full':
+        return max_bytes
+    if name.endswith('KiB'):
+        return min(max_bytes, int(name[:-3]) * 1024)
+    if name.endswith('MiB'):
+        return min(max_bytes, int(name[:-3]) * 1024 * 1024)
+    return min(max_bytes, int(name))
+
+
+def time_call(function, arguments, repeat):
+    """Times a function, keeping the best of several runs.
+
+    Fast functions are called many times per run (enough to take at least
+    0.2 seconds), so even tiny images give steady numbers.
+
+    Args:
+        function (function): The function to time.
+        arguments (tuple): What to call it with.
+        repeat (int): How many timed runs.
+
+    Returns:
+        tuple: (best time per call in seconds, peak memory in bytes during one extra call).
+    """
+    timer = timeit.Timer(lambda: function(*arguments))
+    number, _ = timer.autorange()
+    best = min(timer.repeat(repeat, number)) / number
+
+    # Memory is measured in a separate call, since tracing slows everything down
+    tracemalloc.start()
+    try:
+        function(*arguments)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return best, peak
+
+
+def make_result(name, bits_per_pixel, width, height, payload_bytes, seconds, peak_memory):
+    """Builds one benchmark result with its throughput figures."""
+    seconds = max(seconds, 1e-9)
+    return {
+        'function': name,
+        'bits_per_pixel': bits_per_pixel,
+        'width': width,
+        'height': height,
+        'payload_bytes': payload_bytes,
+        'seconds': seconds,
+        'mb_per_s': payload_bytes / seconds / 1e6,
+        'bits_per_s': payload_bytes * 8 / seconds,
+        'peak_memory_bytes': peak_memory,
+    }
+
+
+def benchmark_carrier(size_name, bits_per_pixel, payload_names, repeat):
+    """Runs every benchmark on one generated carrier.
+
+    Args:
+        size_name (str): One of CARRIER_SIZES.
+        bits_per_pixel (int): 24 or 32.
+        payload_names (list): Payload sizes from PAYLOAD_SIZES (or a number of bytes).
+        repeat (int): How many timed runs per function.
+
+    Yields:
+        dict: One result per function and payload size.
+    """
+    width, height = CARRIER_SIZES[size_name]
+    carrier = make_carrier(width, height, bits_per_pixel, seed=width)
+    header_info = read_bmp_header(carrier)
+
+    if bits_per_pixel == 24:
+        encoder = encode_24bit
+        extract_bits = extract_bits_24bit
+    else:
+        encoder = encode_32bit
+        extract_bits = extract_bits_32bit
+
+    # The biggest payload that fits with its header (or delimiter)
+    max_bytes = header_info.carrier_count // 8 - PAYLOAD_HEADER_SIZE
+
+    done = set()
+    for payload_name in payload_names:
+        # Small carriers can't hold the bigger payloads, which then all come
+        # out as 'full' - only run each size once
+        payload_bytes = parse_payload_size(payload_name, max_bytes)
+        if payload_bytes <= 0 or payload_bytes in done:
+            continue
+        done.add(payload_bytes)
+        payload = make_payload(payload_bytes, seed=payload_bytes)
+        text = payload.decode('utf-8')
+        full_data = convert_message_to_binary(text)
+
+        def timed(name, function, arguments):
+            seconds, peak = time_call(function, arguments, repeat)
+            return make_result(name, bits_per_pixel, width, height, payload_bytes, seconds, peak)
+
+        yield timed('convert_message_to_binary', convert_message_to_binary, (text,))
+
+        # Hiding the same message again changes nothing, so one copy of the
+        # carrier can be reused for every call
+        yield timed(encoder.__name__, encoder, (bytearray(carrier), full_data, header_info))
+
+        # The same with matrix embedding (3 bits in every 7 color bytes), when it fits
+        matrix_data = convert_message_to_binary(text, matrix_bits=3)
+        if len(matrix_data) * 8 <= count_available_bits(header_info, 1, 3):
+            yield timed(f'{encoder.__name__} (matrix 3)', encoder, (bytearray(carrier), matrix_data, header_info))
+
+        # A carrier with a message hidden the current way (with a header)...
+        with_header = bytearray(carrier)
+        encoder(with_header, full_data, header_info)
+        yield timed('extract_payload', lambda img: extract_payload(img, header_info, read_payload_header(img, header_info)),
+                    (with_header,))
+
+        # ...and the older way, ending in the delimiter
+        with_delimiter = bytearray(carrier)
+        encoder(with_delimiter, payload + MESSAGE_DELIMITER, header_info)
+        yield timed(extract_bits.__name__, extract_bits, (with_delimiter, MESSAGE_DELIMITER, header_info))
+
+        yield timed('convert_binary_to_text', convert_binary_to_text, (payload,))
+
+
+def benchmark_startup():
+    """Times how long each of STARTUP_COMMANDS takes in a new Python process.
+
+    Each command is run once first so Python has already compiled the
+    modules (as it has for anyone who ran them before), then STARTUP_RUNS
+    more times.
+
+    Yields:
+        dict: One result per command (with no image or payload).
+    """
+    folder = os.path.dirname(os.path.abspath(__file__))
+    for name, arguments in STARTUP_COMMANDS.items():
+        command = [sys.executable] + arguments
+        subprocess.run(command, cwd=folder, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+
+        best = None
+        for _ in range(STARTUP_RUNS):
+            start = time.perf_counter()
+            subprocess.run(command, cwd=folder, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+            seconds = time.perf_counter() - start
+            best = seconds if best is None else min(best, seconds)
+        yield make_result(f'startup: {name}', 0, 0, 0, 0, best, 0)
+
+
+def compare_results(results, baseline, threshold):
+    """Finds benchmarks that got slower than in an earlier run.
+
+    Args:
+        results (list): The results of this run.
+        baseline (list): The results of the earlier run.
+        threshold (float): How much slower counts as a regression (0.2 = 20%).
+
+    Returns:
+        list: (result, earlier seconds) for every regression.
+    """
+    def key(result):
+        return (result['function'], result['bits_per_pixel'], result['width'], result['height'],
+                result['payload_bytes'])
+
+    earlier = {key(result): result['seconds'] for result in baseline}
+    regressions = []
+    for result in results:
+        earlier_seconds = earlier.get(key(result))
+        if earlier_seconds is not None and result['seconds'] > earlier_seconds * (1 + threshold):
+            regressions.append((result, earlier_seconds))
+    return regressions
+
+
+def build_parser():
+    """Builds the command-line argument parser."""
+    parser = argparse.ArgumentParser(
+        prog='benchmark.py',
+        description='Time the encoding and decoding functions on generated images.',
+    )
+    parser.add_argument('--sizes', nargs='+', default=DEFAULT_SIZES, choices=list(CARRIER_SIZES),
+                        help=f"carrier sizes to run (default: {' '.join(DEFAULT_SIZES)})")
+    parser.add_argument('--bits', nargs='+', type=int, default=[24, 32], choices=[24, 32],
+                        help='bit depths to run (default: 24 32)')
+    parser.add_argument('--payloads', nargs='+', default=PAYLOAD_SIZES,
+                        help="payload sizes, like 1KiB, 2MiB, 5000 or full (default: 1KiB 64KiB full)")
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per function, the best is kept (default: 3)')
+    parser.add_argument('-o', '--output', default='benchmark_results.json', help='where to write the results')
+    parser.add_argument('--compare', help='results file from an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='how much slower counts as a regression with --compare (default: 0.2 = 20%%)')
+    parser.add_argument('--startup', action='store_true',
+                        help=f'time how long the programs take to start instead '
+                             f'(budget for cli.py decode --help: {STARTUP_BUDGET * 1000:.0f} ms)')
+    return parser
+
+
+def main(argv=None):
+    """Runs the benchmarks and returns the exit code."""
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    if args.repeat < 1:
+        parser.error('--repeat must be at least 1')
+
+    results = []
+    over_budget = False
+    if args.startup:
+        for result in benchmark_startup():
+            results.append(result)
+            print(f"{result['function']:<35} {result['seconds'] * 1000:8.1f} ms")
+            if result['function'] == 'startup: cli.py decode --help' and result['seconds'] > STARTUP_BUDGET:
+                print(f"Over budget: cli.py decode --help took more than {STARTUP_BUDGET * 1000:.0f} ms")
+                over_budget = True
+    else:
+        for size_name in args.sizes:
+            for bits_per_pixel in args.bits:
+                for result in benchmark_carrier(size_name, bits_per_pixel, args.payloads, args.repeat):
+                    results.append(result)
+                    print(f"{result['function']:<27} {size_name:<7} {bits_per_pixel}-bit "
+                          f"{result['payload_bytes']:>11} B  {result['seconds'] * 1000:10.2f} ms  "
+                          f"{result['mb_per_s']:9.2f} MB/s  {result['peak_memory_bytes'] / 1e6:9.2f} MB peak")
+
+    report = {
+        'created': datetime.now(timezone.utc).isoformat(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'repeat': args.repeat,
+        'results': results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as results_file:
+        json.dump(report, results_file, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as baseline_file:
+            baseline = json.load(baseline_file)['results']
+        regressions = compare_results(results, baseline, args.threshold)
+        for result, earlier_seconds in regressions:
+            print(f"Slower: {result['function']} {result['bits_per_pixel']}-bit "
+                  f"{result['width']}x{result['height']} {result['payload_bytes']} B: "
+                  f"{earlier_seconds * 1000:.2f} ms -> {result['seconds'] * 1000:.2f} ms")
+        if regressions:
+            return EXIT_REGRESSION
+        print("No regressions.")
+
+    if over_budget:
+        return EXIT_REGRESSION
+    return EXIT_OK
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,363 @@
+''' A cache of decoded messages, so decoding the same image again is instant.
+
+Decoding reads and unpacks every color byte the message is hidden in. When
+the same images are decoded over and over (audits, retries, several
+programs reading the same files), a DecodeCache keeps the messages it
+already found and hands them straight back.
+
+Each image is recognised in one of two ways:
+
+- 'file' (the default): by the file itself - its device, inode, size and
+  last change time, all from a single os.stat(). A hit doesn't read the
+  file at all. A file changed in the last RACY_SECONDS is never cached:
+  it could be changed again within the same clock tick and still look the
+  same.
+
+- 'content': by a hash of the file from its first byte to the end of the
+  hidden message. This still reads that part of the file, but finds copies
+  of an image too, and anything written since is noticed whatever its
+  time stamps say.
+
+The key the message was hidden with is part of the cache key (as a hash),
+so the same image decoded with another key is never answered from the
+cache. Failed decodes are not cached.
+
+The cache holds at most max_bytes of messages. When it is full the one
+used longest ago is dropped first. It can be saved to a file and loaded
+again by a later run. That file holds the decoded messages as they are,
+so it is only readable by its owner and should be kept as private as the
+messages themselves.
+
+    from cache import DecodeCache
+
+    cache = DecodeCache(path='decoded.cache')
+    message = decode_file('secret.bmp', cache=cache)
+    cache.save() '''
+
+import os
+import struct
+import time
+from collections import OrderedDict
+
+from errors import StegoError, CacheError
+
+
+# How many bytes of messages a cache keeps by default
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+
+# Counted on top of the key and message for every entry, so a huge number
+# of tiny messages can't grow the cache without limit
+ENTRY_OVERHEAD = 64
+
+# Files changed less than this many seconds ago are not cached by 'file'
+# identity (see above)
+RACY_SECONDS = 2
+
+# The ways an image can be recognised
+IDENTITY_CHOICES = ['file', 'content']
+
+# Mixed into the key before it is hashed, so the hash differs from any other use of it
+KEY_SALT = b'bmp-lsb-cache-1'
+
+# How much of the file is hashed at a time with 'content' identity
+HASH_READ_SIZE = 1024 * 1024
+
+# The cache file: a header, then every entry (oldest first) as the length of
+# its cache key, the length of its message, the cache key and the message
+CACHE_FILE_MAGIC = b'LSBCACHE'
+CACHE_FILE_VERSION = 1
+CACHE_FILE_HEADER_FORMAT = '>8sBI'
+CACHE_FILE_ENTRY_FORMAT = '>HI'
+
+
+class DecodeCache:
+    """Decoded messages, found again by the image they came from.
+
+    Args:
+        max_bytes (int): The most message bytes to keep.
+        path (str): A file to load the cache from (if it exists) and save it to.
+        identity (str): How to recognise an image: 'file' or 'content' (see above).
+
+    Attributes:
+        hits (int): How many lookups found a message.
+        misses (int): How many lookups found nothing.
+
+    Raises:
+        ValueError: If max_bytes is negative or identity is unknown.
+        CacheError: If the cache file exists but can't be read.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES, path=None, identity='file'):
+        if max_bytes < 0:
+            raise ValueError("The cache size can't be negative")
+        if identity not in IDENTITY_CHOICES:
+            raise ValueError(f"Unknown cache identity: {identity}")
+
+        self.max_bytes = max_bytes
+        self.path = path
+        self.identity = identity
+        self.hits = 0
+        self.misses = 0
+
+        # Oldest first, so the next one to drop is always at the front
+        self.entries = OrderedDict()
+        self.size = 0
+
+        # Several threads may share one cache (like scan.py's readers).
+        # threading is imported here so that cli.py can read the defaults
+        # above without loading it.
+        import threading
+        self.lock = threading.Lock()
+
+        if path is not None:
+            self.load()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup_key(self, image_file_path, key=None):
+        """Works out what an image is stored under.
+
+        Args:
+            image_file_path (str): Path to the image file.
+            key (str or bytes): The secret key the message was hidden with, or None.
+
+        Returns:
+            bytes: The cache key, or None if this image can't be cached
+            (it just changed, or it can't be read - decoding it reports why).
+        """
+        if self.identity == 'file':
+            identity = file_identity(image_file_path)
+        else:
+            identity = content_identity(image_file_path, key)
+        if identity is None:
+            return None
+        return identity + key_digest(key)
+
+    def get(self, cache_key):
+        """Returns the message stored under a cache key, or None."""
+        with self.lock:
+            message_bytes = self.entries.get(cache_key) if cache_key is not None else None
+            if message_bytes is None:
+                self.misses = self.misses + 1
+                return None
+            self.entries.move_to_end(cache_key)
+            self.hits = self.hits + 1
+            return message_bytes
+
+    def put(self, cache_key, message_bytes):
+        """Stores a message, dropping the ones used longest ago if the cache is full.
+
+        Messages bigger than the whole cache (and images that can't be
+        cached, with a cache_key of None) are left out.
+        """
+        if cache_key is None:
+            return
+        entry_size = entry_bytes(cache_key, message_bytes)
+        if entry_size > self.max_bytes:
+            return
+
+        with self.lock:
+            old_bytes = self.entries.pop(cache_key, None)
+            if old_bytes is not None:
+                self.size = self.size - entry_bytes(cache_key, old_bytes)
+            self.entries[cache_key] = bytes(message_bytes)
+            self.size = self.size + entry_size
+            self.evict()
+
+    def evict(self):
+        """Drops the entries used longest ago until the cache fits in max_bytes."""
+        while self.size > self.max_bytes:
+            cache_key, message_bytes = self.entries.popitem(last=False)
+            self.size = self.size - entry_bytes(cache_key, message_bytes)
+
+    def clear(self):
+        """Drops every entry."""
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def load(self):
+        """Reads the entries saved in the cache file, if there is one.
+
+        A cache file that is damaged or from another version is ignored (the
+        cache just starts empty and the file is replaced on the next save).
+
+        Raises:
+            CacheError: If the file exists but can't be read.
+        """
+        try:
+            with open(self.path, 'rb') as cache_file:
+                data = cache_file.read()
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            raise CacheError(f"Could not read the cache file '{self.path}'. {str(e)}") from e
+
+        entries = parse_cache_file(data)
+        if entries is None:
+            return
+
+        with self.lock:
+            for cache_key, message_bytes in entries:
+                self.entries[cache_key] = message_bytes
+                self.size = self.size + entry_bytes(cache_key, message_bytes)
+            self.evict()
+
+    def save(self, path=None):
+        """Writes the cache to a file, which only its owner can read.
+
+        The file is written under another name first and then renamed, so a
+        run that is stopped halfway (or another run reading it) never sees
+        half a cache.
+
+        Args:
+            path (str): Where to save it (default: the path the cache was made with).
+
+        Raises:
+            CacheError: If the file can't be written.
+            ValueError: If there is no path to save to.
+        """
+        path = path or self.path
+        if path is None:
+            raise ValueError("The cache has no file to be saved to")
+
+        with self.lock:
+            entries = list(self.entries.items())
+
+        temporary_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            handle = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with open(handle, 'wb') as cache_file:
+                cache_file.write(struct.pack(CACHE_FILE_HEADER_FORMAT, CACHE_FILE_MAGIC, CACHE_FILE_VERSION,
+                                             len(entries)))
+                for cache_key, message_bytes in entries:
+                    cache_file.write(struct.pack(CACHE_FILE_ENTRY_FORMAT, len(cache_key), len(message_bytes)))
+                    cache_file.write(cache_key)
+                    cache_file.write(message_bytes)
+            os.replace(temporary_path, path)
+        except OSError as e:
+            try:
+                os.remove(temporary_path)
+            except OSError:
+                pass
+            raise CacheError(f"Could not save the cache file '{path}'. {str(e)}") from e
+
+
+def entry_bytes(cache_key, message_bytes):
+    """Returns how much of the cache an entry takes up."""
+    return len(cache_key) + len(message_bytes) + ENTRY_OVERHEAD
+
+
+def key_digest(key):
+    """Turns the secret key into the part of the cache key that stands for it.
+
+    Only a salted hash of the key is kept, never the key itself. Images with
+    no key get no extra part.
+    """
+    if key is None:
+        return b''
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+
+    # Only imported when a key is used (see scatter.py)
+    import hashlib
+    return hashlib.sha256(KEY_SALT + key).digest()
+
+
+def file_identity(image_file_path):
+    """Recognises an image file by its device, inode, size and last change time.
+
+    Returns:
+        bytes: The identity, or None if the file can't be looked at or
+        changed less than RACY_SECONDS ago.
+    """
+    try:
+        info = os.stat(image_file_path)
+    except OSError:
+        return None
+    if time.time() - info.st_mtime < RACY_SECONDS:
+        return None
+    return b'F%d:%d:%d:%d:' % (info.st_dev, info.st_ino, info.st_size, info.st_mtime_ns)
+
+
+def content_identity(image_file_path, key=None):
+    """Recognises an image file by a hash of its headers and hidden message.
+
+    Only the file up to the end of the hidden message is hashed. With a key
+    the message can be anywhere, and images from older versions don't say
+    how long it is, so then the whole file is hashed.
+
+    Returns:
+        bytes: The identity, or None if the file can't be read or used.
+    """
+    from encode import validate_bmp_basic, read_bmp_header, validate_bmp_header, check_bits_per_pixel
+    from encode import count_carriers_for_size, PAYLOAD_HEADER_SIZE
+    from decode import open_image_reader, read_payload_header, check_payload_header, INSPECT_READ_SIZE
+    import hashlib
+
+    try:
+        img_bytes = open_image_reader(image_file_path, INSPECT_READ_SIZE)
+        try:
+            validate_bmp_basic(img_bytes, image_file_path)
+            header_info = read_bmp_header(img_bytes)
+            validate_bmp_header(header_info, img_bytes)
+            check_bits_per_pixel(header_info)
+
+            hash_end = len(img_bytes)
+            payload_header = read_payload_header(img_bytes, header_info) if key is None else None
+            if payload_header is not None:
+                bits_per_channel, matrix_bits = check_payload_header(header_info, payload_header)
+                carriers = count_carriers_for_size(PAYLOAD_HEADER_SIZE + payload_header['payload_length'],
+                                                   bits_per_channel, matrix_bits)
+                hash_end = min(hash_end, header_info.carrier_end(carriers))
+        finally:
+            img_bytes.close()
+
+        # The hash function is fast enough that reading the file is what takes the time
+        digest = hashlib.blake2b(digest_size=16)
+        with open(image_file_path, 'rb') as image_file:
+            bytes_left = hash_end
+            while bytes_left > 0:
+                block = image_file.read(min(HASH_READ_SIZE, bytes_left))
+                if not block:
+                    break
+                digest.update(block)
+                bytes_left = bytes_left - len(block)
+    except (StegoError, OSError):
+        return None
+    return b'C%d:' % hash_end + digest.digest()
+
+
+def parse_cache_file(data):
+    """Reads the entries out of the bytes of a cache file.
+
+    Returns:
+        list: (cache key, message) pairs, oldest first, or None if the data
+        isn't a cache file this version can read.
+    """
+    header_size = struct.calcsize(CACHE_FILE_HEADER_FORMAT)
+    entry_header_size = struct.calcsize(CACHE_FILE_ENTRY_FORMAT)
+    if len(data) < header_size:
+        return None
+    magic, version, count = struct.unpack_from(CACHE_FILE_HEADER_FORMAT, data)
+    if magic != CACHE_FILE_MAGIC or version != CACHE_FILE_VERSION:
+        return None
+
+    entries = []
+    position = header_size
+    for _ in range(count):
+        if position + entry_header_size > len(data):
+            return None
+        key_length, message_length = struct.unpack_from(CACHE_FILE_ENTRY_FORMAT, data, position)
+        position = position + entry_header_size
+        if position + key_length + message_length > len(data):
+            return None
+        cache_key = data[position:position + key_length]
+        position = position + key_length
+        entries.append((cache_key, data[position:position + message_length]))
+        position = position + message_length
+
+    if position != len(data):
+        return None
+    return entries
@@ -0,0 +1,646 @@
+''' Command-line interface for the steganography tools, for use in scripts.
+
+Unlike main.py it never asks questions. Images are given as file paths,
+directories (searched for .bmp files) or glob patterns, and the work is
+shared out over a pool of worker processes.
+
+Examples:
+    python cli.py encode --message "Meet at noon" --output-dir out/ carriers/
+    python cli.py encode --matrix 3 --message "Meet at noon" --output-dir out/ carriers/
+    python cli.py encode --key "correct horse" --message "Meet at noon" --output-dir out/ carriers/
+    python cli.py decode "out/*.bmp"
+    python cli.py decode --key "correct horse" "out/*.bmp"
+    python cli.py decode --cache decoded.cache "out/*.bmp"
+    python cli.py --jobs 8 capacity carriers/
+    python cli.py --stats decode "out/*.bmp"
+    python cli.py split --message-file archive.zip --output-dir out/ a.bmp b.bmp c.bmp
+    python cli.py join --output archive.zip out/
+    python cli.py scan --threads 32 archive/
+    python cli.py --jobs 8 analyze --stop-after 1 incoming/
+    cat photo.bmp | python cli.py encode --message "Meet at noon" - | python cli.py decode -
+
+Every image gets one JSON line on standard output. With --stats each line
+also lists how long every step took, and a summary table of all the steps
+is printed to standard error at the end. The scan and analyze commands
+always print how many files they checked per second to standard error.
+The exit code is 0 when every image worked, 1 when at least one failed and
+2 for bad arguments.
+
+Given - as the only image, encode reads the image from standard input and
+writes the new image to standard output, and decode writes the message
+itself (not a JSON line) to standard output. The image is read once from
+start to end and written out a few rows at a time, with no temporary files,
+so they work in the middle of a pipeline. The JSON line then goes to
+standard error.
+
+Each command only imports the modules it needs, when it runs, so a single
+quick command (or --help) doesn't wait for all of them to load. benchmark.py
+--startup checks how long that takes. '''
+
+import argparse
+import os
+import sys
+from contextlib import nullcontext
+from functools import partial
+
+# Only what the argument parser needs is imported up front (see above)
+from options import MAX_BITS_PER_CHANNEL, COMPRESSION_CHOICES, MIN_MATRIX_BITS, MAX_MATRIX_BITS, SCAN_THREADS
+from cache import DEFAULT_CACHE_BYTES, IDENTITY_CHOICES
+from errors import StegoError
+
+
+# Exit codes
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+
+# The image name that means standard input (and output)
+STDIO_NAME = '-'
+
+# The message every encode worker hides and how to hide it (set once per
+# worker process so a big message isn't sent along with every single image).
+# A message file is never read in here - each worker hides it straight from disk.
+worker_message = None
+worker_message_file = None
+worker_bits_per_channel = 1
+worker_compression = 'none'
+worker_shard_jobs = 1
+worker_matrix_bits = 0
+worker_key = None
+
+
+def set_worker_message(message, bits_per_channel=1, compression='none', shard_jobs=1, message_file_path=None,
+                       matrix_bits=0, key=None):
+    """Stores the message (or the path of the message file) the encode workers should hide.
+
+    shard_jobs is how many processes each image is split over. It is only
+    more than 1 when there is a single image to encode (and the message
+    isn't a file).
+    """
+    global worker_message, worker_message_file, worker_bits_per_channel, worker_compression, worker_shard_jobs
+    global worker_matrix_bits, worker_key
+    worker_message = message
+    worker_message_file = message_file_path
+    worker_bits_per_channel = bits_per_channel
+    worker_compression = compression
+    worker_shard_jobs = shard_jobs
+    worker_matrix_bits = matrix_bits
+    worker_key = key
+
+
+def find_carrier_files(patterns):
+    """Turns the paths, directories and glob patterns from the command line into files.
+
+    Args:
+        patterns (list): Paths, directories or glob patterns.
+
+    Returns:
+        list: Image file paths in the order they were given (directories sorted).
+    """
+    import glob
+    files = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            # Every .bmp file in the directory and the ones below it
+            found = []
+            for folder, _, names in os.walk(pattern):
+                for name in names:
+                    if name.lower().endswith('.bmp'):
+                        found.append(os.path.join(folder, name))
+            files.extend(sorted(found))
+        elif glob.has_magic(pattern):
+            files.extend(sorted(glob.glob(pattern, recursive=True)))
+        else:
+            # A plain path - if it doesn't exist the worker reports it
+            files.append(pattern)
+    return files
+
+
+def error_result(image_file_path, error):
+    """Builds the JSON result for an image that failed."""
+    return {
+        'file': image_file_path,
+        'ok': False,
+        'error_type': type(error).__name__,
+        'error': ' '.join(str(error).split()),
+    }
+
+
+def make_recorder(stats):
+    """Returns a Recorder that measures every step when --stats is on, otherwise None."""
+    from instrument import Recorder
+    return Recorder(trace_memory=True) if stats else None
+
+
+def add_stages(result, recorder):
+    """Adds the steps a Recorder saw to a JSON result (when --stats is on)."""
+    if recorder is not None:
+        result['stages'] = [record.as_dict() for record in recorder.records]
+    return result
+
+
+def encode_worker(task, stats=False):
+    """Hides worker_message in one image (runs in a worker process)."""
+    from encode import encode_file, encode_message_file
+    image_file_path, new_image_path = task
+    recorder = make_recorder(stats)
+    try:
+        with recorder or nullcontext():
+            if worker_message_file is not None:
+                saved_path = encode_message_file(image_file_path, new_image_path, worker_message_file,
+                                                 worker_bits_per_channel, worker_compression, worker_matrix_bits,
+                                                 worker_key)
+            else:
+                saved_path = encode_file(image_file_path, new_image_path, worker_message,
+                                         worker_bits_per_channel, worker_compression, worker_shard_jobs,
+                                         worker_matrix_bits, worker_key)
+    except StegoError as e:
+        return add_stages(error_result(image_file_path, e), recorder)
+    return add_stages({'file': image_file_path, 'ok': True, 'output': saved_path}, recorder)
+
+
+def decode_worker(image_file_path, stats=False, key=None, keep_bytes=False):
+    """Decodes the message hidden in one image (runs in a worker process).
+
+    With keep_bytes the message bytes come back too (as 'message_bytes'), for
+    the cache. They must be taken out before the result is written.
+    """
+    from decode import extract_file, convert_message_bytes
+    recorder = make_recorder(stats)
+    try:
+        with recorder or nullcontext():
+            message_bytes = extract_file(image_file_path, key)
+            message = convert_message_bytes(message_bytes)
+    except StegoError as e:
+        return add_stages(error_result(image_file_path, e), recorder)
+    result = add_stages({'file': image_file_path, 'ok': True, 'message': message}, recorder)
+    if keep_bytes:
+        result['message_bytes'] = message_bytes
+    return result
+
+
+def run_cached_decode(cache, image_files, key, stats, jobs):
+    """Decodes images, taking the ones already in the cache straight from it.
+
+    The cache stays in this process: images it has are answered without
+    being read, the rest go to the workers and what they find is added.
+
+    Yields:
+        dict: One result per image, in order.
+    """
+    from decode import convert_binary_to_text
+
+    cache_keys = [cache.lookup_key(path, key) for path in image_files]
+    cached = [cache.get(cache_key) for cache_key in cache_keys]
+    worker = partial(decode_worker, key=key, keep_bytes=True, stats=stats)
+    decoded = run_jobs(worker, [path for path, message_bytes in zip(image_files, cached) if message_bytes is None],
+                       jobs)
+
+    for path, cache_key, message_bytes in zip(image_files, cache_keys, cached):
+        if message_bytes is not None:
+            yield {'file': path, 'ok': True, 'message': convert_binary_to_text(message_bytes), 'cached': True}
+            continue
+        result = next(decoded)
+        message_bytes = result.pop('message_bytes', None)
+        if message_bytes is not None:
+            cache.put(cache_key, message_bytes)
+            result['cached'] = False
+        yield result
+
+
+def capacity_worker(image_file_path, stats=False):
+    """Reports how much one image can hold and if it has a message (runs in a worker process)."""
+    from decode import inspect_file
+    recorder = make_recorder(stats)
+    try:
+        with recorder or nullcontext():
+            details = inspect_file(image_file_path)
+    except StegoError as e:
+        return add_stages(error_result(image_file_path, e), recorder)
+    return add_stages({'file': image_file_path, 'ok': True, **details}, recorder)
+
+
+def run_jobs(worker, tasks, jobs, initializer=None, initargs=()):
+    """Runs a worker over every task and yields the results in task order.
+
+    Args:
+        worker (function): The function to run for each task.
+        tasks (list): One entry per image.
+        jobs (int): How many worker processes to use (1 = no pool at all).
+        initializer (function): Run once in every worker before any task.
+        initargs (tuple): Arguments for the initializer.
+
+    Yields:
+        dict: One result per task.
+    """
+    if jobs == 1 or len(tasks) <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for task in tasks:
+            yield worker(task)
+        return
+
+    # Hand tasks out in batches so the workers don't spend their time
+    # waiting for the next image
+    chunksize = max(1, len(tasks) // (jobs * 4))
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=jobs, initializer=initializer, initargs=initargs) as executor:
+        yield from executor.map(worker, tasks, chunksize=chunksize)
+
+
+def add_hiding_arguments(command_parser, images_help='images, directories or glob patterns'):
+    """Adds the arguments shared by the encode and split commands."""
+    message_source = command_parser.add_mutually_exclusive_group(required=True)
+    message_source.add_argument('-m', '--message', help='the message text')
+    message_source.add_argument(
+        '-f', '--message-file',
+        help='hide this file (any kind, any size); it is read a block at a time, never all at once',
+    )
+    command_parser.add_argument(
+        '-o', '--output-dir',
+        help='where to save the new images (leave it out with -, where the new image goes to standard output)',
+    )
+    command_parser.add_argument(
+        '-b', '--bits-per-channel', type=int, default=1, choices=range(1, MAX_BITS_PER_CHANNEL + 1),
+        help='bits to hide in each color byte; more holds more but is easier to spot (default: 1)',
+    )
+    command_parser.add_argument(
+        '-c', '--compress', default='none', choices=COMPRESSION_CHOICES,
+        help='compress the message first; only used when it makes it smaller (default: none)',
+    )
+    command_parser.add_argument('images', nargs='+', help=images_help)
+
+
+def read_message_arguments(parser, args):
+    """Gets the message to hide from --message or --message-file.
+
+    A message file is only checked here, never read: it is hidden straight from disk.
+
+    Returns:
+        bytes: The message, or None when it is in args.message_file.
+    """
+    if args.message is not None:
+        message = args.message.encode('utf-8')
+        message_size = len(message)
+    else:
+        message = None
+        try:
+            message_size = os.path.getsize(args.message_file)
+        except OSError as e:
+            parser.error(f"could not read the message file: {e}")
+    if not message_size:
+        parser.error('the message cannot be empty')
+    return message
+
+
+def plan_output_paths(parser, image_files, output_dir):
+    """Works out where every new image goes: the output directory, under its old name."""
+    new_paths = [os.path.join(output_dir, os.path.basename(path)) for path in image_files]
+    if len(set(new_paths)) != len(new_paths):
+        parser.error('two images have the same file name and would overwrite each other in --output-dir')
+    os.makedirs(output_dir, exist_ok=True)
+    return new_paths
+
+
+def write_result(result, output=None):
+    """Writes one JSON result line to standard output (or another text stream)."""
+    import json
+    output = output or sys.stdout
+    output.write(json.dumps(result, ensure_ascii=False) + '\n')
+    output.flush()
+
+
+def run_stream(parser, args):
+    """Runs encode or decode on an image from standard input and returns the exit code.
+
+    The new image (or the message) goes to standard output, so the JSON
+    result line goes to standard error.
+    """
+    if args.command == 'encode':
+        if args.output_dir is not None:
+            parser.error('--output-dir cannot be used with -, the new image goes to standard output')
+        if args.matrix and args.bits_per_channel != 1:
+            parser.error('--matrix only works with --bits-per-channel 1')
+        if sys.stdout.isatty():
+            parser.error('refusing to write an image to a terminal; redirect standard output')
+        message = read_message_arguments(parser, args)
+    elif args.cache is not None:
+        parser.error('--cache cannot be used with -, standard input has no file to recognise')
+
+    from instrument import add_to_totals, format_report
+    recorder = make_recorder(args.stats)
+    try:
+        with recorder or nullcontext():
+            if args.command == 'decode':
+                from decode import save_message_stream
+                size = save_message_stream(sys.stdin.buffer, sys.stdout.buffer, args.key)
+                result = {'file': STDIO_NAME, 'ok': True, 'output': STDIO_NAME, 'message_bytes': size}
+            elif message is None:
+                from encode import encode_message_file_stream
+                size = encode_message_file_stream(sys.stdin.buffer, sys.stdout.buffer, args.message_file,
+                                                  args.bits_per_channel, args.compress, args.matrix, args.key)
+                result = {'file': STDIO_NAME, 'ok': True, 'output': STDIO_NAME, 'image_bytes': size}
+            else:
+                from encode import encode_stream
+                size = encode_stream(sys.stdin.buffer, sys.stdout.buffer, message, args.bits_per_channel,
+                                     args.compress, args.matrix, args.key)
+                result = {'file': STDIO_NAME, 'ok': True, 'output': STDIO_NAME, 'image_bytes': size}
+    except StegoError as e:
+        result = error_result(STDIO_NAME, e)
+
+    write_result(add_stages(result, recorder), sys.stderr)
+    if recorder is not None:
+        stage_totals = {}
+        for record in recorder.records:
+            add_to_totals(stage_totals, record)
+        sys.stderr.write(format_report(stage_totals) + '\n')
+    return EXIT_OK if result['ok'] else EXIT_FAILED
+
+
+def run_split(parser, args, image_files):
+    """Runs the split command and returns the exit code.
+
+    Either every image is saved or none is, so when it fails every image
+    gets the same error.
+    """
+    from split import split_message, split_file
+    message = read_message_arguments(parser, args)
+    new_paths = plan_output_paths(parser, image_files, args.output_dir)
+
+    try:
+        if message is not None:
+            sizes = split_message(image_files, new_paths, message, args.bits_per_channel, args.compress, args.jobs)
+        else:
+            sizes = split_file(image_files, new_paths, args.message_file, args.bits_per_channel, args.compress,
+                               args.jobs)
+    except StegoError as e:
+        for path in image_files:
+            write_result(error_result(path, e))
+        return EXIT_FAILED
+
+    for part, (path, new_path, size) in enumerate(zip(image_files, new_paths, sizes)):
+        write_result({'file': path, 'ok': True, 'output': new_path, 'part': part + 1, 'parts': len(image_files),
+                      'part_bytes': size})
+    return EXIT_OK
+
+
+def run_join(args, image_files):
+    """Runs the join command and returns the exit code."""
+    from split import join_files
+    try:
+        message_size, part_numbers = join_files(image_files, args.output, args.jobs)
+    except StegoError as e:
+        for path in image_files:
+            write_result(error_result(path, e))
+        return EXIT_FAILED
+
+    for path, part in zip(image_files, part_numbers):
+        write_result({'file': path, 'ok': True, 'output': args.output, 'part': part, 'parts': len(image_files),
+                      'message_bytes': message_size})
+    return EXIT_OK
+
+
+def run_scan(args):
+    """Runs the scan command and returns the exit code."""
+    from scan import iter_image_paths, scan_images, ScanReport
+    report = ScanReport()
+    exit_code = EXIT_OK
+    for path, details, error in scan_images(iter_image_paths(args.images), args.threads, report):
+        if error is not None:
+            write_result(error_result(path, error))
+            exit_code = EXIT_FAILED
+        else:
+            write_result({'file': path, 'ok': True, **details})
+
+    sys.stderr.write(report.summary() + '\n')
+    if report.files == 0:
+        sys.stderr.write('cli.py: no images found\n')
+        return EXIT_USAGE
+    return exit_code
+
+
+def run_analyze(args):
+    """Runs the analyze command and returns the exit code."""
+    from scan import iter_image_paths
+    from analysis import analyze_images, AnalysisReport
+    report = AnalysisReport()
+    exit_code = EXIT_OK
+    results = analyze_images(iter_image_paths(args.images), args.jobs, report, not args.full, args.stop_after)
+    for path, details, error in results:
+        if error is not None:
+            write_result(error_result(path, error))
+            exit_code = EXIT_FAILED
+        else:
+            write_result({'file': path, 'ok': True, **details})
+
+    sys.stderr.write(report.summary() + '\n')
+    if report.files == 0:
+        sys.stderr.write('cli.py: no images found\n')
+        return EXIT_USAGE
+    return exit_code
+
+
+def build_parser():
+    """Builds the command-line argument parser."""
+    parser = argparse.ArgumentParser(
+        prog='cli.py',
+        description='Hide messages in BMP images and get them back out, without any prompts.',
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=os.cpu_count() or 1,
+        help='number of worker processes (default: number of CPUs)',
+    )
+    parser.add_argument(
+        '--stats', action='store_true',
+        help='time every step (and its memory use) and print a summary to standard error',
+    )
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    encode_parser = commands.add_parser('encode', help='hide a message in each image')
+    add_hiding_arguments(
+        encode_parser,
+        'images, directories or glob patterns, or - to read one image from standard input and write the new '
+        'image to standard output',
+    )
+    encode_parser.add_argument(
+        '--matrix', type=int, default=0, metavar='P', choices=range(MIN_MATRIX_BITS, MAX_MATRIX_BITS + 1),
+        help=f'matrix embedding: hide P bits in every 2**P-1 color bytes, changing at most one of them; '
+             f'changes far fewer bytes but holds less ({MIN_MATRIX_BITS} to {MAX_MATRIX_BITS}, default: off)',
+    )
+    encode_parser.add_argument(
+        '--key', help='secret key that spreads the message over the whole image; '
+                      'the same key is needed to decode it',
+    )
+
+    split_parser = commands.add_parser(
+        'split', help='hide one message spread over all the images (in the order given), for big messages',
+    )
+    add_hiding_arguments(split_parser)
+
+    join_parser = commands.add_parser('join', help='put a message spread over several images back together')
+    join_parser.add_argument('-o', '--output', required=True, help='where to save the message')
+    join_parser.add_argument('images', nargs='+', help='images, directories or glob patterns (any order)')
+
+    decode_parser = commands.add_parser('decode', help='print the message hidden in each image')
+    decode_parser.add_argument('--key', help='the secret key the messages were hidden with')
+    decode_parser.add_argument(
+        '--cache', metavar='FILE',
+        help='keep the messages found in this file, and take them from it when the same images are decoded again',
+    )
+    decode_parser.add_argument(
+        '--cache-size', type=int, default=DEFAULT_CACHE_BYTES // (1024 * 1024), metavar='MB',
+        help=f'the most messages to keep in the cache, in MB (default: {DEFAULT_CACHE_BYTES // (1024 * 1024)})',
+    )
+    decode_parser.add_argument(
+        '--cache-by', default='file', choices=IDENTITY_CHOICES,
+        help='recognise images by file (device, inode, size and time; no reading at all) or by content '
+             '(a hash of the headers and message; also finds copies) (default: file)',
+    )
+    decode_parser.add_argument(
+        'images', nargs='+',
+        help='images, directories or glob patterns, or - to read one image from standard input and write its '
+             'message to standard output',
+    )
+
+    capacity_parser = commands.add_parser(
+        'capacity', help='show how much each image can hold and whether it already has a message',
+    )
+    capacity_parser.add_argument('images', nargs='+', help='images, directories or glob patterns')
+
+    scan_parser = commands.add_parser(
+        'scan', help='quickly check which images hold a message (reads only the first few pixels of each)',
+    )
+    scan_parser.add_argument(
+        '-t', '--threads', type=int, default=SCAN_THREADS,
+        help=f'files to read at the same time (default: {SCAN_THREADS})',
+    )
+    scan_parser.add_argument('images', nargs='+', help='images, directories or glob patterns')
+
+    analyze_parser = commands.add_parser(
+        'analyze', help='look for signs of a hidden LSB payload in the pixels (chi-square, RS and sample pair analysis)',
+    )
+    analyze_parser.add_argument(
+        '--full', action='store_true',
+        help='always analyze the whole image, even once the result is clear',
+    )
+    analyze_parser.add_argument(
+        '--stop-after', type=int, metavar='N',
+        help='stop once N suspicious images were found (default: analyze every image)',
+    )
+    analyze_parser.add_argument('images', nargs='+', help='images, directories or glob patterns')
+
+    return parser
+
+
+def main(argv=None):
+    """Runs the command line and returns the exit code."""
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+
+    # A scan or an analysis can cover millions of files, so they are found as it goes
+    if args.command == 'scan':
+        if args.threads < 1:
+            parser.error('--threads must be at least 1')
+        return run_scan(args)
+    if args.command == 'analyze':
+        if args.stop_after is not None and args.stop_after < 1:
+            parser.error('--stop-after must be at least 1')
+        return run_analyze(args)
+
+    # An image from standard input is read and written as it streams past
+    if args.command in ('encode', 'decode') and STDIO_NAME in args.images:
+        if args.images != [STDIO_NAME]:
+            parser.error('- (standard input) must be the only image')
+        return run_stream(parser, args)
+    if args.command in ('encode', 'split') and args.output_dir is None:
+        parser.error('the following arguments are required: -o/--output-dir')
+
+    image_files = find_carrier_files(args.images)
+    if not image_files:
+        parser.error('no images found')
+
+    # Splitting and joining are one job over all the images together
+    if args.command == 'split':
+        return run_split(parser, args, image_files)
+    if args.command == 'join':
+        return run_join(args, image_files)
+
+    initializer = None
+    initargs = ()
+    cache = None
+
+    if args.command == 'encode':
+        if args.matrix and args.bits_per_channel != 1:
+            parser.error('--matrix only works with --bits-per-channel 1')
+        message = read_message_arguments(parser, args)
+
+        # Each new image keeps the name of the image it came from
+        tasks = list(zip(image_files, plan_output_paths(parser, image_files, args.output_dir)))
+
+        worker = encode_worker
+        initializer = set_worker_message
+        # With a single image the processes share the work on that image
+        # instead of each taking a whole image
+        shard_jobs = args.jobs if len(tasks) == 1 else 1
+        initargs = (message, args.bits_per_channel, args.compress, shard_jobs, args.message_file, args.matrix,
+                    args.key)
+    elif args.command == 'decode':
+        worker = partial(decode_worker, key=args.key)
+        tasks = image_files
+        if args.cache is not None:
+            if args.cache_size < 0:
+                parser.error('--cache-size cannot be negative')
+            from cache import DecodeCache
+            try:
+                cache = DecodeCache(args.cache_size * 1024 * 1024, args.cache, args.cache_by)
+            except StegoError as e:
+                parser.error(str(e))
+    else:
+        worker = capacity_worker
+        tasks = image_files
+
+    if args.stats:
+        worker = partial(worker, stats=True)
+
+    from instrument import add_to_totals, format_report, StageRecord
+
+    if cache is not None:
+        results = run_cached_decode(cache, image_files, args.key, args.stats, args.jobs)
+    else:
+        results = run_jobs(worker, tasks, args.jobs, initializer, initargs)
+
+    exit_code = EXIT_OK
+    stage_totals = {}
+    for result in results:
+        write_result(result)
+        if not result['ok']:
+            exit_code = EXIT_FAILED
+
+        # The steps come back from the workers as dictionaries, so add them
+        # up again here for the summary
+        for stage in result.get('stages', ()):
+            record = StageRecord(stage['stage'])
+            record.seconds = stage['seconds']
+            record.bytes_read = stage['bytes_read']
+            record.bytes_written = stage['bytes_written']
+            record.peak_memory = stage['peak_memory']
+            add_to_totals(stage_totals, record)
+
+    if args.stats:
+        sys.stderr.write(format_report(stage_totals) + '\n')
+
+    if cache is not None:
+        try:
+            cache.save()
+        except StegoError as e:
+            sys.stderr.write(f"cli.py: {' '.join(str(e).split())}\n")
+            exit_code = EXIT_FAILED
+
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,268 +1,1311 @@
-from encode import validate_bmp_basic, read_bmp_header, read_image_file, validate_bmp_header
+import math
+import os
+import struct
+import zlib
 
+from encode import validate_bmp_basic, read_bmp_header, validate_bmp_header, check_bits_per_pixel, count_available_bits
+from encode import MESSAGE_DELIMITER, PAYLOAD_MAGIC, PAYLOAD_FORMAT_VERSION, PAYLOAD_HEADER_FORMAT, PAYLOAD_HEADER_SIZE
+from encode import FLAG_BITS_PER_CHANNEL, FLAG_COMPRESSION, FLAG_COMPRESSION_SHIFT, KNOWN_FLAGS, MAX_BITS_PER_CHANNEL
+from encode import FLAG_FRAGMENT, FLAG_MATRIX, FLAG_MATRIX_SHIFT, MIN_MATRIX_BITS, MAX_MATRIX_BITS, COMPRESSION_METHODS
+from encode import matrix_group_size, matrix_syndromes, map_image_file, read_stream_header, ImageStream
+from errors import StegoError, ImageFileError, MessageError, NoMessageFoundError, DamagedMessageError
+from errors import IncompleteMessageError, UnsupportedFormatError
+from instrument import stage
+from scatter import apply_key
 
-def extract_bits_24bit(img_bytes, pixel_data_offset, delimiter, header_info):
-    """Extracts hidden bits from a 24-bit BMP image using smart pixel looping.
+# lzma is imported only when a message was compressed with it (see
+# decompress_message()), like in encode.py, to keep start-up quick
+
+# Lookup table for bytes.translate(): turns every byte into the character '0'
+# or '1' depending on its last bit, so a whole run of image bytes becomes a
+# binary string in one call
+LSB_TO_BIT_CHARS = bytes(ord('0') + (value & 0b00000001) for value in range(256))
+
+# Lookup tables for bytes.translate(): entry s turns every byte into '0' or '1'
+# depending on the bit s places from the end, for messages hidden with more
+# than 1 bit per color byte (or with matrix embedding, where each group value
+# holds up to MAX_MATRIX_BITS bits)
+BIT_TO_BIT_CHARS_TABLES = [bytes(ord('0') + ((value >> s) & 0b00000001) for value in range(256))
+                           for s in range(MAX_MATRIX_BITS)]
+
+# How many carrier bytes we unpack per step while searching for the delimiter.
+# Short messages are found after the first step instead of after a full scan.
+EXTRACT_CHUNK_SIZE = 64 * 1024
+
+
+# How many bytes the streaming decoder reads from the file at a time
+STREAM_READ_SIZE = 256 * 1024
+
+# How many bytes inspect_file() reads at a time. The BMP header and the first
+# few dozen pixels (which hold the payload header) almost always fit in one read.
+INSPECT_READ_SIZE = 4096
+
+# Names of the BMP info header versions, by header size
+BMP_HEADER_NAMES = {
+    40: 'BITMAPINFOHEADER',
+    52: 'BITMAPV2INFOHEADER',
+    56: 'BITMAPV3INFOHEADER',
+    108: 'BITMAPV4HEADER',
+    124: 'BITMAPV5HEADER',
+}
+
+
+class ImageFileReader:
+    """Reads parts of an image file on demand, like a read-only bytearray.
+    
+    Slicing the reader seeks to the right place in the file and reads just
+    those bytes, in blocks of STREAM_READ_SIZE. The decoder reads the BMP
+    header, jumps to the pixel data and walks forward from there, so a short
+    message in a big image only costs a block or two of reading.
+    """
+    
+    def __init__(self, image_file, block_size=STREAM_READ_SIZE):
+        self.image_file = image_file
+        self.size = os.fstat(image_file.fileno()).st_size
+        self.block_size = block_size
+        
+        # How many bytes we have read from the file so far
+        self.bytes_read = 0
+        
+        # The last block we read, and where in the file it came from
+        self.block = b''
+        self.block_start = 0
+    
+    def __len__(self):
+        return self.size
+    
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.size)
+            data = self.read_range(start, max(start, stop))
+            return data if step == 1 else data[::step]
+        
+        # A single byte
+        index = key + self.size if key < 0 else key
+        if index < 0 or index >= self.size:
+            raise IndexError("image file index out of range")
+        return self.read_range(index, index + 1)[0]
+    
+    def read_range(self, start, stop):
+        """Returns the file bytes from start up to (not including) stop."""
+        # Serve the bytes from the last block if we already have them
+        block_end = self.block_start + len(self.block)
+        if self.block_start <= start and stop <= block_end:
+            return self.block[start - self.block_start:stop - self.block_start]
+        
+        self.image_file.seek(start)
+        
+        # Big requests are read in one go and not kept around
+        if stop - start > self.block_size:
+            data = self.image_file.read(stop - start)
+            self.bytes_read += len(data)
+            return data
+        
+        # Otherwise read a whole block, since the next request usually
+        # carries on where this one stopped
+        self.block = self.image_file.read(self.block_size)
+        self.block_start = start
+        self.bytes_read += len(self.block)
+        return self.block[:stop - start]
+    
+    def close(self):
+        self.image_file.close()
+
+
+def count_file_bytes_read(img_bytes):
+    """Tells how many bytes have been read from an image file so far.
+    
+    Args:
+        img_bytes (bytearray, ImageFileReader or ImageStream): The image file bytes.
+    
+    Returns:
+        int: Bytes read by an ImageFileReader or ImageStream (0 for an image already in memory).
+    """
+    if isinstance(img_bytes, (ImageFileReader, ImageStream)):
+        return img_bytes.bytes_read
+    return 0
+
+
+def open_image_reader(image_file_path, block_size=STREAM_READ_SIZE):
+    """Opens a BMP image file for reading only the parts we need.
+    
+    Args:
+        image_file_path (str): Path to the image file.
+        block_size (int): How many bytes to read from the file at a time.
+    
+    Returns:
+        ImageFileReader: The opened image.
+    
+    Raises:
+        ImageFileError: If the file can't be opened.
+    """
+    try:
+        return ImageFileReader(open(image_file_path, 'rb'), block_size)  # 'rb' = read binary
+    except FileNotFoundError:
+        raise ImageFileError(f"Image file was not found at: {image_file_path}\n"
+                             f"Please check the file path and try again.") from None
+    except PermissionError:
+        raise ImageFileError(f"Permission denied. Cannot read the file: {image_file_path}") from None
+    except OSError as e:
+        raise ImageFileError(f"Could not read the image file. {str(e)}") from e
+
+
+def iter_carrier_chunks_24bit(img_bytes, header_info, first_carrier=0, carrier_count=None):
+    """Yields the message-carrying bytes of a 24-bit BMP image in order.
+    
+    Args:
+        img_bytes (bytearray): The image file bytes.
+        header_info (BmpLayout): The image layout from read_bmp_header().
+        first_carrier (int): Index of the first carrier byte to read (0 = first Blue byte).
+        carrier_count (int): How many carrier bytes to read, or None to read to the end.
+    
+    Yields:
+        bytes: Runs of Blue/Green/Red bytes with the row padding left out.
+    """
+    pixel_data_offset = header_info.pixel_data_offset
+    bytes_per_row = header_info.bytes_per_row
+    run_length = header_info.run_length
+    
+    # Work out where to stop (never past the last pixel)
+    end_carrier = header_info.carrier_count
+    if carrier_count is not None:
+        end_carrier = min(end_carrier, first_carrier + carrier_count)
+    
+    carrier = first_carrier
+    while carrier < end_carrier:
+        chunk_end = min(carrier + EXTRACT_CHUNK_SIZE, end_carrier)
+        
+        # Collect the pieces of each row that fall inside this step. Slicing
+        # stops at the end of the file by itself, so a truncated image simply
+        # gives fewer bytes.
+        runs = []
+        while carrier < chunk_end:
+            row = carrier // run_length
+            column = carrier % run_length
+            length = min(run_length - column, chunk_end - carrier)
+            run_start = pixel_data_offset + (row * bytes_per_row) + column
+            runs.append(img_bytes[run_start:run_start + length])
+            carrier = carrier + length
+        
+        chunk = b''.join(runs)
+        if not chunk:
+            return
+        yield chunk
+
+
+def iter_carrier_chunks_32bit(img_bytes, header_info, first_carrier=0, carrier_count=None):
+    """Yields the message-carrying bytes of a 32-bit BMP image in order.
     
     Args:
         img_bytes (bytearray): The image file bytes.
-        pixel_data_offset (int): Offset where pixel data starts.
-        delimiter (str): The delimiter pattern to look for (marks end of message).
-        header_info (dict): Header information from read_bmp_header().
+        header_info (BmpLayout): The image layout from read_bmp_header().
+        first_carrier (int): Index of the first carrier byte to read (0 = first Blue byte).
+        carrier_count (int): How many carrier bytes to read, or None to read to the end.
+    
+    Yields:
+        bytes: Runs of Blue/Green/Red bytes with the Alpha bytes left out.
+    """
+    pixel_data_offset = header_info.pixel_data_offset
+    channel_offsets = header_info.channel_offsets
+    
+    # Work out where to stop (never past the last pixel, so anything stored
+    # after the pixels, like a color profile, is left alone)
+    end_carrier = header_info.carrier_count
+    if carrier_count is not None:
+        end_carrier = min(end_carrier, first_carrier + carrier_count)
+    
+    carrier = first_carrier
+    while carrier < end_carrier:
+        chunk_end = min(carrier + EXTRACT_CHUNK_SIZE, end_carrier)
+        
+        # Read the whole pixels that hold this step's carrier bytes
+        first_pixel = carrier // 3
+        last_pixel = (chunk_end - 1) // 3 + 1
+        pixel_bytes = img_bytes[pixel_data_offset + (first_pixel * 4):pixel_data_offset + (last_pixel * 4)]
+        
+        # Take every 4th byte starting at Blue (0), Green (1) and Red (2) and
+        # weave them back together in pixel order. The Alpha byte is skipped.
+        full_pixels = len(pixel_bytes) // 4
+        woven = bytearray(full_pixels * 3)
+        for channel, channel_offset in enumerate(channel_offsets):
+            woven[channel::3] = pixel_bytes[channel_offset:full_pixels * 4:4]
+        
+        # A file that ends part way through a pixel still gives up the color
+        # bytes it has
+        last_part = pixel_bytes[full_pixels * 4:]
+        woven += bytes(last_part[offset] for offset in channel_offsets if offset < len(last_part))
+        
+        # Drop the channels before the first carrier byte we were asked for
+        skip = carrier - (first_pixel * 3)
+        chunk = bytes(woven[skip:skip + (chunk_end - carrier)])
+        if not chunk:
+            return
+        yield chunk
+        carrier = chunk_end
+
+
+def iter_carrier_chunks_scattered(img_bytes, header_info, first_carrier=0, carrier_count=None):
+    """Yields the message-carrying bytes picked by a key, in payload order.
+    
+    Args:
+        img_bytes (bytearray or mmap.mmap): The image file bytes.
+        header_info (BmpLayout): The image layout, with a key applied (see scatter.apply_key()).
+        first_carrier (int): Index of the first carrier byte to read.
+        carrier_count (int): How many carrier bytes to read, or None to read to the end.
+    
+    Yields:
+        bytes: Runs of carrier bytes, from wherever in the image the key put them.
+    """
+    carrier_order = header_info.carrier_order
+    
+    end_carrier = header_info.carrier_count
+    if carrier_count is not None:
+        end_carrier = min(end_carrier, first_carrier + carrier_count)
+    
+    carrier = first_carrier
+    while carrier < end_carrier:
+        chunk_end = min(carrier + EXTRACT_CHUNK_SIZE, end_carrier)
+        chunk = carrier_order.gather(img_bytes, carrier, chunk_end - carrier)
+        if chunk:
+            yield chunk
+        
+        # In a truncated file the message stops at the first missing segment
+        if len(chunk) < chunk_end - carrier:
+            return
+        carrier = chunk_end
+
+
+def iter_carrier_chunks(img_bytes, header_info, first_carrier=0, carrier_count=None):
+    """Yields the message-carrying bytes of a 24-bit or 32-bit BMP image in order.
+    
+    Args:
+        img_bytes (bytearray): The image file bytes.
+        header_info (BmpLayout): The image layout from read_bmp_header().
+        first_carrier (int): Index of the first carrier byte to read.
+        carrier_count (int): How many carrier bytes to read, or None to read to the end.
     
     Returns:
-        str: Extracted binary string (including delimiter if found), or None if error.
+        generator: Runs of carrier bytes from iter_carrier_chunks_24bit(),
+        iter_carrier_chunks_32bit() or (with a key) iter_carrier_chunks_scattered().
     """
-    extracted_bits = ""
-    width = header_info['width']
-    height = header_info['height']
+    if header_info.carrier_order is not None:
+        return iter_carrier_chunks_scattered(img_bytes, header_info, first_carrier, carrier_count)
+    if header_info.bits_per_pixel == 24:
+        return iter_carrier_chunks_24bit(img_bytes, header_info, first_carrier, carrier_count)
+    return iter_carrier_chunks_32bit(img_bytes, header_info, first_carrier, carrier_count)
+
+
+def pack_lsbs(carrier_bytes):
+    """Packs the last bit of every carrier byte into message bytes.
     
-    # In a 24-bit image, each pixel uses 3 bytes (one for Blue, one for Green, one for Red)
-    bytes_per_pixel = 3
+    Args:
+        carrier_bytes (bytes): Message-carrying bytes, a multiple of 8 long.
+    
+    Returns:
+        bytes: One message byte for every 8 carrier bytes.
+    """
+    if not carrier_bytes:
+        return b''
     
-    # Calculate how many bytes are in one row (without padding)
-    bytes_per_row_without_padding = width * bytes_per_pixel
+    # Turn the run into '0'/'1' characters and read them as one binary number
+    bit_chars = bytes(carrier_bytes).translate(LSB_TO_BIT_CHARS)
+    return int(bit_chars, 2).to_bytes(len(bit_chars) // 8, 'big')
+
+
+def pack_carrier_bits(carrier_bytes, bits_per_channel=1):
+    """Reads the last few bits of every carrier byte and packs them into bytes.
     
-    # BMP files require each row to be a multiple of 4 bytes
-    # Calculate how many bytes per row including padding
-    remainder = bytes_per_row_without_padding % 4
-    if remainder == 0:
-        # Already a multiple of 4, no padding needed
-        bytes_per_row = bytes_per_row_without_padding
-    else:
-        # Need to add padding to make it a multiple of 4
-        padding_needed = 4 - remainder
-        bytes_per_row = bytes_per_row_without_padding + padding_needed
+    Args:
+        carrier_bytes (bytes): Message-carrying bytes.
+        bits_per_channel (int): How many bits each carrier byte holds.
     
-    # Get the number of rows (use absolute value in case height is negative)
-    if height < 0:
-        number_of_rows = -height
-    else:
-        number_of_rows = height
+    Returns:
+        bytes: The hidden bytes (bits that don't make up a whole byte are dropped).
+    """
+    if bits_per_channel == 1:
+        usable = len(carrier_bytes) - (len(carrier_bytes) % 8)
+        return pack_lsbs(carrier_bytes[:usable])
+    
+    # Write out the bits of every carrier byte as '0'/'1' characters, highest
+    # bit first. Each bit position is one table lookup pass into a strided slice.
+    carrier_bytes = bytes(carrier_bytes)
+    bit_chars = bytearray(len(carrier_bytes) * bits_per_channel)
+    for position in range(bits_per_channel):
+        shift = bits_per_channel - 1 - position
+        bit_chars[position::bits_per_channel] = carrier_bytes.translate(BIT_TO_BIT_CHARS_TABLES[shift])
+    
+    usable = len(bit_chars) - (len(bit_chars) % 8)
+    if not usable:
+        return b''
+    return int(bit_chars[:usable], 2).to_bytes(usable // 8, 'big')
+
+
+def iter_message_bytes(carrier_chunks, bits_per_channel=1):
+    """Packs runs of carrier bytes into message bytes as they are read.
+    
+    Args:
+        carrier_chunks (iterable): Runs of message-carrying bytes, in order.
+        bits_per_channel (int): How many bits each carrier byte holds.
+    
+    Yields:
+        bytes: The hidden bytes, 8 bits per message byte.
+    """
+    # The smallest number of carrier bytes that holds a whole number of
+    # message bytes (8 for 1 or 3 bits per byte, 4 for 2 bits, 2 for 4 bits)
+    group_size = 8 // math.gcd(8, bits_per_channel)
+    
+    leftover = b''
+    for chunk in carrier_chunks:
+        # Runs don't always line up with whole message bytes, so hold back
+        # the last few carrier bytes until the next run arrives
+        if leftover:
+            chunk = leftover + chunk
+        usable = len(chunk) - (len(chunk) % group_size)
+        leftover = chunk[usable:]
+        if usable:
+            yield pack_carrier_bits(chunk[:usable], bits_per_channel)
     
-    # Extract bits using smart pixel looping (matching the encoding method)
-    # We iterate row by row, pixel by pixel, and skip padding bytes
-    for row in range(number_of_rows):
-        # Calculate where this row starts in the file
-        row_start = pixel_data_offset + (row * bytes_per_row)
+    # With 3 bits per byte the last few carrier bytes can still finish a
+    # message byte
+    if leftover and bits_per_channel > 1:
+        last_bytes = pack_carrier_bits(leftover, bits_per_channel)
+        if last_bytes:
+            yield last_bytes
+
+
+def collect_bytes_until_delimiter(message_chunks, delimiter):
+    """Collects hidden bytes until the delimiter shows up.
+    
+    Args:
+        message_chunks (iterable): Runs of hidden bytes, in order.
+        delimiter (bytes): The delimiter pattern to look for (marks end of message).
+    
+    Returns:
+        bytes: Extracted bytes (including delimiter if found).
+    """
+    overlap = len(delimiter) - 1
+    
+    collected = []
+    previous_tail = b''
+    
+    for chunk in message_chunks:
+        # Search this run together with the end of the previous one, in case
+        # the delimiter was split across the two
+        search_area = previous_tail + chunk
+        found_at = search_area.find(delimiter)
+        if found_at != -1:
+            # Keep everything up to and including the delimiter
+            end_in_chunk = found_at + len(delimiter) - len(previous_tail)
+            collected.append(chunk[:end_in_chunk])
+            return b''.join(collected)
         
-        # Go through each pixel in this row
-        for pixel in range(width):
-            # Calculate where this pixel starts in the file
-            pixel_start = row_start + (pixel * bytes_per_pixel)
-            
-            # Each pixel has 3 color channels: Blue (0), Green (1), and Red (2)
-            # We'll read one bit from each channel
-            for channel in range(3):
-                # Calculate which byte we're reading from
-                byte_index = pixel_start + channel
-                
-                # Make sure we don't go past the end of the file
-                if byte_index >= len(img_bytes):
-                    break
-                
-                # Get the last bit of this byte
-                # 0b00000001 in binary means only the last bit is 1
-                # When we use & (AND), it gives us just the last bit
-                last_bit = img_bytes[byte_index] & 0b00000001
-                
-                # Convert the bit (which is 0 or 1) to a string and add it to our extracted bits
-                extracted_bits = extracted_bits + str(last_bit)
-                
-                # Check if we've found the delimiter (the end of the message)
-                if len(extracted_bits) >= len(delimiter):
-                    # Get the last few bits (same length as delimiter)
-                    start_index = len(extracted_bits) - len(delimiter)
-                    last_bits = extracted_bits[start_index:]
-                    
-                    # Check if they match our delimiter
-                    if last_bits == delimiter:
-                        return extracted_bits  # Found the end!
-    
-    return extracted_bits
-
-
-def extract_bits_32bit(img_bytes, pixel_data_offset, delimiter):
-    """Extracts hidden bits from a 32-bit BMP image.
+        collected.append(chunk)
+        if overlap > 0:
+            previous_tail = search_area[-overlap:]
+    
+    # No delimiter anywhere - give back every byte we read
+    return b''.join(collected)
+
+
+def extract_bits_24bit(img_bytes, delimiter, header_info):
+    """Extracts hidden bytes from a 24-bit BMP image using smart pixel looping.
     
     Args:
         img_bytes (bytearray): The image file bytes.
-        pixel_data_offset (int): Offset where pixel data starts.
-        delimiter (str): The delimiter pattern to look for (marks end of message).
+        delimiter (bytes): The delimiter pattern to look for (marks end of message).
+        header_info (BmpLayout): The image layout from read_bmp_header().
     
     Returns:
-        str: Extracted binary string (including delimiter if found), or None if error.
+        bytes: Extracted bytes (including delimiter if found), or None if error.
     """
-    extracted_bits = ""
+    # Read the rows in order, pixel by pixel, skipping padding bytes (matching
+    # the encoding method) and stop as soon as the delimiter is found
+    carrier_chunks = iter_carrier_chunks_24bit(img_bytes, header_info)
+    return collect_bytes_until_delimiter(iter_message_bytes(carrier_chunks), delimiter)
+
+
+def extract_bits_32bit(img_bytes, delimiter, header_info):
+    """Extracts hidden bytes from a 32-bit BMP image.
+    
+    Args:
+        img_bytes (bytearray): The image file bytes.
+        delimiter (bytes): The delimiter pattern to look for (marks end of message).
+        header_info (BmpLayout): The image layout from read_bmp_header().
     
+    Returns:
+        bytes: Extracted bytes (including delimiter if found), or None if error.
+    """
     # For 32-bit images, each pixel has 4 bytes: Blue, Green, Red, and Alpha
-    # We'll skip the Alpha channel and only read from Blue, Green, and Red
-    # Start at the pixel data and go through each pixel (every 4 bytes)
-    pixel_start = pixel_data_offset
-    while pixel_start < len(img_bytes):
-        # For each pixel, read from the first 3 bytes (Blue, Green, Red)
-        # We skip the 4th byte (Alpha channel)
-        for channel in range(3):  # 0=Blue, 1=Green, 2=Red
-            # Calculate which byte we're reading from
-            byte_index = pixel_start + channel
-            
-            # Make sure we don't go past the end of the file
-            if byte_index >= len(img_bytes):
-                break
-            
-            # Get the last bit of this byte
-            # 0b00000001 in binary means only the last bit is 1
-            # When we use & (AND), it gives us just the last bit
-            last_bit = img_bytes[byte_index] & 0b00000001
-            
-            # Convert the bit (which is 0 or 1) to a string and add it to our extracted bits
-            extracted_bits = extracted_bits + str(last_bit)
+    # We skip the Alpha channel and only read from Blue, Green, and Red
+    carrier_chunks = iter_carrier_chunks_32bit(img_bytes, header_info)
+    return collect_bytes_until_delimiter(iter_message_bytes(carrier_chunks), delimiter)
+
+
+def read_hidden_range(img_bytes, header_info, first_carrier, byte_count, bits_per_channel=1, matrix_bits=0):
+    """Reads a range of hidden bytes without looking at any other pixels.
+    
+    Args:
+        img_bytes (bytearray): The image file bytes.
+        header_info (BmpLayout): The image layout from read_bmp_header().
+        first_carrier (int): Index of the first color byte to read from.
+        byte_count (int): How many hidden bytes to read.
+        bits_per_channel (int): How many bits each color byte holds.
+        matrix_bits (int): Bits per group if the bytes were hidden with matrix
+            embedding (0 = not used). first_carrier must start a group.
+    
+    Returns:
+        bytes: The hidden bytes (fewer than asked for if the image runs out).
+    """
+    return b''.join(iter_hidden_chunks(img_bytes, header_info, first_carrier, byte_count, bits_per_channel,
+                                       matrix_bits))
+
+
+def iter_hidden_chunks(img_bytes, header_info, first_carrier, byte_count, bits_per_channel=1, matrix_bits=0):
+    """Reads a range of hidden bytes a chunk at a time.
+    
+    Args:
+        img_bytes (bytearray or ImageFileReader): The image file bytes.
+        header_info (BmpLayout): The image layout from read_bmp_header().
+        first_carrier (int): Index of the first color byte to read from.
+        byte_count (int): How many hidden bytes to read.
+        bits_per_channel (int): How many bits each color byte holds.
+        matrix_bits (int): Bits per group with matrix embedding (0 = not used).
+    
+    Returns:
+        generator: The hidden bytes, in chunks (fewer than asked for if the image runs out).
+    """
+    if matrix_bits:
+        # Every group of color bytes holds matrix_bits bits (rounded up, so
+        # the last group may only be partly used)
+        group_count = -(-byte_count * 8 // matrix_bits)
+        carrier_count = group_count * matrix_group_size(matrix_bits)
+        carrier_chunks = iter_carrier_chunks(img_bytes, header_info, first_carrier, carrier_count)
+        return iter_message_bytes(iter_syndrome_chunks(carrier_chunks, matrix_bits), matrix_bits)
+    
+    # Every hidden byte is spread over 8 bits, bits_per_channel per color byte
+    # (rounded up, so the last color byte may only be partly used)
+    carrier_count = -(-byte_count * 8 // bits_per_channel)
+    carrier_chunks = iter_carrier_chunks(img_bytes, header_info, first_carrier, carrier_count)
+    return iter_message_bytes(carrier_chunks, bits_per_channel)
+
+
+def iter_syndrome_chunks(carrier_chunks, matrix_bits):
+    """Turns runs of color bytes hidden with matrix embedding into group values.
+    
+    Args:
+        carrier_chunks (iterable): Runs of message-carrying bytes, in order.
+        matrix_bits (int): Message bits per group.
+    
+    Yields:
+        bytes: One value per whole group of color bytes, ready for iter_message_bytes().
+    """
+    group_size = matrix_group_size(matrix_bits)
+    
+    leftover = b''
+    for chunk in carrier_chunks:
+        # Runs don't always line up with whole groups, so hold back the last
+        # few color bytes until the next run arrives
+        if leftover:
+            chunk = leftover + chunk
+        usable = len(chunk) - (len(chunk) % group_size)
+        leftover = chunk[usable:]
+        if usable:
+            yield matrix_syndromes(chunk[:usable], matrix_bits)
+
+
+def read_payload_header(img_bytes, header_info):
+    """Reads the payload header from the first hidden bytes of the image.
+    
+    Args:
+        img_bytes (bytearray): The image file bytes.
+        header_info (BmpLayout): The image layout from read_bmp_header().
+    
+    Returns:
+        dict: The header fields, or None if the image has no payload header.
+    """
+    # The header only needs the first few dozen pixels
+    header_bytes = read_hidden_range(img_bytes, header_info, 0, PAYLOAD_HEADER_SIZE)
+    if len(header_bytes) < PAYLOAD_HEADER_SIZE:
+        return None
+    
+    magic, version, flags, payload_length, checksum = struct.unpack(PAYLOAD_HEADER_FORMAT, header_bytes)
+    if magic != PAYLOAD_MAGIC:
+        return None
+    
+    return {
+        'version': version,
+        'flags': flags,
+        'payload_length': payload_length,
+        'crc32': checksum,
+    }
+
+
+def extract_payload(img_bytes, header_info, payload_header):
+    """Reads and checks the message that follows a payload header.
+    
+    Args:
+        img_bytes (bytearray): The image file bytes.
+        header_info (BmpLayout): The image layout from read_bmp_header().
+        payload_header (dict): Header fields from read_payload_header().
+    
+    Returns:
+        bytes: The hidden message bytes.
+    
+    Raises:
+        UnsupportedFormatError: If the message uses a newer format version.
+        DamagedMessageError: If the message is cut short or its checksum is wrong.
+    """
+    bits_per_channel, matrix_bits = check_payload_header(header_info, payload_header)
+    payload_length = payload_header['payload_length']
+    
+    # Read exactly the bytes of the message and nothing more. The message
+    # starts right after the header, which always uses 1 bit per color byte.
+    first_carrier = PAYLOAD_HEADER_SIZE * 8
+    message_bytes = read_hidden_range(img_bytes, header_info, first_carrier, payload_length, bits_per_channel,
+                                      matrix_bits)
+    if len(message_bytes) != payload_length:
+        raise DamagedMessageError("The image ends before the hidden message does. It may be truncated.")
+    
+    # Check that the message wasn't damaged along the way
+    if zlib.crc32(message_bytes) != payload_header['crc32']:
+        raise DamagedMessageError("The hidden message is damaged (checksum does not match).")
+    
+    # Undo the compression, if the message was compressed
+    compression_code = (payload_header['flags'] & FLAG_COMPRESSION) >> FLAG_COMPRESSION_SHIFT
+    return decompress_message(message_bytes, compression_code)
+
+
+def check_payload_header(header_info, payload_header):
+    """Makes sure a payload header is one we can read and that fits the image.
+    
+    Args:
+        header_info (BmpLayout): The image layout from read_bmp_header().
+        payload_header (dict): Header fields from read_payload_header().
+    
+    Returns:
+        tuple: (bits the message keeps in each color byte, bits per group with
+        matrix embedding or 0).
+    
+    Raises:
+        UnsupportedFormatError: If the message uses a newer format version.
+        DamagedMessageError: If the header says the message is longer than the image.
+    """
+    # Make sure we know how to read this version of the format
+    if payload_header['version'] > PAYLOAD_FORMAT_VERSION:
+        raise UnsupportedFormatError(f"This message was hidden with a newer format (version {payload_header['version']}).\n"
+                                     f"Please update the program to decode it.")
+    
+    if payload_header['flags'] & ~KNOWN_FLAGS:
+        raise UnsupportedFormatError("This message was hidden with options this program doesn't know.\n"
+                                     "Please update the program to decode it.")
+    
+    # The header says how many bits the message keeps in each color byte
+    bits_per_channel = (payload_header['flags'] & FLAG_BITS_PER_CHANNEL) + 1
+    matrix_bits = (payload_header['flags'] & FLAG_MATRIX) >> FLAG_MATRIX_SHIFT
+    
+    # Matrix embedding only ever uses the last bit of each color byte
+    if matrix_bits and (matrix_bits < MIN_MATRIX_BITS or bits_per_channel != 1):
+        raise UnsupportedFormatError("This message was hidden with matrix options this program doesn't know.\n"
+                                     "Please update the program to decode it.")
+    
+    # Make sure the message could really fit in this image - if not, the
+    # header is damaged and reading on would just give us garbage
+    available_bits = count_available_bits(header_info, bits_per_channel, matrix_bits)
+    payload_length = payload_header['payload_length']
+    if (PAYLOAD_HEADER_SIZE + payload_length) * 8 > available_bits:
+        raise DamagedMessageError("The hidden message header is damaged (message is longer than the image).")
+    
+    return bits_per_channel, matrix_bits
+
+
+def iter_payload_chunks(img_bytes, header_info, payload_header):
+    """Reads the message that follows a payload header a chunk at a time.
+    
+    Works like extract_payload(), but never holds more than a chunk of the
+    message in memory. The checksum can only be checked at the very end, so
+    the chunks must not be trusted until this has finished without an error.
+    
+    Args:
+        img_bytes (bytearray or ImageFileReader): The image file bytes.
+        header_info (BmpLayout): The image layout from read_bmp_header().
+        payload_header (dict): Header fields from read_payload_header().
+    
+    Yields:
+        bytes: The next chunk of the original (decompressed) message.
+    
+    Raises:
+        UnsupportedFormatError: If the message uses a newer format version.
+        DamagedMessageError: If the message is cut short or its checksum is wrong.
+    """
+    # The checksum covers the bytes as they were stored, so it is checked
+    # before the compression is undone
+    stored_chunks = iter_stored_chunks(img_bytes, header_info, payload_header)
+    compression_code = (payload_header['flags'] & FLAG_COMPRESSION) >> FLAG_COMPRESSION_SHIFT
+    yield from iter_decompressed(stored_chunks, compression_code)
+
+
+def iter_stored_chunks(img_bytes, header_info, payload_header):
+    """Reads the message bytes that follow a payload header as they were stored.
+    
+    Nothing is decompressed. The length and checksum are checked once the
+    last chunk has been read.
+    
+    Args:
+        img_bytes (bytearray or ImageFileReader): The image file bytes.
+        header_info (BmpLayout): The image layout from read_bmp_header().
+        payload_header (dict): Header fields from read_payload_header().
+    
+    Yields:
+        bytes: The next chunk of the stored message.
+    
+    Raises:
+        UnsupportedFormatError: If the message uses a newer format version.
+        DamagedMessageError: If the message is cut short or its checksum is wrong.
+    """
+    bits_per_channel, matrix_bits = check_payload_header(header_info, payload_header)
+    
+    # The message starts right after the header
+    message_chunks = iter_hidden_chunks(img_bytes, header_info, PAYLOAD_HEADER_SIZE * 8,
+                                        payload_header['payload_length'], bits_per_channel, matrix_bits)
+    yield from iter_checked_chunks(message_chunks, payload_header)
+
+
+def iter_checked_chunks(stored_chunks, payload_header):
+    """Passes message chunks on, checking their length and checksum at the end.
+    
+    Args:
+        stored_chunks (iterable): The message bytes as they were stored, in order.
+        payload_header (dict): Header fields from read_payload_header().
+    
+    Yields:
+        bytes: The same chunks.
+    
+    Raises:
+        DamagedMessageError: If the message is cut short or its checksum is wrong.
+    """
+    message_length = 0
+    checksum = 0
+    for chunk in stored_chunks:
+        message_length = message_length + len(chunk)
+        checksum = zlib.crc32(chunk, checksum)
+        yield chunk
+    
+    if message_length != payload_header['payload_length']:
+        raise DamagedMessageError("The image ends before the hidden message does. It may be truncated.")
+    if checksum != payload_header['crc32']:
+        raise DamagedMessageError("The hidden message is damaged (checksum does not match).")
+
+
+def iter_decompressed(stored_chunks, compression_code):
+    """Undoes the compression of a message a chunk at a time.
+    
+    Args:
+        stored_chunks (iterable): The message bytes as they were stored, in order.
+        compression_code (int): The compression number from the header flags.
+    
+    Yields:
+        bytes: The next chunk of the original message (at most
+        EXTRACT_CHUNK_SIZE bytes, however well the message was compressed).
+    
+    Raises:
+        UnsupportedFormatError: If the compression method is unknown.
+        DamagedMessageError: If the compressed data can't be unpacked.
+    """
+    if compression_code == COMPRESSION_METHODS['none']:
+        yield from stored_chunks
+        return
+    
+    import lzma
+    if compression_code == COMPRESSION_METHODS['zlib']:
+        decompressor = zlib.decompressobj()
+    elif compression_code == COMPRESSION_METHODS['lzma']:
+        decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_ALONE)
+    else:
+        raise UnsupportedFormatError("This message was compressed in a way this program doesn't know.\n"
+                                     "Please update the program to decode it.")
+    
+    try:
+        for chunk in stored_chunks:
+            if decompressor.eof:
+                # Anything after the end of the compressed data is ignored,
+                # but it still has to be read for the checksum
+                continue
             
-            # Check if we've found the delimiter (the end of the message)
-            if len(extracted_bits) >= len(delimiter):
-                # Get the last few bits (same length as delimiter)
-                start_index = len(extracted_bits) - len(delimiter)
-                last_bits = extracted_bits[start_index:]
-                
-                # Check if they match our delimiter
-                if last_bits == delimiter:
-                    return extracted_bits  # Found the end!
+            # Ask for a limited amount of output at a time, so a tiny chunk
+            # that unpacks to a huge one can't fill up the memory
+            if compression_code == COMPRESSION_METHODS['zlib']:
+                while chunk:
+                    data = decompressor.decompress(chunk, EXTRACT_CHUNK_SIZE)
+                    chunk = decompressor.unconsumed_tail
+                    if data:
+                        yield data
+            else:
+                data = decompressor.decompress(chunk, EXTRACT_CHUNK_SIZE)
+                if data:
+                    yield data
+                while not decompressor.needs_input and not decompressor.eof:
+                    data = decompressor.decompress(b'', EXTRACT_CHUNK_SIZE)
+                    if data:
+                        yield data
         
-        # Move to the next pixel (each pixel is 4 bytes)
-        pixel_start = pixel_start + 4
+        if compression_code == COMPRESSION_METHODS['zlib']:
+            data = decompressor.flush()
+            if data:
+                yield data
+    except (zlib.error, lzma.LZMAError):
+        raise DamagedMessageError("The hidden message is damaged (it could not be decompressed).") from None
     
-    return extracted_bits
+    if not decompressor.eof:
+        raise DamagedMessageError("The hidden message is damaged (it could not be decompressed).")
 
 
-def validate_extracted_bits(extracted_bits, delimiter):
-    """Validates that extracted bits contain a valid message with delimiter.
+def decompress_message(message_bytes, compression_code):
+    """Undoes the compression used when the message was hidden.
     
     Args:
-        extracted_bits (str): The extracted binary string.
-        delimiter (str): The delimiter pattern to look for.
+        message_bytes (bytes): The message bytes as they were stored.
+        compression_code (int): The compression number from the header flags.
     
     Returns:
-        bool: True if valid message found, False otherwise.
+        bytes: The original message bytes.
+    
+    Raises:
+        UnsupportedFormatError: If the compression method is unknown.
+        DamagedMessageError: If the compressed data can't be unpacked.
     """
-    # Check if we found enough bits to have a delimiter
-    delimiter_length = len(delimiter)
-    if len(extracted_bits) < delimiter_length:
-        print("Error: No valid hidden message found in this image.")
-        return False
+    if compression_code == COMPRESSION_METHODS['none']:
+        return message_bytes
+    
+    import lzma
+    try:
+        if compression_code == COMPRESSION_METHODS['zlib']:
+            return zlib.decompress(message_bytes)
+        if compression_code == COMPRESSION_METHODS['lzma']:
+            return lzma.decompress(message_bytes, format=lzma.FORMAT_ALONE)
+    except (zlib.error, lzma.LZMAError):
+        raise DamagedMessageError("The hidden message is damaged (it could not be decompressed).") from None
+    
+    raise UnsupportedFormatError("This message was compressed in a way this program doesn't know.\n"
+                                 "Please update the program to decode it.")
+
+
+def validate_extracted_bits(extracted_bits, delimiter):
+    """Validates that extracted bytes contain a valid message with delimiter.
+    
+    Args:
+        extracted_bits (bytes): The extracted bytes.
+        delimiter (bytes): The delimiter pattern to look for.
     
-    # Get the last few bits (same length as delimiter)
-    start_index = len(extracted_bits) - delimiter_length
-    last_bits = extracted_bits[start_index:]
+    Returns:
+        bool: True if a valid message was found.
     
-    # Check if the last bits match our delimiter
-    if last_bits != delimiter:
-        print("Error: No valid hidden message found in this image.")
-        return False
+    Raises:
+        NoMessageFoundError: If there is no message.
+    """
+    # Check that the extracted bytes end with our delimiter (if the delimiter
+    # was never found we read to the end of the image instead)
+    if not extracted_bits.endswith(delimiter):
+        raise NoMessageFoundError("No valid hidden message found in this image.")
     
     return True
 
 
 def convert_binary_to_text(message_bits):
-    """Converts a binary string back to text.
+    """Converts the hidden bytes back to text.
     
     Args:
-        message_bits (str): Binary string representing the message (without delimiter).
+        message_bits (bytes): The hidden message bytes (without delimiter).
     
     Returns:
         str: The decoded text message.
     """
-    message = ""
-    
-    # Each 8 bits represents one character
-    # Go through the message 8 bits at a time
-    i = 0
-    while i < len(message_bits):
-        # Get the next 8 bits
-        # For example, if i=0, we get bits 0-7
-        # If i=8, we get bits 8-15, etc.
-        end_index = i + 8
-        byte_bits = message_bits[i:end_index]
+    # Messages are stored as UTF-8, which covers every character
+    try:
+        return message_bits.decode('utf-8')
+    except UnicodeDecodeError:
+        # Older versions of the encoder stored one byte per character, which
+        # is exactly what Latin-1 is
+        return message_bits.decode('latin-1')
+
+
+def extract_message_bytes(img_bytes, image_file_path, key=None):
+    """Finds the hidden message in an opened BMP image.
+    
+    Args:
+        img_bytes (bytearray or ImageFileReader): The image file bytes. With a
+            key it must be a bytearray or mmap.mmap (see open_decode_source()).
+        image_file_path (str): Path to the image (used in error messages).
+        key (str or bytes): The secret key the message was hidden with, or None.
+    
+    Returns:
+        bytes: The hidden message bytes.
+    
+    Raises:
+        StegoError: If the image can't be read or has no valid message.
+    """
+    with stage('read header') as record:
+        # Validate the BMP structure and read the header
+        validate_bmp_basic(img_bytes, image_file_path)
+        header_info = read_bmp_header(img_bytes)
+        validate_bmp_header(header_info, img_bytes)
+        
+        # Make sure we support this bit depth
+        check_bits_per_pixel(header_info)
+        apply_key(header_info, key)
+        
+        # Look for the payload header at the start of the pixels
+        payload_header = read_payload_header(img_bytes, header_info)
+        if payload_header is not None:
+            reject_fragment(payload_header)
+        record.bytes_read = count_file_bytes_read(img_bytes)
+        
+        # Messages from older versions were never hidden with a key, so
+        # without a header there is nothing more to look for
+        if payload_header is None and key is not None:
+            raise NoMessageFoundError("No hidden message was found with this key.\n"
+                                      "Please check the key and try again.")
+    
+    with stage('extract message') as record:
+        bytes_read_before = count_file_bytes_read(img_bytes)
         
-        # Make sure we have exactly 8 bits
-        if len(byte_bits) == 8:
-            try:
-                # Convert binary string to a number
-                # The '2' means we're converting from base 2 (binary)
-                # For example, '01000001' becomes 65
-                char_code = int(byte_bits, 2)
-                
-                # Make sure it's a valid character code
-                # Unicode characters can have codes from 0 to 1114111
-                if char_code >= 0 and char_code <= 1114111:
-                    # Convert the number to a character
-                    # For example, 65 becomes 'A'
-                    char = chr(char_code)
-                    message = message + char
-                else:
-                    break  # Invalid character code, stop
-            except (ValueError, OverflowError):
-                break  # Error converting, stop
+        if payload_header is not None:
+            # Read exactly as many bytes as the header says
+            message_bytes = extract_payload(img_bytes, header_info, payload_header)
         else:
-            break  # Not enough bits for a complete character, stop
+            # No header, so this may be an image from an older version
+            message_bytes = extract_delimited_message(img_bytes, header_info)
         
-        # Move to the next 8 bits
-        i = i + 8
+        record.bytes_read = count_file_bytes_read(img_bytes) - bytes_read_before
+        record.bytes_written = len(message_bytes)
     
-    return message
+    return message_bytes
 
 
-def Decode():
-    """This function extracts a hidden message from a BMP image file."""
+def extract_delimited_message(img_bytes, header_info):
+    """Finds a message hidden by an older version, which has no payload header.
     
-    # Step 1: Get the image file from the user
-    image_file_path = input("Please enter the path to the BMP image file with hidden message: ")
+    Args:
+        img_bytes (bytearray or ImageFileReader): The image file bytes.
+        header_info (BmpLayout): The image layout from read_bmp_header().
     
-    # Step 2: Read the image file
-    img_bytes = read_image_file(image_file_path)
-    if img_bytes is None:
-        return
+    Returns:
+        bytes: The hidden message bytes.
     
-    # Step 3: Validate basic BMP structure
-    if not validate_bmp_basic(img_bytes, image_file_path):
-        return
+    Raises:
+        StegoError: If no message ending in the delimiter is found.
+    """
+    # Read until we find the delimiter pattern that marks the end
+    delimiter = MESSAGE_DELIMITER
     
-    # Step 4: Read BMP header information
-    header_info = read_bmp_header(img_bytes)
-    if header_info is None:
-        return
+    if header_info.bits_per_pixel == 24:
+        extracted_bits = extract_bits_24bit(img_bytes, delimiter, header_info)
+    else:
+        extracted_bits = extract_bits_32bit(img_bytes, delimiter, header_info)
     
-    # Step 5: Validate header information
-    if not validate_bmp_header(header_info, img_bytes):
-        return
+    validate_extracted_bits(extracted_bits, delimiter)
     
-    # Step 6: Extract the hidden bits
-    # We'll look for our delimiter pattern to know when to stop
-    delimiter = '0000000000000001'
-    pixel_data_offset = header_info['pixel_data_offset']
-    bits_per_pixel = header_info['bits_per_pixel']
-    
-    if bits_per_pixel == 24:
-        extracted_bits = extract_bits_24bit(img_bytes, pixel_data_offset, delimiter, header_info)
-    elif bits_per_pixel == 32:
-        extracted_bits = extract_bits_32bit(img_bytes, pixel_data_offset, delimiter)
-    elif bits_per_pixel == 8:
-        print("Error: Decoding from 8-bit BMP images is not supported.")
-        print("Please convert your image to a 24-bit or 32-bit BMP format.")
-        return
+    # Remove the delimiter to get just the message bytes
+    return extracted_bits[:-len(delimiter)]
+
+
+def describe_payload_header(payload_header):
+    """Turns the raw payload header fields into something easy to read.
+    
+    Args:
+        payload_header (dict): Header fields from read_payload_header().
+    
+    Returns:
+        dict: The format version, bits per color byte, compression, length,
+        whether it is part of a split message and the matrix embedding bits.
+    """
+    flags = payload_header['flags']
+    compression_code = (flags & FLAG_COMPRESSION) >> FLAG_COMPRESSION_SHIFT
+    compression = 'unknown'
+    for name, code in COMPRESSION_METHODS.items():
+        if code == compression_code:
+            compression = name
+    
+    return {
+        'version': payload_header['version'],
+        'bits_per_channel': (flags & FLAG_BITS_PER_CHANNEL) + 1,
+        'compression': compression,
+        'length': payload_header['payload_length'],
+        'fragment': bool(flags & FLAG_FRAGMENT),
+        'matrix_bits': (flags & FLAG_MATRIX) >> FLAG_MATRIX_SHIFT,
+    }
+
+
+def reject_fragment(payload_header):
+    """Stops a single part of a split message from being decoded on its own.
+    
+    Args:
+        payload_header (dict): Header fields from read_payload_header().
+    
+    Raises:
+        IncompleteMessageError: If the image holds only one part of a message.
+    """
+    if payload_header['flags'] & FLAG_FRAGMENT:
+        raise IncompleteMessageError("This image holds only one part of a message that was split over several images.\n"
+                                     "Please decode all of the images together.")
+
+
+def inspect_image(img_bytes, image_file_path):
+    """Describes an opened BMP image without reading its pixels.
+    
+    Only the BMP header and the payload header (the first few dozen pixels)
+    are looked at, so this is quick even for huge images.
+    
+    Args:
+        img_bytes (bytearray or ImageFileReader): The image file bytes.
+        image_file_path (str): Path to the image (used in error messages).
+    
+    Returns:
+        dict: The image size and layout, how much it can hold with 1 to 4 bits
+        per color byte and with matrix embedding, and the payload header if it
+        already has a message.
+    
+    Raises:
+        StegoError: If the image can't be used.
+    """
+    with stage('read header') as record:
+        # Validate the BMP structure and read the header
+        validate_bmp_basic(img_bytes, image_file_path)
+        header_info = read_bmp_header(img_bytes)
+        validate_bmp_header(header_info, img_bytes)
+        check_bits_per_pixel(header_info)
+        
+        # Only images hidden with a payload header can be recognised this quickly.
+        # Images from older versions (with a delimiter) show up as having none.
+        payload_header = read_payload_header(img_bytes, header_info)
+        record.bytes_read = count_file_bytes_read(img_bytes)
+    
+    # How much fits with every number of bits per color byte
+    modes = []
+    for bits_per_channel in range(1, MAX_BITS_PER_CHANNEL + 1):
+        available_bits = count_available_bits(header_info, bits_per_channel)
+        modes.append({
+            'bits_per_channel': bits_per_channel,
+            'available_bits': available_bits,
+            'max_message_bytes': max(0, available_bits // 8 - PAYLOAD_HEADER_SIZE),
+        })
+    
+    # How much fits with matrix embedding, and how many color bytes it
+    # changes on average for every message bit (plain LSB changes 0.5)
+    matrix_modes = []
+    for matrix_bits in range(MIN_MATRIX_BITS, MAX_MATRIX_BITS + 1):
+        available_bits = count_available_bits(header_info, 1, matrix_bits)
+        matrix_modes.append({
+            'matrix_bits': matrix_bits,
+            'available_bits': available_bits,
+            'max_message_bytes': max(0, available_bits // 8 - PAYLOAD_HEADER_SIZE),
+            'changes_per_bit': (1 - 2 ** -matrix_bits) / matrix_bits,
+        })
+    
+    return {
+        'width': header_info.width,
+        'height': header_info.height,
+        'bits_per_pixel': header_info.bits_per_pixel,
+        'header': BMP_HEADER_NAMES.get(header_info.header_size, f'{header_info.header_size}-byte header'),
+        'top_down': header_info.top_down,
+        'available_bits': modes[0]['available_bits'],
+        'max_message_bytes': modes[0]['max_message_bytes'],
+        'modes': modes,
+        'matrix_modes': matrix_modes,
+        'has_payload': payload_header is not None,
+        'payload': describe_payload_header(payload_header) if payload_header is not None else None,
+    }
+
+
+def inspect_file(image_file_path):
+    """Describes a BMP image file by reading only its headers.
+    
+    Args:
+        image_file_path (str): Path to the image file.
+    
+    Returns:
+        dict: See inspect_image().
+    
+    Raises:
+        StegoError: If the image can't be read or used.
+    """
+    # Small reads, since we only need the start of the file
+    img_bytes = open_image_reader(image_file_path, INSPECT_READ_SIZE)
+    try:
+        return inspect_image(img_bytes, image_file_path)
+    finally:
+        img_bytes.close()
+
+
+def decode_image_bytes(img_bytes, image_file_path):
+    """Finds and decodes the hidden text message in an opened BMP image.
+    
+    Args:
+        img_bytes (bytearray or ImageFileReader): The image file bytes.
+        image_file_path (str): Path to the image (used in error messages).
+    
+    Returns:
+        str: The decoded text message.
+    
+    Raises:
+        StegoError: If the image can't be read or has no valid message.
+    """
+    return convert_message_bytes(extract_message_bytes(img_bytes, image_file_path))
+
+
+def convert_message_bytes(message_bytes):
+    """Turns the hidden message bytes back into text (timed as the 'convert text' step).
+    
+    Args:
+        message_bytes (bytes): The hidden message bytes.
+    
+    Returns:
+        str: The decoded text message.
+    """
+    with stage('convert text') as record:
+        record.bytes_read = len(message_bytes)
+        secret_message = convert_binary_to_text(message_bytes)
+        record.bytes_written = len(secret_message)
+    return secret_message
+
+
+def open_decode_source(image_file_path, key=None):
+    """Opens a BMP image file for finding a hidden message in it.
+    
+    Without a key the message sits at the start of the pixels, so an
+    ImageFileReader reads the file in order and stops where the message
+    does. With a key the message is spread over the whole image, so the file
+    is mapped into memory instead and the operating system loads just the
+    pages the color bytes are on.
+    
+    Args:
+        image_file_path (str): Path to the image file.
+        key (str or bytes): The secret key the message was hidden with, or None.
+    
+    Returns:
+        ImageFileReader or mmap.mmap: The opened image (both have close()).
+    
+    Raises:
+        ImageFileError: If the file can't be opened.
+    """
+    if key is not None:
+        return map_image_file(image_file_path)
+    return open_image_reader(image_file_path)
+
+
+def extract_file(image_file_path, key=None, cache=None):
+    """Finds the hidden message bytes in a BMP image file.
+    
+    Args:
+        image_file_path (str): Path to the image file.
+        key (str or bytes): The secret key the message was hidden with, or None.
+        cache (DecodeCache): Messages already found (see cache.py), or None.
+            The message is taken from it when it is there and added to it
+            when it isn't.
+    
+    Returns:
+        bytes: The hidden message bytes.
+    
+    Raises:
+        StegoError: If the image can't be read or has no valid message.
+    """
+    cache_key = None
+    if cache is not None:
+        with stage('check cache') as record:
+            cache_key = cache.lookup_key(image_file_path, key)
+            message_bytes = cache.get(cache_key)
+        if message_bytes is not None:
+            record.bytes_written = len(message_bytes)
+            return message_bytes
+    
+    # Open the image file. Nothing is read yet - the decoder reads the header,
+    # then seeks to the pixels and reads only as far as the message goes.
+    img_bytes = open_decode_source(image_file_path, key)
+    try:
+        message_bytes = extract_message_bytes(img_bytes, image_file_path, key)
+    finally:
+        img_bytes.close()
+    
+    if cache is not None:
+        cache.put(cache_key, message_bytes)
+    return message_bytes
+
+
+def save_message_file(image_file_path, output_path, key=None):
+    """Finds the hidden message in a BMP image file and saves it to another file.
+    
+    The message can be any kind of file. It is written a chunk at a time, so
+    memory use stays the same however big it is. If anything goes wrong the
+    output file is removed again, so a damaged message is never left behind.
+    
+    Args:
+        image_file_path (str): Path to the image file.
+        output_path (str): Where to save the message.
+        key (str or bytes): The secret key the message was hidden with, or None.
+    
+    Returns:
+        int: How many bytes were saved.
+    
+    Raises:
+        StegoError: If the image can't be read or has no valid message.
+        MessageError: If the output file can't be written.
+    """
+    img_bytes = open_decode_source(image_file_path, key)
+    try:
+        with stage('read header') as record:
+            validate_bmp_basic(img_bytes, image_file_path)
+            header_info = read_bmp_header(img_bytes)
+            validate_bmp_header(header_info, img_bytes)
+            check_bits_per_pixel(header_info)
+            apply_key(header_info, key)
+            payload_header = read_payload_header(img_bytes, header_info)
+            record.bytes_read = count_file_bytes_read(img_bytes)
+        
+        if payload_header is not None:
+            reject_fragment(payload_header)
+            message_chunks = iter_payload_chunks(img_bytes, header_info, payload_header)
+        else:
+            # Images from older versions end in a delimiter instead, so the
+            # message has to be found first before it can be saved
+            message_chunks = [extract_message_bytes(img_bytes, image_file_path, key)]
+        
+        with stage('save message') as record:
+            bytes_read_before = count_file_bytes_read(img_bytes)
+            record.bytes_written = write_message_chunks(message_chunks, output_path)
+            record.bytes_read = count_file_bytes_read(img_bytes) - bytes_read_before
+    finally:
+        img_bytes.close()
+    
+    return record.bytes_written
+
+
+def write_message_chunks(message_chunks, output_path):
+    """Writes message chunks to a file, removing the file again if anything fails.
+    
+    Args:
+        message_chunks (iterable): The message, a chunk at a time.
+        output_path (str): Where to save the message.
+    
+    Returns:
+        int: How many bytes were written.
+    
+    Raises:
+        MessageError: If the file can't be written.
+    """
+    try:
+        output_file = open(output_path, 'wb')
+    except OSError as e:
+        raise MessageError(f"Could not save the message to '{output_path}'. {str(e)}") from e
+    
+    bytes_written = 0
+    try:
+        with output_file:
+            for chunk in message_chunks:
+                output_file.write(chunk)
+                bytes_written = bytes_written + len(chunk)
+    except BaseException as e:
+        # Don't leave a half-written (or damaged) message behind
+        os.remove(output_path)
+        if isinstance(e, OSError):
+            raise MessageError(f"Could not save the message to '{output_path}'. {str(e)}") from e
+        raise
+    
+    return bytes_written
+
+
+def save_message_stream(source, target, key=None):
+    """Finds the hidden message in a BMP image read from a stream and writes it to another stream.
+    
+    The image is read once from start to end and only as far as the message
+    goes (see ImageStream), and the message is written a chunk at a time, so
+    it works in a pipeline:
+    
+        cat secret.bmp | python cli.py decode - > message.txt
+    
+    A stream can't be taken back like a file can, so if the message turns
+    out to be damaged, the chunks before the damage was found have already
+    been written. The error still says so.
+    
+    Args:
+        source (file object): The binary stream the image comes from (like sys.stdin.buffer).
+        target (file object): The binary stream the message goes to (like sys.stdout.buffer).
+        key (str or bytes): The secret key the message was hidden with, or None.
+            The image is held in memory then, since the message can be anywhere in it.
+    
+    Returns:
+        int: How many bytes were written.
+    
+    Raises:
+        StegoError: If the image can't be read or has no valid message.
+        MessageError: If the message can't be written.
+    """
+    with stage('read header') as record:
+        header_bytes, header_info = read_stream_header(source, key)
+        img_bytes = ImageStream(source, None, header_info, header_bytes)
+        payload_header = read_payload_header(img_bytes, header_info)
+        record.bytes_read = count_file_bytes_read(img_bytes)
+    
+    if payload_header is not None:
+        reject_fragment(payload_header)
+        message_chunks = iter_payload_chunks(img_bytes, header_info, payload_header)
+    elif key is not None:
+        raise NoMessageFoundError("No hidden message was found with this key.\n"
+                                  "Please check the key and try again.")
     else:
-        print(f"Error: Unsupported BMP format. This image has {bits_per_pixel} bits per pixel.")
-        print("Only 24-bit and 32-bit BMP images are supported.")
-        return
+        # Images from older versions end in a delimiter instead
+        message_chunks = [extract_delimited_message(img_bytes, header_info)]
     
-    # Step 7: Validate extracted bits
-    if not validate_extracted_bits(extracted_bits, delimiter):
-        return
+    with stage('save message') as record:
+        bytes_read_before = count_file_bytes_read(img_bytes)
+        bytes_written = 0
+        try:
+            for chunk in message_chunks:
+                target.write(chunk)
+                bytes_written = bytes_written + len(chunk)
+            target.flush()
+        except OSError as e:
+            raise MessageError(f"Could not write the message. {str(e)}") from e
+        record.bytes_written = bytes_written
+        record.bytes_read = count_file_bytes_read(img_bytes) - bytes_read_before
+    
+    return bytes_written
+
+
+def decode_file(image_file_path, key=None, cache=None):
+    """Finds and decodes the hidden text message in a BMP image file.
+    
+    Args:
+        image_file_path (str): Path to the image file.
+        key (str or bytes): The secret key the message was hidden with, or None.
+        cache (DecodeCache): Messages already found (see extract_file()), or None.
     
-    # Step 8: Remove the delimiter to get just the message bits
-    message_bits = extracted_bits[:-len(delimiter)]
+    Returns:
+        str: The decoded text message.
     
-    # Step 9: Convert binary back to text
-    message = convert_binary_to_text(message_bits)
+    Raises:
+        StegoError: If the image can't be read or has no valid message.
+    """
+    return convert_message_bytes(extract_file(image_file_path, key, cache))
+
+
+def Decode():
+    """This function extracts a hidden message from a BMP image file."""
+    
+    # Step 1: Get the image file from the user
+    image_file_path = input("Please enter the path to the BMP image file with hidden message: ")
+    
+    # Hidden files (pictures, archives, ...) are better saved than shown
+    output_path = input("Enter a file to save the message to, or press Enter to show it: ").strip()
+    
+    # Step 2: Find the hidden message
+    try:
+        if output_path:
+            saved_bytes = save_message_file(image_file_path, output_path)
+            print(f"Saved the secret message ({saved_bytes} bytes) to {output_path}.")
+            return
+        message = decode_file(image_file_path)
+    except StegoError as e:
+        print(f"Error: {e}")
+        return
     
-    # Step 10: Display the decoded message
-    print(f"Decoded secret message: {message}")
\ No newline at end of file
+    # Step 3: Display the decoded message
+    print(f"Decoded secret message: {message}")
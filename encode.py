@@ -1,538 +1,2512 @@
+import errno
+import mmap
+import os
+import struct
+import sys
+import zlib
+from functools import partial
+
+# lzma, tempfile, shutil and the process pool are only needed for some
+# messages and images, so they are imported where they are used. That keeps
+# every program that imports this module quick to start.
+
+from errors import StegoError, ImageFileError, InvalidImageError, UnsupportedImageError
+from errors import MessageError, MessageTooLongError
+from instrument import stage
+from options import COMPRESSION_CHOICES, MAX_BITS_PER_CHANNEL, MIN_MATRIX_BITS, MAX_MATRIX_BITS
+from scatter import apply_key
+
+
+def read_message_file(text_file_path):
+    """Reads a secret message from a UTF-8 text file.
+    
+    Args:
+        text_file_path (str): Path to the text file.
+    
+    Returns:
+        bytes: The file contents, exactly as they are stored (UTF-8).
+    
+    Raises:
+        MessageError: If the file can't be read or isn't UTF-8 text.
+    """
+    try:
+        # Read the raw bytes - a UTF-8 text file is already in the form we hide,
+        # so there is no need to turn it into a string and back again
+        with open(text_file_path, 'rb') as text_file:
+            secret_text = text_file.read()  # Read everything in the file
+        
+        # Make sure the file really is UTF-8 text
+        secret_text.decode('utf-8')
+    except FileNotFoundError:
+        # The file doesn't exist at that path
+        raise MessageError(f"Text file was not found at: {text_file_path}\n"
+                           f"Please check the file path and try again.") from None
+    except (OSError, UnicodeDecodeError) as e:
+        # Some other error happened (permissions, encoding, etc.)
+        raise MessageError(f"Could not read the text file '{text_file_path}'. {str(e)}") from e
+    
+    return secret_text
+
+
 def get_secret_message():
     """Gets the secret message from the user either by direct input or from a file.
     
+    Files are not read here - they are hidden straight from the file later
+    on, a block at a time, so even a very big file never has to fit in memory.
+    
     Returns:
-        str: The secret message text, or None if there was an error or empty message.
+        tuple: (message bytes, None) for a typed message, (None, file path)
+        for a file, or None if there was an error or empty message.
     """
     print("\nHow would you like to provide the secret message?")
     print("1. Type the message directly")
-    print("2. Provide a path to a text file")
+    print("2. Provide a path to a file (text or any other kind of file)")
     
     message_choice = input("Enter your choice (1 or 2): ").strip()
-    secret_text = ""
     
-    if message_choice == '1':
-        # User wants to type the message themselves
-        secret_text = input("Please enter the secret message: ")
-        
-    elif message_choice == '2':
-        # User wants to read the message from a text file
-        text_file_path = input("Please enter the path to the text file: ").strip()
-        
-        # Try to open and read the file
-        try:
-            text_file = open(text_file_path, 'r', encoding='utf-8')
-            secret_text = text_file.read()  # Read everything in the file
-            text_file.close()  # Always close files when done
-        except FileNotFoundError:
-            # The file doesn't exist at that path
-            print(f"Error: Text file was not found at: {text_file_path}")
-            print("Please check the file path and try again.")
-            return None
-        except Exception as e:
-            # Some other error happened (permissions, encoding, etc.)
-            print(f"Error: Could not read the text file '{text_file_path}'. {str(e)}")
+    try:
+        if message_choice == '1':
+            # User wants to type the message themselves
+            # Store it as UTF-8 so any character can be hidden
+            secret_text = encode_message_text(input("Please enter the secret message: "))
+            
+            # Make sure we actually have a message to hide
+            if not secret_text:
+                print("Error: Secret message cannot be empty.")
+                return None
+            return secret_text, None
+            
+        elif message_choice == '2':
+            # User wants to hide a file. Make sure we can open it and that
+            # it isn't empty, but don't read it yet.
+            message_file_path = input("Please enter the path to the file: ").strip()
+            with open_message_file(message_file_path) as message_file:
+                if os.fstat(message_file.fileno()).st_size == 0:
+                    print("Error: Secret message cannot be empty.")
+                    return None
+            return None, message_file_path
+        else:
+            # User entered something other than 1 or 2
+            print("Invalid choice. Please enter 1 or 2.")
             return None
-    else:
-        # User entered something other than 1 or 2
-        print("Invalid choice. Please enter 1 or 2.")
+    except StegoError as e:
+        print(f"Error: {e}")
         return None
+
+
+def open_message_file(message_file_path):
+    """Opens a file whose contents will be hidden (any kind of file).
     
-    # Make sure we actually have a message to hide
-    if not secret_text:
-        print("Error: Secret message cannot be empty.")
-        return None
+    Args:
+        message_file_path (str): Path to the file.
     
-    return secret_text
+    Returns:
+        file: The file, opened for reading bytes.
+    
+    Raises:
+        MessageError: If the file can't be opened.
+    """
+    try:
+        return open(message_file_path, 'rb')
+    except FileNotFoundError:
+        raise MessageError(f"Message file was not found at: {message_file_path}\n"
+                           f"Please check the file path and try again.") from None
+    except OSError as e:
+        raise MessageError(f"Could not read the message file '{message_file_path}'. {str(e)}") from e
 
 
 def read_image_file(image_file_path):
-    # Reads a BMP image file from disk.
+    """Reads a whole BMP image file from disk.
+    
+    Args:
+        image_file_path (str): Path to the image file.
+    
+    Returns:
+        bytearray: The image file bytes (modifiable).
+    
+    Raises:
+        ImageFileError: If the file can't be read.
+    """
+    try:
+        with open(image_file_path, 'rb') as img_file:  # 'rb' = read binary
+            return bytearray(img_file.read())  # Read all bytes and make it modifiable
+    except FileNotFoundError:
+        raise ImageFileError(f"Image file was not found at: {image_file_path}\n"
+                             f"Please check the file path and try again.") from None
+    except PermissionError:
+        raise ImageFileError(f"Permission denied. Cannot read the file: {image_file_path}") from None
+    except OSError as e:
+        raise ImageFileError(f"Could not read the image file. {str(e)}") from e
+
 
+def map_image_file(image_file_path, writable=False):
+    """Opens a BMP image file as a memory map instead of reading it all in.
+    
+    The map acts like a bytearray, but the operating system only loads the
+    parts of the file we actually look at.
+    
+    Args:
+        image_file_path (str): Path to the image file.
+        writable (bool): True to allow changes (they go straight to the file).
+    
+    Returns:
+        mmap.mmap: The mapped file.
+    
+    Raises:
+        ImageFileError: If the file can't be opened.
+        InvalidImageError: If the file is empty.
+    """
     try:
-        img_file = open(image_file_path, 'rb')  # 'rb' = read binary
-        img_bytes = bytearray(img_file.read())   # Read all bytes and make it modifiable
-        img_file.close()  # Close the file
-        return img_bytes
+        if writable:
+            img_file = open(image_file_path, 'r+b')  # 'r+b' = read and write binary
+            access = mmap.ACCESS_WRITE
+        else:
+            img_file = open(image_file_path, 'rb')  # 'rb' = read binary
+            access = mmap.ACCESS_READ
+        
+        # The map keeps its own handle on the file, so we can close ours
+        with img_file:
+            return mmap.mmap(img_file.fileno(), 0, access=access)
     except FileNotFoundError:
-        print(f"Error: Image file was not found at: {image_file_path}")
-        print("Please check the file path and try again.")
-        return None
+        raise ImageFileError(f"Image file was not found at: {image_file_path}\n"
+                             f"Please check the file path and try again.") from None
     except PermissionError:
-        print(f"Error: Permission denied. Cannot read the file: {image_file_path}")
-        return None
-    except Exception as e:
-        print(f"Error: Could not read the image file. {str(e)}")
-        return None
+        raise ImageFileError(f"Permission denied. Cannot read the file: {image_file_path}") from None
+    except ValueError:
+        # Empty files can't be mapped
+        raise InvalidImageError(f"The file '{image_file_path}' is not a valid BMP file.\n"
+                                f"BMP files must start with 'BM'. Please use an uncompressed 24-bit or 32-bit BMP image.") from None
+    except OSError as e:
+        raise ImageFileError(f"Could not read the image file. {str(e)}") from e
 
 
 def validate_bmp_basic(img_bytes, image_file_path):
-    # Performs basic validation on a BMP file.
-
+    """Performs basic validation on a BMP file.
+    
+    Args:
+        img_bytes (bytearray): The image file bytes.
+        image_file_path (str): Path to the image (used in error messages).
+    
+    Returns:
+        bool: True if the file looks like a BMP image.
+    
+    Raises:
+        InvalidImageError: If it doesn't.
+    """
     # Check if it's actually a BMP file
     # BMP files always start with the letters 'BM' - that's how you identify them
     if img_bytes[0:2] != b'BM':
-        print(f"Error: The file '{image_file_path}' is not a valid BMP file.")
-        print("BMP files must start with 'BM'. Please use an uncompressed 24-bit or 32-bit BMP image.")
-        return False
+        raise InvalidImageError(f"The file '{image_file_path}' is not a valid BMP file.\n"
+                                f"BMP files must start with 'BM'. Please use an uncompressed 24-bit or 32-bit BMP image.")
     
     # Check if the file is big enough to have a valid header
     # BMP headers are at least 54 bytes long - if the file is smaller, it's corrupted
     if len(img_bytes) < 54:
-        print("Error: BMP file header is too small or corrupted.")
-        return False
+        raise InvalidImageError("BMP file header is too small or corrupted.")
     
     return True
 
 
-def read_bmp_header(img_bytes):
-    # Reads and extracts information from the BMP file header.
+# Compression types in the BMP header
+BI_RGB = 0        # No compression
+BI_BITFIELDS = 3  # No compression, but the color bytes can be in any order (see the masks)
 
-    header_info = {}
+# Sizes of the info header that follows the 14-byte file header. Newer
+# versions (V4, V5) only add fields at the end, so the fields we need are
+# always in the same place.
+BITMAPINFOHEADER_SIZE = 40
+BITMAPV4HEADER_SIZE = 108
+BITMAPV5HEADER_SIZE = 124
+
+# Where the red, green and blue bit masks are for BI_BITFIELDS images
+COLOR_MASKS_OFFSET = 54
+COLOR_MASKS_SIZE = 12
+
+
+class ImageFileWriter:
+    """Changes parts of an image file in place, reading only the bytes it needs.
     
-    # Find where the pixel data starts (this is stored in bytes 10-13 of the header)
-    try:
-        # Get bytes 10, 11, 12, and 13
-        offset_bytes = img_bytes[10:14]
-        # Convert these 4 bytes to a number (little-endian means least significant byte first)
-        header_info['pixel_data_offset'] = int.from_bytes(offset_bytes, byteorder='little')
-    except (ValueError, IndexError):
-        print("Error: Could not read pixel data offset from BMP header. File may be corrupted.")
-        return None
+    Slicing the writer reads straight from the file (with os.pread where the
+    system has it), so it can stand in for the image bytes wherever they are
+    only read. Changes are written back a whole range at a time with
+    write_range(); see write_blocks_to_file().
+    """
     
-    # Check if the image is compressed
-    # We only support uncompressed BMP files (compression type = 0)
-    # This information is stored in bytes 30-33
-    try:
-        # Get bytes 30, 31, 32, and 33
-        compression_bytes = img_bytes[30:34]
-        # Convert these 4 bytes to a number
-        header_info['compression'] = int.from_bytes(compression_bytes, byteorder='little')
-    except (ValueError, IndexError):
-        print("Error: Could not read compression type from BMP header. File may be corrupted.")
-        return None
+    def __init__(self, image_file):
+        self.image_file = image_file
+        self.size = os.fstat(image_file.fileno()).st_size
     
-    # Find out how many bits per pixel
-    # This tells us if it's 24-bit (3 bytes per pixel) or 32-bit (4 bytes per pixel)
-    # This is stored in bytes 28-29
-    try:
-        # Get bytes 28 and 29
-        bits_bytes = img_bytes[28:30]
-        # Convert these 2 bytes to a number
-        header_info['bits_per_pixel'] = int.from_bytes(bits_bytes, byteorder='little')
-    except (ValueError, IndexError):
-        print("Error: Could not read bits per pixel from BMP header. File may be corrupted.")
-        return None
+    def __len__(self):
+        return self.size
     
-    # Get the image width and height
-    # Width is stored in bytes 18-21
-    # Height is stored in bytes 22-25
-    try:
-        # Get bytes 18, 19, 20, and 21 for width
-        width_bytes = img_bytes[18:22]
-        header_info['width'] = int.from_bytes(width_bytes, byteorder='little')
-        
-        # Get bytes 22, 23, 24, and 25 for height
-        # signed=True means the height can be negative (for top-down images)
-        height_bytes = img_bytes[22:26]
-        header_info['height'] = int.from_bytes(height_bytes, byteorder='little', signed=True)
-    except (ValueError, IndexError):
-        print("Error: Could not read image dimensions from BMP header. File may be corrupted.")
-        return None
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.size)
+            data = self.read_range(start, max(start, stop))
+            return data if step == 1 else data[::step]
+        
+        # A single byte
+        index = key + self.size if key < 0 else key
+        if index < 0 or index >= self.size:
+            raise IndexError("image file index out of range")
+        return self.read_range(index, index + 1)[0]
+    
+    def read_range(self, start, stop):
+        """Returns the file bytes from start up to (not including) stop."""
+        if hasattr(os, 'pread'):
+            return os.pread(self.image_file.fileno(), stop - start, start)
+        self.image_file.seek(start)
+        return self.image_file.read(stop - start)
+    
+    def write_range(self, start, data):
+        """Writes bytes to the file, starting at position start."""
+        data = memoryview(data)
+        while data:
+            if hasattr(os, 'pwrite'):
+                written = os.pwrite(self.image_file.fileno(), data, start)
+            else:
+                self.image_file.seek(start)
+                written = self.image_file.write(data)
+            data = data[written:]
+            start = start + written
     
-    return header_info
+    def flush(self):
+        """Makes sure the changes reach the disk."""
+        self.image_file.flush()
+        os.fsync(self.image_file.fileno())
+    
+    def close(self):
+        self.image_file.close()
 
 
-def validate_bmp_header(header_info, img_bytes):
-    """Validates the BMP header information.
+def open_image_writer(image_file_path):
+    """Opens a BMP image file for changing some of its bytes in place.
     
     Args:
-        header_info (dict): Header information from read_bmp_header().
-        img_bytes (bytearray): The image file bytes.
+        image_file_path (str): Path to the image file.
     
     Returns:
-        bool: True if valid, False otherwise.
-    """
-    # Make sure the offset makes sense
-    if header_info['pixel_data_offset'] < 54:
-        print("Error: Invalid pixel data offset in BMP header.")
-        return False
-    if header_info['pixel_data_offset'] > len(img_bytes):
-        print("Error: Pixel data offset is beyond the file size.")
-        return False
-    
-    # Check if the image is compressed
-    if header_info['compression'] != 0:
-        print("Error: Only uncompressed BMP files are supported.")
-        return False
-    
-    # Validate dimensions
-    if header_info['width'] <= 0:
-        print(f"Error: Invalid image width ({header_info['width']}). Width must be greater than 0.")
-        return False
-    if header_info['height'] == 0:
-        print(f"Error: Invalid image height ({header_info['height']}). Height cannot be zero.")
-        return False
+        ImageFileWriter: The opened image.
     
-    return True
+    Raises:
+        ImageFileError: If the file can't be opened.
+    """
+    try:
+        # No buffering, every read and write goes straight to the file
+        return ImageFileWriter(open(image_file_path, 'r+b', buffering=0))  # 'r+b' = read and write binary
+    except FileNotFoundError:
+        raise ImageFileError(f"Image file was not found at: {image_file_path}\n"
+                             f"Please check the file path and try again.") from None
+    except PermissionError:
+        raise ImageFileError(f"Permission denied. Cannot write to: {image_file_path}") from None
+    except OSError as e:
+        raise ImageFileError(f"Could not open the image file. {str(e)}") from e
 
 
-def convert_message_to_binary(secret_text):
-    """Converts a text message to binary format with a delimiter.
+def open_embed_target(image_file_path, header_info):
+    """Opens the copy of an image that a message will be hidden in.
+    
+    Without a key the message fills one range of pixels, which an
+    ImageFileWriter reads and writes back a block at a time. With a key the
+    color bytes are spread over the whole image, so the file is mapped into
+    memory instead and only the pages that hold them are read and written.
     
     Args:
-        secret_text (str): The secret message text.
+        image_file_path (str): Path to the copy.
+        header_info (BmpLayout): The image layout from read_bmp_header().
     
     Returns:
-        str: Binary string representation of the message with delimiter, or None if error.
+        ImageFileWriter or mmap.mmap: The opened file (both have flush() and close()).
+    
+    Raises:
+        ImageFileError: If the file can't be opened.
     """
-    # Convert the secret message to binary
-    # Computers store everything as binary (ones and zeros)
-    # Each character in our message needs to become 8 bits of binary data
-    binary_message = ""
+    if header_info.carrier_order is not None:
+        return map_image_file(image_file_path, writable=True)
+    return open_image_writer(image_file_path)
+
+
+class PixelWindow:
+    """A range of an image file held in memory, indexed by file positions.
     
-    # Go through each character in the message
-    for char in secret_text:
-        try:
-            # Get the number that represents this character (like ASCII code)
-            # For example, 'A' has the code 65
-            char_code = ord(char)
-            
-            # Convert that number to 8-bit binary with leading zeros
-            # For example: 65 becomes '01000001'
-            # The '08b' means: 8 digits, in binary format, with leading zeros
-            char_binary = format(char_code, '08b')
-            
-            # Add this character's binary to our full binary message
-            binary_message = binary_message + char_binary
-        except (TypeError, ValueError):
-            print("Error: Invalid character in message. Please use standard text characters.")
-            return None
+    The block writers can change a window exactly as they would change the
+    whole image, since they only ever touch the bytes of the block they are given.
+    """
     
-    # Add a delimiter to mark where the message ends
-    # This is a special pattern: 0000000000000001 (15 zeros then a 1)
-    # When we decode later, we'll look for this pattern to know when to stop reading
-    # It's like putting a bookmark at the end of our message
-    delimiter = '0000000000000001'
+    def __init__(self, data, start):
+        self.data = bytearray(data)
+        self.start = start
     
-    # Combine the message and delimiter
-    full_data = binary_message + delimiter
+    def __getitem__(self, key):
+        return self.data[slice(key.start - self.start, key.stop - self.start, key.step)]
     
-    return full_data
+    def __setitem__(self, key, value):
+        self.data[slice(key.start - self.start, key.stop - self.start, key.step)] = value
 
 
-def encode_24bit(img_bytes, full_data, header_info):
-    """Encodes a message into a 24-bit BMP image using LSB steganography.
+class ImageStream(ImageFileWriter):
+    """An image arriving on a stream (like standard input), read once from start to end.
     
-    Args:
-        img_bytes (bytearray): The image file bytes (will be modified).
-        full_data (str): Binary string of the message with delimiter.
-        header_info (dict): Header information from read_bmp_header().
+    It stands in for an ImageFileWriter: slicing reads from the source as
+    far as needed, and write_range() changes the bytes that are still held.
+    Every whole row more than STREAM_KEEP_SIZE behind the latest write is
+    passed on to the target, so the new image flows out while the message
+    goes in and only a few rows are ever held in memory. finish() passes on
+    the rest. Bytes are only let go after a write, never after a read: with
+    matrix embedding a block is read ahead of its write (sometimes much more
+    than STREAM_KEEP_SIZE of it) and then read again from its start when it
+    is written back (see write_blocks_to_file()).
     
-    Returns:
-        bool: True if successful, False otherwise.
+    With no target (for decoding) nothing is written, so the rows behind the
+    latest read are dropped instead.
+    
+    With a key the color bytes can be anywhere in the image, so then nothing
+    is passed on before finish().
+    
+    Args:
+        source (file object): The binary stream the image comes from.
+        target (file object): The binary stream the image goes to, or None.
+        header_info (BmpLayout): The image layout from read_stream_header().
+        data (bytes): The bytes already read from the source (the headers).
     """
-    # Get the information we need from the header
-    pixel_data_offset = header_info['pixel_data_offset']
-    width = header_info['width']
-    height = header_info['height']
     
-    # In a 24-bit image, each pixel uses 3 bytes (one for Blue, one for Green, one for Red)
-    bytes_per_pixel = 3
+    def __init__(self, source, target, header_info, data=b''):
+        self.source = source
+        self.target = target
+        self.header_info = header_info
+        
+        # A stream has no size, so go by where the header says the pixels end
+        self.size = header_info.pixel_array_end
+        self.keep_all = header_info.carrier_order is not None
+        
+        # The bytes we hold, and where in the image the first one is
+        self.buffer = bytearray(data)
+        self.buffer_start = 0
+        
+        self.bytes_read = len(data)
+        self.bytes_written = 0
     
-    # Calculate how many bytes are in one row (without padding)
-    bytes_per_row_without_padding = width * bytes_per_pixel
+    def __setitem__(self, key, value):
+        # Only used with a key (see CarrierOrder.write_segments())
+        self.write_range(key.start, value)
     
-    # BMP files require each row to be a multiple of 4 bytes
-    # So if a row is 10 bytes, we need to add 2 padding bytes to make it 12 bytes
-    # Let's calculate how many bytes per row including padding
-    remainder = bytes_per_row_without_padding % 4
-    if remainder == 0:
-        # Already a multiple of 4, no padding needed
-        bytes_per_row = bytes_per_row_without_padding
-    else:
-        # Need to add padding to make it a multiple of 4
-        padding_needed = 4 - remainder
-        bytes_per_row = bytes_per_row_without_padding + padding_needed
+    def read_range(self, start, stop):
+        """Returns the image bytes from start up to (not including) stop."""
+        self.fill(stop)
+        if self.target is None and not self.keep_all:
+            self.pass_on(start - STREAM_KEEP_SIZE)
+        if start < self.buffer_start:
+            raise ValueError("An ImageStream can't go back to bytes it has already passed on")
+        
+        data = bytes(self.buffer[start - self.buffer_start:stop - self.buffer_start])
+        if len(data) < stop - start and self.target is not None:
+            raise InvalidImageError("The image ended before all of its pixels arrived. It may be cut short.")
+        return data
     
-    # Get the number of rows (use absolute value in case height is negative)
-    if height < 0:
-        number_of_rows = -height
-    else:
-        number_of_rows = height
+    def write_range(self, start, data):
+        """Changes bytes that have been read but not passed on yet."""
+        offset = start - self.buffer_start
+        if offset < 0 or offset + len(data) > len(self.buffer):
+            raise ValueError("An ImageStream can only change the bytes it still holds")
+        self.buffer[offset:offset + len(data)] = data
+
+        # The blocks are written in order, so nothing before this one is needed again
+        if not self.keep_all:
+            self.pass_on(start - STREAM_KEEP_SIZE)
     
-    # Calculate how many pixels are in the image
-    total_pixels = number_of_rows * width
+    def fill(self, stop):
+        """Reads from the source until we hold everything before stop (or it ends)."""
+        while self.buffer_start + len(self.buffer) < stop:
+            block = self.read_source(max(stop - self.buffer_start - len(self.buffer), STREAM_BLOCK_SIZE))
+            if not block:
+                break
+            self.buffer += block
     
-    # Each pixel has 3 bytes, and we can hide 1 bit in each byte
-    # So we can hide 3 bits per pixel
-    bits_per_pixel = 3
-    available_bits = total_pixels * bits_per_pixel
+    def pass_on(self, position):
+        """Passes on every whole row of pixels before position, and the headers before them."""
+        header_info = self.header_info
+        if position <= header_info.pixel_data_offset:
+            return
+        rows = (position - header_info.pixel_data_offset) // header_info.bytes_per_row
+        count = min(header_info.pixel_data_offset + rows * header_info.bytes_per_row - self.buffer_start,
+                    len(self.buffer))
+        if count <= 0:
+            return
+        
+        self.write_target(self.buffer[:count])
+        del self.buffer[:count]
+        self.buffer_start = self.buffer_start + count
     
-    # Check if our message will fit
-    message_length = len(full_data)
-    if message_length > available_bits:
-        print(f"Error: The message is too long for this image.")
-        print(f"Message requires {message_length} bits, but image only has {available_bits} bits available.")
-        print(f"Try using a larger image or a shorter message.")
-        return False
-    
-    # Now we'll hide the message bit by bit
-    # We'll go through each row, then each pixel, then each color channel
-    data_index = 0  # This keeps track of which bit of our message we're currently hiding
-    
-    # Go through each row of the image
-    for row in range(number_of_rows):
-        # Calculate where this row starts in the file
-        row_start = pixel_data_offset + (row * bytes_per_row)
-        
-        # Go through each pixel in this row
-        for pixel in range(width):
-            # Check if we've hidden all our data
-            if data_index >= len(full_data):
-                break  # We're done!
-            
-            # Calculate where this pixel starts in the file
-            pixel_start = row_start + (pixel * bytes_per_pixel)
-            
-            # Each pixel has 3 color channels: Blue (0), Green (1), and Red (2)
-            # We'll hide one bit in each channel
-            for channel in range(3):
-                # Check if we've hidden all our data
-                if data_index >= len(full_data):
-                    break  # We're done!
-                
-                # Calculate which byte we're modifying
-                byte_index = pixel_start + channel
-                
-                # Make sure we don't go past the end of the file
-                if byte_index >= len(img_bytes):
-                    print("Error: Attempted to write beyond file size. Image may be corrupted.")
-                    return False
-                
-                # Get the current byte value
-                current_byte = img_bytes[byte_index]
-                
-                # Clear the last bit (set it to 0)
-                # 0b11111110 in binary means all bits are 1 except the last one
-                # When we use & (AND), it keeps all bits the same except sets the last bit to 0
-                cleared_byte = current_byte & 0b11111110
-                
-                # Get the bit we want to hide (convert from string '0' or '1' to integer)
-                message_bit_string = full_data[data_index]
-                message_bit = int(message_bit_string)
-                
-                # Set the last bit to our message bit
-                # When we use | (OR), it combines the cleared byte with our bit
-                new_byte = cleared_byte | message_bit
-                
-                # Update the byte in the image
-                img_bytes[byte_index] = new_byte
-                
-                # Move to the next bit of our message
-                data_index = data_index + 1
-        
-        # Check if we're done (we skip padding bytes automatically because we only
-        # iterate through 'width' pixels, not the full bytes_per_row)
-        if data_index >= len(full_data):
-            break  # We're done!
+    def finish(self):
+        """Passes on everything still held, then the rest of the source as it is."""
+        if self.target is None:
+            return
+        self.write_target(self.buffer)
+        self.buffer_start = self.buffer_start + len(self.buffer)
+        self.buffer = bytearray()
+        
+        # Anything after the pixels (like an ICC color profile) goes through unchanged
+        while True:
+            block = self.read_source(STREAM_BLOCK_SIZE)
+            if not block:
+                break
+            self.write_target(block)
+            self.buffer_start = self.buffer_start + len(block)
+        self.flush()
     
-    return True
+    def read_source(self, size):
+        try:
+            block = self.source.read(size)
+        except OSError as e:
+            raise ImageFileError(f"Could not read the image stream. {str(e)}") from e
+        self.bytes_read += len(block)
+        return block
+    
+    def write_target(self, data):
+        if self.target is None:
+            return
+        try:
+            self.target.write(data)
+        except OSError as e:
+            raise ImageFileError(f"Could not write the new image. {str(e)}") from e
+        self.bytes_written += len(data)
+    
+    def flush(self):
+        """Makes sure the bytes passed on so far reach the target."""
+        if self.target is not None:
+            try:
+                self.target.flush()
+            except OSError as e:
+                raise ImageFileError(f"Could not write the new image. {str(e)}") from e
+    
+    def close(self):
+        # The streams belong to the caller, so they are left open
+        pass
 
 
-def encode_32bit(img_bytes, full_data, header_info):
-    """Encodes a message into a 32-bit BMP image using LSB steganography.
+def read_stream_header(source, key=None, stream_name='<stdin>'):
+    """Reads and checks the headers of a BMP image arriving on a stream.
+    
+    Only the bytes up to the pixel data are read, so the pixels are still
+    waiting on the stream for an ImageStream.
     
     Args:
-        img_bytes (bytearray): The image file bytes (will be modified).
-        full_data (str): Binary string of the message with delimiter.
-        header_info (dict): Header information from read_bmp_header().
+        source (file object): The binary stream the image comes from.
+        key (str or bytes): Secret key that picks which color bytes hold the message, or None.
+        stream_name (str): What to call the stream in error messages.
     
     Returns:
-        bool: True if successful, False otherwise.
+        tuple: (the bytes read, BmpLayout), ready for ImageStream.
+    
+    Raises:
+        StegoError: If the stream can't be read or the image can't be used.
     """
-    # Get the information we need from the header
-    pixel_data_offset = header_info['pixel_data_offset']
-    width = header_info['width']
-    height = header_info['height']
+    def read_exactly(data, size):
+        # A pipe can hand over less than asked for, so keep reading
+        while len(data) < size:
+            try:
+                block = source.read(size - len(data))
+            except OSError as e:
+                raise ImageFileError(f"Could not read the image stream. {str(e)}") from e
+            if not block:
+                break
+            data += block
+        return data
     
-    # Get the number of rows (use absolute value in case height is negative)
-    if height < 0:
-        number_of_rows = -height
-    else:
-        number_of_rows = height
+    # The file header says where the pixels start. Read at least as far as
+    # the color masks, which some images keep right after the info header.
+    data = read_exactly(bytearray(), 14)
+    pixel_data_offset = int.from_bytes(data[10:14], byteorder='little')
+    if pixel_data_offset > MAX_STREAM_HEADER_SIZE:
+        raise InvalidImageError("Invalid pixel data offset in BMP header.")
+    data = read_exactly(data, max(pixel_data_offset, COLOR_MASKS_OFFSET + COLOR_MASKS_SIZE))
     
-    # Calculate how many pixels are in the image
-    total_pixels = number_of_rows * width
+    validate_bmp_basic(data, stream_name)
+    header_info = read_bmp_header(data)
+    validate_bmp_header(header_info, data)
+    check_bits_per_pixel(header_info)
+
+    # A file shows how big the image really is, but a stream only has the
+    # header's word for it, so a broken header could claim a size no
+    # program can index
+    if header_info.pixel_array_end > sys.maxsize:
+        raise InvalidImageError("The BMP header describes more pixels than an image can hold. "
+                                "It may be corrupted.")
+    return bytes(data), apply_key(header_info, key)
+
+
+class BmpLayout:
+    """Where everything is in a BMP file, worked out once from its header.
     
-    # In a 32-bit image, each pixel has 4 bytes: Blue, Green, Red, and Alpha
-    # We'll skip the Alpha channel and only use Blue, Green, and Red
-    # So we can hide 3 bits per pixel
-    bits_per_pixel = 3
-    available_bits = total_pixels * bits_per_pixel
+    Every function that reads or changes pixels uses this instead of doing
+    the row arithmetic itself, so nothing outside the pixel array (like ICC
+    color profiles stored after it) is ever touched.
     
-    # Check if our message will fit
-    message_length = len(full_data)
-    if message_length > available_bits:
-        print(f"Error: The message is too long for this image.")
-        print(f"Message requires {message_length} bits, but image only has {available_bits} bits available.")
-        print(f"Try using a larger image or a shorter message.")
-        return False
-    
-    # Now we'll hide the message bit by bit
-    # We'll go through each pixel (every 4 bytes) and use the first 3 bytes
-    data_index = 0  # This keeps track of which bit of our message we're currently hiding
-    
-    # Start at the pixel data and go through each pixel (every 4 bytes)
-    pixel_start = pixel_data_offset
-    while pixel_start < len(img_bytes):
-        # For each pixel, we'll use the first 3 bytes (Blue, Green, Red)
-        # We skip the 4th byte (Alpha channel)
-        for channel in range(3):  # 0=Blue, 1=Green, 2=Red
-            # Check if we've hidden all our data
-            if data_index >= len(full_data):
-                break  # We're done!
-            
-            # Calculate which byte we're modifying
-            byte_index = pixel_start + channel
-            
-            # Make sure we don't go past the end of the file
-            if byte_index >= len(img_bytes):
-                print("Error: Attempted to write beyond file size. Image may be corrupted.")
-                return False
-            
-            # Get the current byte value
-            current_byte = img_bytes[byte_index]
-            
-            # Clear the last bit (set it to 0)
-            # 0b11111110 in binary means all bits are 1 except the last one
-            # When we use & (AND), it keeps all bits the same except sets the last bit to 0
-            cleared_byte = current_byte & 0b11111110
-            
-            # Get the bit we want to hide (convert from string '0' or '1' to integer)
-            message_bit_string = full_data[data_index]
-            message_bit = int(message_bit_string)
-            
-            # Set the last bit to our message bit
-            # When we use | (OR), it combines the cleared byte with our bit
-            new_byte = cleared_byte | message_bit
-            
-            # Update the byte in the image
-            img_bytes[byte_index] = new_byte
-            
-            # Move to the next bit of our message
-            data_index = data_index + 1
+    Attributes:
+        pixel_data_offset (int): Where the pixel data starts in the file.
+        compression (int): BI_RGB or BI_BITFIELDS for the images we support.
+        bits_per_pixel (int): 24 or 32 for the images we support.
+        width (int): Width in pixels.
+        height (int): Height as stored in the header (negative for top-down images).
+        header_size (int): Size of the info header (40, or 108/124 for V4/V5).
+        color_masks (tuple): Red, green and blue bit masks (BI_BITFIELDS only, else None).
+        top_down (bool): True if the first row in the file is the top of the picture.
+        number_of_rows (int): The height without its sign.
+        bytes_per_pixel (int): 3 for 24-bit images, 4 for 32-bit images.
+        row_size (int): Bytes of pixels in one row, without padding.
+        bytes_per_row (int): Bytes in one row including padding (the stride).
+        pixel_array_end (int): Where the pixel data ends in the file.
+        channel_offsets (tuple): Where the 3 color bytes we use sit inside a pixel.
+        carrier_count (int): How many color bytes can carry message bits.
+        run_length (int): How many color bytes of a 24-bit image sit next to each other.
+        carrier_order (CarrierOrder): The keyed order of the color bytes (see
+            scatter.py), or None to use them in order from the first pixel.
+    """
+    
+    __slots__ = ('pixel_data_offset', 'compression', 'bits_per_pixel', 'width', 'height',
+                 'header_size', 'color_masks', 'top_down', 'number_of_rows', 'bytes_per_pixel',
+                 'row_size', 'bytes_per_row', 'pixel_array_end', 'channel_offsets',
+                 'carrier_count', 'run_length', 'carrier_order')
+    
+    def __init__(self, pixel_data_offset, compression, bits_per_pixel, width, height,
+                 header_size=BITMAPINFOHEADER_SIZE, color_masks=None):
+        self.pixel_data_offset = pixel_data_offset
+        self.compression = compression
+        self.bits_per_pixel = bits_per_pixel
+        self.width = width
+        self.height = height
+        self.header_size = header_size
+        self.color_masks = color_masks
+        
+        # A positive height means the rows are stored from the bottom of the
+        # picture up (the usual way); a negative height means top to bottom
+        self.top_down = height < 0
+        if height < 0:
+            self.number_of_rows = -height
+        else:
+            self.number_of_rows = height
         
-        # Check if we're done
-        if data_index >= len(full_data):
-            break  # We're done!
+        # In a 24-bit image, each pixel uses 3 bytes (one for Blue, one for Green, one for Red)
+        # In a 32-bit image, each pixel has 4 bytes: Blue, Green, Red, and Alpha
+        self.bytes_per_pixel = bits_per_pixel // 8
         
-        # Move to the next pixel (each pixel is 4 bytes)
-        pixel_start = pixel_start + 4
+        # Calculate how many bytes are in one row (without padding)
+        self.row_size = width * self.bytes_per_pixel
+        
+        # BMP files require each row to be a multiple of 4 bytes
+        # So if a row is 10 bytes, we need to add 2 padding bytes to make it 12 bytes
+        remainder = self.row_size % 4
+        if remainder == 0:
+            # Already a multiple of 4, no padding needed
+            self.bytes_per_row = self.row_size
+        else:
+            # Need to add padding to make it a multiple of 4
+            self.bytes_per_row = self.row_size + (4 - remainder)
+        
+        self.pixel_array_end = pixel_data_offset + self.bytes_per_row * self.number_of_rows
+        
+        # We hide bits in the Blue, Green and Red bytes and skip Alpha. They
+        # are used in the order they sit in the pixel, which is Blue, Green,
+        # Red unless the color masks say otherwise.
+        self.channel_offsets = find_channel_offsets(color_masks) or (0, 1, 2)
+        self.carrier_count = self.number_of_rows * width * len(self.channel_offsets)
+        
+        # Inside a row the Blue, Green and Red bytes of all pixels of a 24-bit
+        # image sit right next to each other. Without padding the rows join up
+        # and the whole image is one long run.
+        if self.bytes_per_row == self.row_size:
+            self.run_length = self.carrier_count
+        else:
+            self.run_length = self.row_size
+        
+        # Set by scatter.apply_key() when the message is hidden with a key
+        self.carrier_order = None
     
-    return True
+    def __repr__(self):
+        return (f"BmpLayout(width={self.width}, height={self.height}, bits_per_pixel={self.bits_per_pixel}, "
+                f"pixel_data_offset={self.pixel_data_offset}, bytes_per_row={self.bytes_per_row})")
+    
+    def carrier_position(self, carrier):
+        """Finds where in the file a color byte is.
+        
+        Args:
+            carrier (int): Index of the color byte (0 = first color byte of the first pixel).
+        
+        Returns:
+            int: The position of that byte in the file.
+        """
+        pixel, channel = divmod(carrier, len(self.channel_offsets))
+        row, column = divmod(pixel, self.width)
+        return (self.pixel_data_offset + row * self.bytes_per_row
+                + column * self.bytes_per_pixel + self.channel_offsets[channel])
+    
+    def carrier_span(self, first_carrier, carrier_count):
+        """Finds the range of the file that holds some color bytes.
+        
+        Args:
+            first_carrier (int): Index of the first color byte.
+            carrier_count (int): How many color bytes (at least 1).
+        
+        Returns:
+            tuple: (start, stop) file positions covering every pixel that
+            holds one of the color bytes.
+        """
+        channels = len(self.channel_offsets)
+        first_row, first_column = divmod(first_carrier // channels, self.width)
+        last_row, last_column = divmod((first_carrier + carrier_count - 1) // channels, self.width)
+        start = self.pixel_data_offset + first_row * self.bytes_per_row + first_column * self.bytes_per_pixel
+        stop = self.pixel_data_offset + last_row * self.bytes_per_row + (last_column + 1) * self.bytes_per_pixel
+        return start, stop
+    
+    def carrier_end(self, carrier_count):
+        """Finds where in the file the first few color bytes of the payload end.
+        
+        Args:
+            carrier_count (int): How many color bytes the payload uses (at least 1).
+        
+        Returns:
+            int: The position just after the last of them. With a key they can
+            be anywhere, so this is the end of the last color byte of the image.
+        """
+        if self.carrier_order is not None:
+            carrier_count = self.carrier_count
+        return self.carrier_position(carrier_count - 1) + 1
 
 
-def save_encoded_image(img_bytes):
-    """Saves the encoded image to a file.
+def find_channel_offsets(color_masks):
+    """Works out where the color bytes are in a pixel from the BI_BITFIELDS masks.
     
     Args:
-        img_bytes (bytearray): The modified image file bytes.
+        color_masks (tuple): Red, green and blue bit masks, or None.
     
     Returns:
-        str: Path to the saved file, or None if there was an error.
+        tuple: The byte positions of the three colors in the order they sit in
+        the pixel, or None if there are no masks or a color isn't exactly one byte.
     """
-    # Ask the user what they want to name the new file
-    new_image_path = input("Please enter the filename for the new image with .bmp extension (e.g., secret.bmp): ")
-    
-    # Make sure it ends with .bmp (add it if the user forgot)
-    if not new_image_path.lower().endswith('.bmp'):
-        new_image_path = new_image_path + '.bmp'
-    
-    # Write the file
-    try:
-        new_img_file = open(new_image_path, 'wb')  # 'wb' = write binary
-        new_img_file.write(img_bytes)  # Write all the modified bytes
-        new_img_file.close()  # Close the file
-        print(f"Success! Your secret message has been encoded into {new_image_path}.")
-        return new_image_path
-    except PermissionError:
-        print(f"Error: Permission denied. Cannot write to: {new_image_path}")
-        print("Please check file permissions or choose a different location.")
+    if color_masks is None:
         return None
-    except Exception as e:
-        print(f"Error: Could not save the image file '{new_image_path}'. {str(e)}")
+    
+    # Each mask must cover exactly one whole byte, like 0x00FF0000
+    byte_masks = [0xFF << (8 * position) for position in range(4)]
+    if any(mask not in byte_masks for mask in color_masks) or len(set(color_masks)) != 3:
         return None
+    return tuple(sorted(byte_masks.index(mask) for mask in color_masks))
 
 
-def Encode():
-    """This function hides a secret message inside a BMP image file.
+def read_bmp_header(img_bytes):
+    """Reads and extracts information from the BMP file header.
     
-    The steps go like this:
-    1. Get the secret message from the user
-    2. Get the image file to hide it in
-    3. Convert the message to binary (ones and zeros)
-    4. Read information from the BMP file header
-    5. Hide each bit of the message in the image pixels
-    6. Save the modified image
+    Args:
+        img_bytes (bytearray): The image file bytes (at least the first 54).
     
-    We use LSB (Least Significant Bit) steganography - we change the last bit
-    of each color channel byte to store our message. Since we only change the
-    last bit, the image looks almost exactly the same to the human eye.
+    Returns:
+        BmpLayout: The header fields we need and the layout of the pixels.
+    
+    Raises:
+        InvalidImageError: If the header is cut short.
     """
+    # All the fields we need are in the first 34 bytes
+    if len(img_bytes) < 34:
+        raise InvalidImageError("BMP file header is too small or corrupted.")
     
-    # Step 1: Get the secret message from the user
-    secret_text = get_secret_message()
-    if secret_text is None:
-        return
+    # Find where the pixel data starts (this is stored in bytes 10-13 of the header)
+    # Convert these 4 bytes to a number (little-endian means least significant byte first)
+    pixel_data_offset = int.from_bytes(img_bytes[10:14], byteorder='little')
     
-    # Step 2: Get the image file from the user
-    image_file_path = input("Please enter the path to the BMP image file: ")
+    # The size of the info header tells us which version of BMP this is
+    # This is stored in bytes 14-17
+    header_size = int.from_bytes(img_bytes[14:18], byteorder='little')
     
-    # Step 3: Read the image file
-    img_bytes = read_image_file(image_file_path)
-    if img_bytes is None:
-        return
+    # Check if the image is compressed
+    # We only support uncompressed BMP files (compression type = 0, or 3 if
+    # the color bytes are described by bit masks)
+    # This information is stored in bytes 30-33
+    compression = int.from_bytes(img_bytes[30:34], byteorder='little')
     
-    # Step 4: Validate basic BMP structure
-    if not validate_bmp_basic(img_bytes, image_file_path):
-        return
+    # Find out how many bits per pixel
+    # This tells us if it's 24-bit (3 bytes per pixel) or 32-bit (4 bytes per pixel)
+    # This is stored in bytes 28-29
+    bits_per_pixel = int.from_bytes(img_bytes[28:30], byteorder='little')
     
-    # Step 5: Read BMP header information
-    header_info = read_bmp_header(img_bytes)
-    if header_info is None:
-        return
+    # Get the image width and height
+    # Width is stored in bytes 18-21
+    # Height is stored in bytes 22-25
+    # signed=True means the height can be negative (for top-down images)
+    width = int.from_bytes(img_bytes[18:22], byteorder='little')
+    height = int.from_bytes(img_bytes[22:26], byteorder='little', signed=True)
     
-    # Step 6: Validate header information
-    if not validate_bmp_header(header_info, img_bytes):
-        return
+    # With bit fields, the red, green and blue masks come right after the
+    # 40-byte part of the header (V4 and V5 headers keep them in the same place)
+    color_masks = None
+    if compression == BI_BITFIELDS:
+        masks_end = COLOR_MASKS_OFFSET + COLOR_MASKS_SIZE
+        if len(img_bytes) < masks_end:
+            raise InvalidImageError("BMP file header is too small or corrupted.")
+        color_masks = struct.unpack('<III', img_bytes[COLOR_MASKS_OFFSET:masks_end])
     
-    # Step 7: Convert the secret message to binary
-    full_data = convert_message_to_binary(secret_text)
-    if full_data is None:
-        return
+    return BmpLayout(pixel_data_offset, compression, bits_per_pixel, width, height, header_size, color_masks)
+
+
+def validate_bmp_header(header_info, img_bytes):
+    """Validates the BMP header information.
+    
+    Args:
+        header_info (BmpLayout): The image layout from read_bmp_header().
+        img_bytes (bytearray): The image file bytes.
     
-    # Step 8: Hide the message in the image based on bit depth
-    bits_per_pixel = header_info['bits_per_pixel']
+    Returns:
+        bool: True if valid.
     
-    if bits_per_pixel == 24:
-        success = encode_24bit(img_bytes, full_data, header_info)
-        if not success:
-            return
-    elif bits_per_pixel == 32:
-        success = encode_32bit(img_bytes, full_data, header_info)
-        if not success:
-            return
-    elif bits_per_pixel == 8:
+    Raises:
+        InvalidImageError: If the header doesn't make sense.
+        UnsupportedImageError: If the image is compressed.
+    """
+    # Old OS/2 style headers are laid out differently
+    if header_info.header_size < BITMAPINFOHEADER_SIZE:
+        raise UnsupportedImageError("This BMP file uses an old OS/2 header, which is not supported.")
+    
+    # Make sure the offset makes sense (the pixels can't start inside the header)
+    header_end = 14 + header_info.header_size
+    if header_info.compression == BI_BITFIELDS and header_info.header_size == BITMAPINFOHEADER_SIZE:
+        header_end = header_end + COLOR_MASKS_SIZE
+    if header_info.pixel_data_offset < max(54, header_end):
+        raise InvalidImageError("Invalid pixel data offset in BMP header.")
+    if header_info.pixel_data_offset > len(img_bytes):
+        raise InvalidImageError("Pixel data offset is beyond the file size.")
+    
+    # Check if the image is compressed. Bit fields are fine as long as every
+    # color is a whole byte of a 32-bit pixel.
+    if header_info.compression == BI_BITFIELDS:
+        if header_info.bits_per_pixel != 32 or find_channel_offsets(header_info.color_masks) is None:
+            raise UnsupportedImageError("Only BMP files with one whole byte per color are supported.")
+    elif header_info.compression != BI_RGB:
+        raise UnsupportedImageError("Only uncompressed BMP files are supported.")
+    
+    # Validate dimensions
+    if header_info.width <= 0:
+        raise InvalidImageError(f"Invalid image width ({header_info.width}). Width must be greater than 0.")
+    if header_info.height == 0:
+        raise InvalidImageError(f"Invalid image height ({header_info.height}). Height cannot be zero.")
+    
+    return True
+
+
+def check_bits_per_pixel(header_info):
+    """Makes sure we know how to hide a message in this kind of BMP image.
+    
+    Args:
+        header_info (BmpLayout): The image layout from read_bmp_header().
+    
+    Raises:
+        UnsupportedImageError: If the image isn't 24-bit or 32-bit.
+    """
+    bits_per_pixel = header_info.bits_per_pixel
+    
+    if bits_per_pixel == 8:
         # 8-bit images use a color palette, which is more complicated
-        print("Error: Encoding into 8-bit BMP images is not supported.")
-        print("Please convert your image to a 24-bit or 32-bit BMP format.")
-        return
-    else:
+        raise UnsupportedImageError("8-bit BMP images are not supported.\n"
+                                    "Please convert your image to a 24-bit or 32-bit BMP format.")
+    if bits_per_pixel != 24 and bits_per_pixel != 32:
         # Some other format we don't support
-        print(f"Error: Unsupported BMP format. This image has {bits_per_pixel} bits per pixel.")
-        print("Only 24-bit and 32-bit BMP images are supported.")
+        raise UnsupportedImageError(f"Unsupported BMP format. This image has {bits_per_pixel} bits per pixel.\n"
+                                    f"Only 24-bit and 32-bit BMP images are supported.")
+
+
+# Every hidden message starts with a small header so the decoder knows how many
+# bytes to read and can tell an image with a message from one without:
+#   magic (4 bytes)    - the letters 'LSB' and a zero byte
+#   version (1 byte)   - the header format version
+#   flags (1 byte)     - options used when hiding the message (see below)
+#   length (4 bytes)   - how many message bytes follow the header
+#   checksum (4 bytes) - CRC32 of the message bytes
+PAYLOAD_MAGIC = b'LSB\x00'
+PAYLOAD_FORMAT_VERSION = 1
+PAYLOAD_HEADER_FORMAT = '>4sBBII'
+PAYLOAD_HEADER_SIZE = struct.calcsize(PAYLOAD_HEADER_FORMAT)
+
+# Flag bits in the payload header
+# Bits 0-1: how many bits the message stores in each color byte, minus 1.
+# The header itself always uses 1 bit per byte so it can be read first.
+# Bits 2-3: how the message was compressed (one of COMPRESSION_METHODS).
+# Bit 4: the message is one part of a bigger one that was split over several
+# images (see split.py). The message then starts with a fragment header.
+# Bits 5-7: the message is hidden with matrix embedding (see MAX_MATRIX_BITS),
+# and this is the number of message bits per group of color bytes. 0 = off.
+FLAG_BITS_PER_CHANNEL = 0b00000011
+FLAG_COMPRESSION = 0b00001100
+FLAG_COMPRESSION_SHIFT = 2
+FLAG_FRAGMENT = 0b00010000
+FLAG_MATRIX = 0b11100000
+FLAG_MATRIX_SHIFT = 5
+KNOWN_FLAGS = FLAG_BITS_PER_CHANNEL | FLAG_COMPRESSION | FLAG_FRAGMENT | FLAG_MATRIX
+
+# Ways a message can be compressed before it is hidden, and the number stored
+# for each in the header flags. 'auto' tries them all and keeps the smallest.
+# COMPRESSION_CHOICES, MAX_BITS_PER_CHANNEL and the matrix embedding limits
+# are in options.py.
+COMPRESSION_METHODS = {'none': 0, 'zlib': 1, 'lzma': 2}
+
+# Older versions of this program had no header. They marked the end of the
+# message with the pattern 0000000000000001 (15 zeros then a 1) instead, and
+# the decoder still looks for it in images without a header.
+MESSAGE_DELIMITER = b'\x00\x01'
+
+# Lookup tables for bytes.translate(): entry k maps every byte value to the
+# same value with its last k bits cleared, so a whole run of bytes can be
+# cleared in one call
+CLEAR_LOW_BITS_TABLES = [bytes(value & (0xFF << k) & 0xFF for value in range(256))
+                         for k in range(MAX_BITS_PER_CHANNEL + 1)]
+CLEAR_LSB_TABLE = CLEAR_LOW_BITS_TABLES[1]
+
+# Lookup tables for bytes.translate(): entry s moves a bit value (0 or 1) s
+# places to the left, so 1 becomes 2, 4, 8, ... (up to the biggest matrix
+# embedding group value)
+SHIFT_BIT_TABLES = [bytes((value << s) & 0xFF for value in range(256))
+                    for s in range(MAX_MATRIX_BITS)]
+
+# Lookup table for bytes.translate(): keeps only the last bit of each byte
+LAST_BIT_TABLE = bytes(value & 0b00000001 for value in range(256))
+
+# Lookup tables for bytes.translate() used by matrix embedding. Entry i of
+# MATRIX_POSITION_TABLES turns a color byte into i if its last bit is 1 (and
+# 0 if not). Entry i of MATRIX_SELECT_TABLES turns i into 1 and anything else
+# into 0. There are 256 of them, so they are built with bytes methods rather
+# than one byte at a time, which would slow down every import of this module.
+MATRIX_POSITION_TABLES = [LAST_BIT_TABLE.replace(b'\x01', bytes([position]))
+                          for position in range(2 ** MAX_MATRIX_BITS)]
+MATRIX_SELECT_TABLES = [bytes(position) + b'\x01' + bytes(255 - position)
+                        for position in range(2 ** MAX_MATRIX_BITS)]
+
+# Lookup table for bytes.translate(): turns the characters '0' and '1' into the
+# byte values 0 and 1 so a binary string can be used as a run of bit values
+BIT_CHARS_TO_VALUES = bytes.maketrans(b'01', b'\x00\x01')
+
+# How many payload bytes are turned into bits at a time while embedding.
+# This keeps the unpacked bits small no matter how long the message is. It is
+# a multiple of 3 and 4 so every block splits evenly into color bytes.
+EMBED_BLOCK_SIZE = 48 * 1024
+
+# Payloads smaller than this are always hidden by a single process, because
+# starting workers would take longer than the work itself
+PARALLEL_MIN_SIZE = 4 * 1024 * 1024
+
+# How much of a message file is read at a time when it is hidden straight
+# from the file. It is exactly one block, so the message part of the payload
+# is cut in the same places as when it is hidden from memory.
+MESSAGE_READ_SIZE = EMBED_BLOCK_SIZE
+
+# Errors that mean a kernel-side copy isn't supported for these two files
+# (different file systems, an old kernel, ...), so copy_file_contents()
+# should try another way
+COPY_FALLBACK_ERRORS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOTSOCK}
+
+# How many bytes an ImageStream reads from its source at a time
+STREAM_BLOCK_SIZE = 256 * 1024
+
+# How far behind the latest read an ImageStream keeps the bytes it has
+# already passed. The readers step back a little now and then (a 32-bit
+# image is read one color at a time, and old images are read again from the
+# first pixel after looking for a payload header), never by more than this.
+STREAM_KEEP_SIZE = 64 * 1024
+
+# The most header bytes (before the pixels) we accept from a stream, so a
+# broken pixel data offset can't make us read a huge amount into memory
+MAX_STREAM_HEADER_SIZE = 1024 * 1024
+
+
+def count_available_bits(header_info, bits_per_channel=1, matrix_bits=0):
+    """Works out how many bits can be hidden in an image.
+    
+    Args:
+        header_info (BmpLayout): The image layout from read_bmp_header().
+        bits_per_channel (int): How many bits the message stores in each color byte.
+        matrix_bits (int): Bits per group with matrix embedding (0 = not used).
+    
+    Returns:
+        int: The number of bits that fit (3 color bytes per pixel).
+    """
+    carrier_bytes = header_info.carrier_count
+    
+    if bits_per_channel == 1 and not matrix_bits:
+        return carrier_bytes
+    
+    # The payload header always takes 1 bit from each of its color bytes
+    header_carriers = min(carrier_bytes, PAYLOAD_HEADER_SIZE * 8)
+    if matrix_bits:
+        # Every whole group of color bytes holds matrix_bits bits
+        groups = (carrier_bytes - header_carriers) // matrix_group_size(matrix_bits)
+        return header_carriers + groups * matrix_bits
+    return header_carriers + (carrier_bytes - header_carriers) * bits_per_channel
+
+
+def matrix_group_size(matrix_bits):
+    """Tells how many color bytes one matrix embedding group uses (2 ** matrix_bits - 1)."""
+    return (1 << matrix_bits) - 1
+
+
+def payload_bits_per_channel(full_data):
+    """Reads how many bits per color byte a payload asks for from its header.
+    
+    Args:
+        full_data (bytes): The payload header and message bytes.
+    
+    Returns:
+        int: Bits per color byte for the message part (1 if there is no header).
+    """
+    if len(full_data) < PAYLOAD_HEADER_SIZE or bytes(full_data[:len(PAYLOAD_MAGIC)]) != PAYLOAD_MAGIC:
+        return 1
+    flags = full_data[len(PAYLOAD_MAGIC) + 1]
+    return (flags & FLAG_BITS_PER_CHANNEL) + 1
+
+
+def payload_matrix_bits(full_data):
+    """Reads the matrix embedding group bits a payload asks for from its header.
+    
+    Args:
+        full_data (bytes): The payload header and message bytes (or just the header).
+    
+    Returns:
+        int: Message bits per group of color bytes (0 if matrix embedding isn't used).
+    """
+    if len(full_data) < PAYLOAD_HEADER_SIZE or bytes(full_data[:len(PAYLOAD_MAGIC)]) != PAYLOAD_MAGIC:
+        return 0
+    flags = full_data[len(PAYLOAD_MAGIC) + 1]
+    return (flags & FLAG_MATRIX) >> FLAG_MATRIX_SHIFT
+
+
+def count_carriers_needed(full_data):
+    """Works out how many color bytes a payload will change.
+    
+    Args:
+        full_data (bytes): The payload header and message bytes.
+    
+    Returns:
+        int: The number of color bytes needed.
+    """
+    return count_carriers_for_size(len(full_data), payload_bits_per_channel(full_data),
+                                   payload_matrix_bits(full_data))
+
+
+def count_carriers_for_size(payload_size, bits_per_channel=1, matrix_bits=0):
+    """Works out how many color bytes a payload of a given size will change.
+    
+    Args:
+        payload_size (int): Size of the payload header and message in bytes.
+        bits_per_channel (int): Bits per color byte for the message part.
+        matrix_bits (int): Bits per group with matrix embedding (0 = not used).
+    
+    Returns:
+        int: The number of color bytes needed.
+    """
+    if matrix_bits:
+        # The header at 1 bit per byte, then one group of color bytes for
+        # every matrix_bits message bits (the last group may be only partly used)
+        groups = -(-(payload_size - PAYLOAD_HEADER_SIZE) * 8 // matrix_bits)
+        return PAYLOAD_HEADER_SIZE * 8 + groups * matrix_group_size(matrix_bits)
+    
+    if bits_per_channel == 1:
+        return payload_size * 8
+    
+    # 1 bit per byte for the header, then bits_per_channel for the message
+    # (rounded up, so the last color byte may only be partly used)
+    message_bits = (payload_size - PAYLOAD_HEADER_SIZE) * 8
+    return PAYLOAD_HEADER_SIZE * 8 + -(-message_bits // bits_per_channel)
+
+
+def build_payload_header(message_bytes, flags=0):
+    """Builds the header that goes in front of a hidden message.
+    
+    Args:
+        message_bytes (bytes): The message bytes that will follow the header.
+        flags (int): Options used when hiding the message.
+    
+    Returns:
+        bytes: The packed header.
+    """
+    return pack_payload_header(len(message_bytes), zlib.crc32(message_bytes), flags)
+
+
+def pack_payload_header(message_length, checksum, flags=0):
+    """Packs the payload header fields.
+    
+    Args:
+        message_length (int): How many message bytes follow the header.
+        checksum (int): CRC-32 of those bytes.
+        flags (int): Options used when hiding the message.
+    
+    Returns:
+        bytes: The packed header.
+    """
+    return struct.pack(
+        PAYLOAD_HEADER_FORMAT,
+        PAYLOAD_MAGIC,
+        PAYLOAD_FORMAT_VERSION,
+        flags,
+        message_length,
+        checksum,
+    )
+
+
+def encode_message_text(secret_message):
+    """Turns a text message into the UTF-8 bytes we hide.
+    
+    Args:
+        secret_message (str or bytes): The secret message. Bytes are used as they are.
+    
+    Returns:
+        bytes: The message bytes.
+    
+    Raises:
+        MessageError: If the text has characters that can't be stored.
+    """
+    # Text becomes UTF-8 bytes, so every character (not just the first 256)
+    # survives the trip
+    if isinstance(secret_message, str):
+        try:
+            return secret_message.encode('utf-8')
+        except UnicodeEncodeError:
+            raise MessageError("Invalid character in message. Please use standard text characters.") from None
+    return secret_message
+
+
+def compress_message(message_bytes, compression='none'):
+    """Compresses a message, if that makes it smaller.
+    
+    Args:
+        message_bytes (bytes): The message bytes.
+        compression (str): 'none', 'zlib', 'lzma' or 'auto' (try both, keep the smallest).
+    
+    Returns:
+        tuple: (stored bytes, name of the method used). The method is 'none'
+        when compressing didn't help.
+    
+    Raises:
+        ValueError: If the compression method is unknown.
+    """
+    if compression not in COMPRESSION_CHOICES:
+        raise ValueError(f"Unknown compression method: {compression}")
+    
+    if compression == 'auto':
+        methods = ['zlib', 'lzma']
+    elif compression == 'none':
+        methods = []
+    else:
+        methods = [compression]
+    
+    # Start with the message as it is and only switch to a compressed
+    # version when it really is smaller (short or random messages often grow)
+    best_bytes = message_bytes
+    best_method = 'none'
+    for method in methods:
+        if method == 'zlib':
+            compressed = zlib.compress(message_bytes, 9)
+        else:
+            import lzma
+            
+            # The 'alone' format has a much smaller header than the usual .xz one
+            compressed = lzma.compress(message_bytes, format=lzma.FORMAT_ALONE)
+        if len(compressed) < len(best_bytes):
+            best_bytes = compressed
+            best_method = method
+    
+    return best_bytes, best_method
+
+
+def convert_message_to_binary(secret_message, bits_per_channel=1, compression='none', matrix_bits=0):
+    """Converts a message to the bytes we hide in the image, with a header.
+    
+    Args:
+        secret_message (str or bytes): The secret message. Text is stored as UTF-8.
+        bits_per_channel (int): How many bits to store in each color byte (1 to 4).
+        compression (str): 'none', 'zlib', 'lzma' or 'auto'. The message is only
+            stored compressed when that makes it smaller.
+        matrix_bits (int): Hide the message with matrix embedding, this many
+            bits per group of color bytes (2 to 7), or 0 for plain LSB.
+    
+    Returns:
+        bytes: The payload header followed by the (possibly compressed) message bytes.
+    
+    Raises:
+        MessageError: If the message can't be stored.
+        ValueError: If bits_per_channel, compression or matrix_bits is out of range.
+    """
+    check_bits_per_channel(bits_per_channel, matrix_bits)
+    
+    secret_message = encode_message_text(secret_message)
+    
+    # Shrink the message first so it needs fewer pixels
+    secret_message, method = compress_message(bytes(secret_message), compression)
+    
+    # The 4-byte length field limits how big a message can be
+    if len(secret_message) > 0xFFFFFFFF:
+        raise MessageError("The message is too long. Messages can be at most 4 GB.")
+    
+    # Put the header in front so the decoder knows exactly how much to read
+    flags = make_payload_flags(bits_per_channel, method, matrix_bits)
+    return build_payload_header(secret_message, flags) + secret_message
+
+
+def check_bits_per_channel(bits_per_channel, matrix_bits=0):
+    """Makes sure the number of bits per color byte (and matrix bits) is one we can store.
+    
+    Raises:
+        ValueError: If bits_per_channel or matrix_bits is out of range.
+    """
+    if bits_per_channel < 1 or bits_per_channel > MAX_BITS_PER_CHANNEL:
+        raise ValueError(f"bits_per_channel must be between 1 and {MAX_BITS_PER_CHANNEL}")
+    if matrix_bits and (matrix_bits < MIN_MATRIX_BITS or matrix_bits > MAX_MATRIX_BITS):
+        raise ValueError(f"matrix_bits must be 0 or between {MIN_MATRIX_BITS} and {MAX_MATRIX_BITS}")
+    if matrix_bits and bits_per_channel != 1:
+        raise ValueError("Matrix embedding only changes the last bit of each color byte (bits_per_channel must be 1)")
+
+
+def make_payload_flags(bits_per_channel, method, matrix_bits=0):
+    """Packs the options used to hide a message into the header flags.
+    
+    Args:
+        bits_per_channel (int): Bits per color byte for the message part.
+        method (str): The compression method that was used ('none', 'zlib' or 'lzma').
+        matrix_bits (int): Bits per group with matrix embedding (0 = not used).
+    
+    Returns:
+        int: The flags byte.
+    """
+    return ((bits_per_channel - 1) | (COMPRESSION_METHODS[method] << FLAG_COMPRESSION_SHIFT)
+            | (matrix_bits << FLAG_MATRIX_SHIFT))
+
+
+def iter_file_chunks(message_file, chunk_size=MESSAGE_READ_SIZE, start=0, length=None):
+    """Reads a file (or part of it), one chunk at a time.
+    
+    Every chunk except the last is exactly chunk_size bytes long.
+    
+    Args:
+        message_file (file): A file opened for reading bytes.
+        chunk_size (int): How many bytes to read at a time.
+        start (int): Where in the file to start reading.
+        length (int): How many bytes to read at most (None = up to the end).
+    
+    Yields:
+        bytes: The next chunk of the file.
+    
+    Raises:
+        MessageError: If the file can't be read.
+    """
+    try:
+        message_file.seek(start)
+        bytes_left = length
+        while bytes_left is None or bytes_left > 0:
+            wanted = chunk_size if bytes_left is None else min(chunk_size, bytes_left)
+            chunk = message_file.read(wanted)
+            if not chunk:
+                return
+            
+            # A read can come back short before the end of the file (pipes
+            # do that), so keep reading until the chunk is full
+            while len(chunk) < wanted:
+                more = message_file.read(wanted - len(chunk))
+                if not more:
+                    break
+                chunk = chunk + more
+            
+            if bytes_left is not None:
+                bytes_left = bytes_left - len(chunk)
+            yield chunk
+    except OSError as e:
+        raise MessageError(f"Could not read the message file. {str(e)}") from e
+
+
+def compress_message_file(message_file, compression='none'):
+    """Compresses a file into a temporary file, if that makes it smaller.
+    
+    Works like compress_message(), but a chunk at a time, so the file never
+    has to fit in memory.
+    
+    Args:
+        message_file (file): The file to compress, opened for reading bytes.
+        compression (str): 'none', 'zlib', 'lzma' or 'auto' (try both, keep the smallest).
+    
+    Returns:
+        tuple: (file holding the stored bytes, name of the method used). The
+        file is message_file itself when the method is 'none'; otherwise it is
+        a temporary file that is deleted when it is closed.
+    
+    Raises:
+        ValueError: If the compression method is unknown.
+        MessageError: If the file can't be read.
+    """
+    if compression not in COMPRESSION_CHOICES:
+        raise ValueError(f"Unknown compression method: {compression}")
+    
+    if compression == 'auto':
+        methods = ['zlib', 'lzma']
+    elif compression == 'none':
+        methods = []
+    else:
+        methods = [compression]
+    
+    best_file = message_file
+    best_method = 'none'
+    best_size = os.fstat(message_file.fileno()).st_size
+    for method in methods:
+        if method == 'zlib':
+            compressor = zlib.compressobj(9)
+        else:
+            import lzma
+            compressor = lzma.LZMACompressor(format=lzma.FORMAT_ALONE)
+        
+        import tempfile
+        compressed_file = tempfile.TemporaryFile()
+        for chunk in iter_file_chunks(message_file):
+            compressed_file.write(compressor.compress(chunk))
+        compressed_file.write(compressor.flush())
+        
+        # Only keep the compressed version when it really is smaller
+        if compressed_file.tell() < best_size:
+            if best_file is not message_file:
+                best_file.close()
+            best_file = compressed_file
+            best_method = method
+            best_size = compressed_file.tell()
+        else:
+            compressed_file.close()
+    
+    return best_file, best_method
+
+
+def prepare_message_file(message_file, bits_per_channel=1, compression='none', matrix_bits=0):
+    """Gets a file ready to be hidden straight from disk.
+    
+    The file is read once to work out its length and checksum (and, if
+    asked, to compress it), so the payload header can be built before any
+    pixel is touched.
+    
+    Args:
+        message_file (file): The file to hide, opened for reading bytes.
+        bits_per_channel (int): How many bits to store in each color byte (1 to 4).
+        compression (str): 'none', 'zlib', 'lzma' or 'auto'.
+        matrix_bits (int): Use matrix embedding with this many bits per group (2 to 7), or 0 for plain LSB.
+    
+    Returns:
+        tuple: (payload header, file holding the message bytes to hide, payload size).
+        The payload size counts the header and the message.
+    
+    Raises:
+        MessageError: If the file can't be read or is too big.
+        ValueError: If bits_per_channel, compression or matrix_bits is out of range.
+    """
+    check_bits_per_channel(bits_per_channel, matrix_bits)
+    
+    # Shrink the message first so it needs fewer pixels
+    stored_file, method = compress_message_file(message_file, compression)
+    
+    # Work out the length and checksum of the bytes we will hide
+    message_length = 0
+    checksum = 0
+    for chunk in iter_file_chunks(stored_file):
+        message_length = message_length + len(chunk)
+        checksum = zlib.crc32(chunk, checksum)
+    
+    # The 4-byte length field limits how big a message can be
+    if message_length > 0xFFFFFFFF:
+        if stored_file is not message_file:
+            stored_file.close()
+        raise MessageError("The message is too long. Messages can be at most 4 GB.")
+    
+    payload_header = pack_payload_header(message_length, checksum,
+                                         make_payload_flags(bits_per_channel, method, matrix_bits))
+    return payload_header, stored_file, PAYLOAD_HEADER_SIZE + message_length
+
+
+def iter_payload_blocks(payload_header, message_chunks, bits_per_channel=1):
+    """Unpacks a payload header and a message that arrives in chunks into color byte values.
+    
+    Gives exactly the same blocks as iter_carrier_blocks() would for the
+    header and the whole message together, but only about one block of the
+    message is ever in memory.
+    
+    Args:
+        payload_header (bytes): The payload header (from prepare_message_file()).
+        message_chunks (iterable): The message bytes to hide, in chunks of any size.
+        bits_per_channel (int): Bits per color byte for the message part.
+    
+    Yields:
+        tuple: (index of the first color byte, values for the block, bits per color byte).
+    """
+    yield from iter_carrier_blocks(payload_header, 0, bits_per_channel)
+    
+    # The message is passed on in whole blocks, so every block starts on a
+    # color byte boundary whatever the number of bits per color byte
+    first_byte = PAYLOAD_HEADER_SIZE
+    for piece in iter_whole_blocks(message_chunks, MESSAGE_READ_SIZE):
+        yield from iter_carrier_blocks(piece, first_byte, bits_per_channel)
+        first_byte = first_byte + len(piece)
+
+
+def iter_whole_blocks(message_chunks, block_size):
+    """Regroups chunks of any size into pieces that are a whole number of blocks long.
+    
+    Bytes that don't fill a block yet wait for the next chunk. Only the
+    last piece can be shorter.
+    
+    Args:
+        message_chunks (iterable): The message bytes, in chunks of any size.
+        block_size (int): Every piece but the last is a multiple of this many bytes.
+    
+    Yields:
+        bytes or memoryview: The next piece of the message.
+    """
+    waiting = b''
+    for chunk in message_chunks:
+        if waiting:
+            chunk = waiting + chunk
+        usable = len(chunk) - (len(chunk) % block_size)
+        if usable:
+            yield memoryview(chunk)[:usable]
+        waiting = bytes(chunk[usable:])
+    
+    if waiting:
+        yield waiting
+
+
+def unpack_bits(data):
+    """Turns bytes into one byte per bit (each 0 or 1), most significant bit first.
+    
+    Args:
+        data (bytes or memoryview): The bytes to unpack.
+    
+    Returns:
+        bytes: Eight bit values for every input byte.
+    """
+    if not data:
+        return b''
+    
+    # Read the bytes as one big number and write it out in binary with
+    # leading zeros, then turn the '0'/'1' characters into 0/1 values
+    bit_chars = format(int.from_bytes(data, 'big'), f'0{len(data) * 8}b')
+    return bit_chars.encode('ascii').translate(BIT_CHARS_TO_VALUES)
+
+
+def unpack_carrier_values(data, bits_per_channel=1):
+    """Turns bytes into the values to store in each color byte.
+    
+    Args:
+        data (bytes or memoryview): The bytes to unpack.
+        bits_per_channel (int): How many bits go in each color byte.
+    
+    Returns:
+        bytes: One value per color byte, each below 2 ** bits_per_channel.
+    """
+    bit_values = unpack_bits(data)
+    if bits_per_channel == 1:
+        return bit_values
+    
+    # Pad with zeros so the bits split evenly into groups
+    bit_values = bit_values + bytes(-len(bit_values) % bits_per_channel)
+    
+    # Take the first, second, ... bit of every group as a strided slice, move
+    # it to its place in the value and OR the slices together (as big numbers,
+    # since the bits never overlap)
+    combined = 0
+    for position in range(bits_per_channel):
+        shift = bits_per_channel - 1 - position
+        shifted = bit_values[position::bits_per_channel].translate(SHIFT_BIT_TABLES[shift])
+        combined = combined | int.from_bytes(shifted, 'big')
+    return combined.to_bytes(len(bit_values) // bits_per_channel, 'big')
+
+
+def iter_carrier_blocks(full_data, first_byte=0, bits_per_channel=None):
+    """Unpacks the payload into color byte values one block at a time.
+    
+    Args:
+        full_data (bytes or memoryview): The payload header and message bytes,
+            or a shard of them cut out by plan_shards().
+        first_byte (int): Where in the whole payload full_data starts.
+        bits_per_channel (int): Bits per color byte for the message part. Read
+            from the payload header when not given (a shard has no header).
+    
+    Yields:
+        tuple: (index of the first color byte, values for the block, bits per color byte).
+    """
+    payload = memoryview(full_data)
+    if bits_per_channel is None:
+        bits_per_channel = payload_bits_per_channel(full_data)
+    end = first_byte + len(payload)
+    
+    # The header always goes in at 1 bit per color byte. The message follows
+    # at however many bits per color byte the header asks for. Each section
+    # is (first payload byte, end of the section, bits per color byte).
+    if bits_per_channel == 1:
+        sections = [(0, end, 1)]
+    else:
+        sections = [(0, PAYLOAD_HEADER_SIZE, 1), (PAYLOAD_HEADER_SIZE, end, bits_per_channel)]
+    
+    for section_start, section_end, section_bits in sections:
+        start = max(section_start, first_byte)
+        stop = min(section_end, end)
+        for block_start in range(start, stop, EMBED_BLOCK_SIZE):
+            block = payload[block_start - first_byte:min(block_start + EMBED_BLOCK_SIZE, stop) - first_byte]
+            block_first_carrier = section_start * 8 + ((block_start - section_start) * 8) // section_bits
+            yield block_first_carrier, unpack_carrier_values(block, section_bits), section_bits
+
+
+def matrix_block_size(matrix_bits):
+    """Tells how many payload bytes go in one block with matrix embedding.
+    
+    Every block is a whole number of groups, so the next block starts on a
+    group boundary.
+    """
+    return (EMBED_BLOCK_SIZE // matrix_bits) * matrix_bits
+
+
+def matrix_syndromes(carrier_bytes, matrix_bits):
+    """Reads the value hidden in every group of color bytes with matrix embedding.
+    
+    The value of a group is the XOR of the positions (1, 2, 3, ...) of the
+    color bytes in it whose last bit is 1.
+    
+    Args:
+        carrier_bytes (bytes): Color bytes, a whole number of groups long.
+        matrix_bits (int): Message bits per group.
+    
+    Returns:
+        bytes: One value per group, each below 2 ** matrix_bits.
+    """
+    group_size = matrix_group_size(matrix_bits)
+    carrier_bytes = bytes(carrier_bytes)
+    
+    # Take the first, second, ... color byte of every group as a strided
+    # slice, turn each byte into its position (or 0) and XOR the slices
+    # together as big numbers. The values never need more than one byte, so
+    # this is the same as XOR-ing every group on its own.
+    combined = 0
+    for position in range(1, group_size + 1):
+        positions = carrier_bytes[position - 1::group_size].translate(MATRIX_POSITION_TABLES[position])
+        combined = combined ^ int.from_bytes(positions, 'big')
+    return combined.to_bytes(len(carrier_bytes) // group_size, 'big')
+
+
+def matrix_embed(carrier_bytes, values, matrix_bits):
+    """Works out the new last bits of color bytes so every group holds its value.
+    
+    At most one color byte changes in every group: the one whose position
+    is the XOR of the value the group holds now and the one it should hold.
+    
+    Args:
+        carrier_bytes (bytes): Color bytes, one group for every value.
+        values (bytes): The value to hide in each group.
+        matrix_bits (int): Message bits per group.
+    
+    Returns:
+        bytes: The new last bit (0 or 1) of every color byte.
+    """
+    group_size = matrix_group_size(matrix_bits)
+    carrier_bytes = bytes(carrier_bytes)
+    
+    # Which position has to change in every group (0 = nothing to change)
+    changes = (int.from_bytes(matrix_syndromes(carrier_bytes, matrix_bits), 'big')
+               ^ int.from_bytes(values, 'big')).to_bytes(len(values), 'big')
+    
+    # Mark the byte to flip in every group, one position at a time
+    flips = bytearray(len(carrier_bytes))
+    for position in range(1, group_size + 1):
+        flips[position - 1::group_size] = changes.translate(MATRIX_SELECT_TABLES[position])
+    
+    last_bits = carrier_bytes.translate(LAST_BIT_TABLE)
+    return (int.from_bytes(last_bits, 'big') ^ int.from_bytes(flips, 'big')).to_bytes(len(carrier_bytes), 'big')
+
+
+def iter_matrix_blocks(img_bytes, header_info, data, first_byte, matrix_bits):
+    """Works out blocks of color byte values that hide message bytes with matrix embedding.
+    
+    Unlike iter_carrier_blocks(), the new values depend on the color bytes
+    already in the image, so every block reads its color bytes first. The
+    blocks go to write_blocks_24bit() or write_blocks_32bit() as usual.
+    
+    Args:
+        img_bytes (bytearray or mmap.mmap): The image file bytes.
+        header_info (BmpLayout): The image layout from read_bmp_header().
+        data (bytes or memoryview): Message bytes (never the payload header).
+        first_byte (int): Where in the whole payload data starts. The message
+            bits before it must fill whole groups.
+        matrix_bits (int): Message bits per group.
+    
+    Yields:
+        tuple: (index of the first color byte, values for the block, 1).
+    """
+    data = memoryview(data)
+    group_size = matrix_group_size(matrix_bits)
+    block_size = matrix_block_size(matrix_bits)
+    
+    for block_start in range(0, len(data), block_size):
+        block = data[block_start:block_start + block_size]
+        
+        # The values to hide (the last group is padded with zero bits)
+        values = unpack_carrier_values(block, matrix_bits)
+        group = ((first_byte + block_start - PAYLOAD_HEADER_SIZE) * 8) // matrix_bits
+        first_carrier = PAYLOAD_HEADER_SIZE * 8 + group * group_size
+        
+        carrier_bytes = gather_carrier_bytes(img_bytes, header_info, first_carrier, len(values) * group_size)
+        yield first_carrier, matrix_embed(carrier_bytes, values, matrix_bits), 1
+
+
+def embed_bits_in_bytes(carrier_bytes, bit_values, bits_per_channel=1):
+    """Hides bits in the last bits of every byte of a run, all at once.
+    
+    Args:
+        carrier_bytes (bytes): The image bytes that will carry the bits.
+        bit_values (bytes): One value per carrier byte (same length as carrier_bytes).
+        bits_per_channel (int): How many of the last bits of each byte to replace.
+    
+    Returns:
+        bytes: The carrier bytes with their last bits replaced by bit_values.
+    """
+    # Clear the last bits of every byte with a single table lookup pass
+    cleared_bytes = bytes(carrier_bytes).translate(CLEAR_LOW_BITS_TABLES[bits_per_channel])
+    
+    # Treat both runs as big numbers and OR them together. Every cleared byte
+    # ends in zeros and every value fits in those bits, so no byte can spill
+    # into its neighbour and this is the same as OR-ing each byte pair on its own.
+    combined = int.from_bytes(cleared_bytes, 'big') | int.from_bytes(bit_values, 'big')
+    return combined.to_bytes(len(cleared_bytes), 'big')
+
+
+def check_message_fits(image_size, full_data, header_info):
+    """Makes sure the whole payload fits in the image before anything is written.
+    
+    Args:
+        image_size (int): Size of the image file in bytes.
+        full_data (bytes): The payload header and message bytes.
+        header_info (BmpLayout): The image layout from read_bmp_header().
+    
+    Returns:
+        int: The number of color bytes the payload will change.
+    
+    Raises:
+        MessageTooLongError: If the message doesn't fit in the image.
+        InvalidImageError: If the file is shorter than its header says.
+    """
+    return check_payload_fits(image_size, len(full_data), payload_bits_per_channel(full_data), header_info,
+                              payload_matrix_bits(full_data))
+
+
+def check_payload_fits(image_size, payload_size, bits_per_channel, header_info, matrix_bits=0):
+    """Makes sure a payload of a given size fits in the image.
+    
+    Args:
+        image_size (int): Size of the image file in bytes.
+        payload_size (int): Size of the payload header and message in bytes.
+        bits_per_channel (int): Bits per color byte for the message part.
+        header_info (BmpLayout): The image layout from read_bmp_header().
+        matrix_bits (int): Bits per group with matrix embedding (0 = not used).
+    
+    Returns:
+        int: The number of color bytes the payload will change.
+    
+    Raises:
+        MessageTooLongError: If the message doesn't fit in the image.
+        InvalidImageError: If the file is shorter than its header says.
+    """
+    # Each pixel has 3 color bytes, and we can hide 1 bit (or more, if the
+    # header asks for it) in each byte
+    available_bits = count_available_bits(header_info, bits_per_channel, matrix_bits)
+    
+    # Check if our message will fit (every message byte needs 8 bits)
+    message_length = payload_size * 8
+    if message_length > available_bits:
+        raise MessageTooLongError(message_length, available_bits)
+    
+    # Make sure we don't go past the end of the file
+    carriers_needed = count_carriers_for_size(payload_size, bits_per_channel, matrix_bits)
+    if carriers_needed > 0 and header_info.carrier_end(carriers_needed) > image_size:
+        raise InvalidImageError("Attempted to write beyond file size. Image may be corrupted.")
+    
+    return carriers_needed
+
+
+def write_blocks_24bit(img_bytes, carrier_blocks, header_info):
+    """Hides blocks of color byte values in a 24-bit BMP image.
+    
+    Args:
+        img_bytes (bytearray or mmap.mmap): The image file bytes (will be modified).
+        carrier_blocks (iterable): Blocks from iter_carrier_blocks().
+        header_info (BmpLayout): The image layout from read_bmp_header().
+    """
+    for first_carrier, values, bits_per_channel in carrier_blocks:
+        # Work out which runs of bytes carry this block's values
+        runs = carrier_runs(header_info, first_carrier, len(values))
+        
+        # Gather the carrier bytes of every run, hide all the bits in one go,
+        # then put each run back where it came from
+        carrier_bytes = b''.join(img_bytes[start:start + length] for start, length in runs)
+        new_bytes = embed_bits_in_bytes(carrier_bytes, values, bits_per_channel)
+        
+        position = 0
+        for start, length in runs:
+            img_bytes[start:start + length] = new_bytes[position:position + length]
+            position = position + length
+
+
+def carrier_runs(header_info, first_carrier, carrier_count):
+    """Works out where a range of color bytes sits in a 24-bit BMP image.
+    
+    Args:
+        header_info (BmpLayout): The image layout from read_bmp_header().
+        first_carrier (int): Index of the first color byte.
+        carrier_count (int): How many color bytes.
+    
+    Returns:
+        list: (file offset, length) for every run of color bytes in a row.
+    """
+    pixel_data_offset = header_info.pixel_data_offset
+    bytes_per_row = header_info.bytes_per_row
+    run_length = header_info.run_length
+    
+    runs = []
+    carrier = first_carrier
+    carriers_left = carrier_count
+    while carriers_left > 0:
+        row = carrier // run_length
+        column = carrier % run_length
+        length = min(run_length - column, carriers_left)
+        runs.append((pixel_data_offset + (row * bytes_per_row) + column, length))
+        carrier = carrier + length
+        carriers_left = carriers_left - length
+    return runs
+
+
+def gather_carrier_bytes(img_bytes, header_info, first_carrier, carrier_count):
+    """Reads a range of color bytes from a 24-bit or 32-bit BMP image, in order.
+    
+    Args:
+        img_bytes (bytearray or mmap.mmap): The image file bytes.
+        header_info (BmpLayout): The image layout from read_bmp_header().
+        first_carrier (int): Index of the first color byte.
+        carrier_count (int): How many color bytes.
+    
+    Returns:
+        bytes: The color bytes, with row padding and Alpha bytes left out.
+    """
+    if header_info.carrier_order is not None:
+        return header_info.carrier_order.gather(img_bytes, first_carrier, carrier_count)
+    
+    if header_info.bits_per_pixel == 24:
+        return b''.join(img_bytes[start:start + length]
+                        for start, length in carrier_runs(header_info, first_carrier, carrier_count))
+    
+    # In a 32-bit image take each color channel as a strided slice and
+    # weave them together in pixel order
+    carrier_bytes = bytearray(carrier_count)
+    for channel, channel_offset in enumerate(header_info.channel_offsets):
+        skip = (channel - first_carrier) % 3
+        if skip >= carrier_count:
+            continue
+        first = first_carrier + skip
+        count = len(range(skip, carrier_count, 3))
+        start = header_info.pixel_data_offset + (first // 3) * 4 + channel_offset
+        carrier_bytes[skip::3] = img_bytes[start:start + count * 4:4]
+    return bytes(carrier_bytes)
+
+
+def write_blocks_32bit(img_bytes, carrier_blocks, header_info):
+    """Hides blocks of color byte values in a 32-bit BMP image.
+    
+    Args:
+        img_bytes (bytearray or mmap.mmap): The image file bytes (will be modified).
+        carrier_blocks (iterable): Blocks from iter_carrier_blocks().
+        header_info (BmpLayout): The image layout from read_bmp_header().
+    """
+    pixel_data_offset = header_info.pixel_data_offset
+    
+    for first_carrier, values, bits_per_channel in carrier_blocks:
+        # Handle each color channel as a strided slice: every 4th byte starting
+        # at Blue (0), Green (1) or Red (2). The Alpha byte is never part of a slice.
+        for channel, channel_offset in enumerate(header_info.channel_offsets):
+            # Find the first color byte of this block in this channel; from
+            # there every 3rd value belongs to the channel
+            first = first_carrier + ((channel - first_carrier) % 3)
+            channel_values = values[first - first_carrier::3]
+            if not channel_values:
+                continue
+            
+            start = pixel_data_offset + (first // 3) * 4 + channel_offset
+            stop = start + len(channel_values) * 4
+            img_bytes[start:stop:4] = embed_bits_in_bytes(img_bytes[start:stop:4], channel_values, bits_per_channel)
+
+
+def write_blocks_scattered(img_bytes, carrier_blocks, header_info):
+    """Hides blocks of color byte values in the pixels picked by a key.
+    
+    Args:
+        img_bytes (bytearray or mmap.mmap): The image file bytes (will be modified).
+        carrier_blocks (iterable): Blocks from iter_carrier_blocks().
+        header_info (BmpLayout): The image layout, with a key applied (see scatter.apply_key()).
+    """
+    carrier_order = header_info.carrier_order
+    
+    for first_carrier, values, bits_per_channel in carrier_blocks:
+        # Work out where the key puts the segments of this block and read them all
+        first_segment, segment_count, skip = carrier_order.segment_range(first_carrier, len(values))
+        starts = carrier_order.segment_starts(first_segment, segment_count)
+        pixel_bytes = carrier_order.read_segments(img_bytes, starts)
+        
+        # Hide all the bits in one go, then put each segment back where it came from
+        color_bytes = carrier_order.take_colors(pixel_bytes)
+        stop = skip + len(values)
+        color_bytes[skip:stop] = embed_bits_in_bytes(color_bytes[skip:stop], values, bits_per_channel)
+        carrier_order.put_colors(pixel_bytes, color_bytes)
+        carrier_order.write_segments(img_bytes, starts, pixel_bytes)
+
+
+def write_blocks_to_file(img_file, carrier_blocks, header_info, write_blocks):
+    """Hides blocks of color byte values in an image file, one range at a time.
+    
+    For every block the pixels it covers are read into a PixelWindow, changed
+    there by the usual block writer and written back with a single write.
+    Nothing else in the file is read or written.
+    
+    Args:
+        img_file (ImageFileWriter): The opened image file.
+        carrier_blocks (iterable): Blocks from iter_carrier_blocks().
+        header_info (BmpLayout): The image layout from read_bmp_header().
+        write_blocks (function): write_blocks_24bit or write_blocks_32bit.
+    """
+    for block in carrier_blocks:
+        first_carrier, values, _ = block
+        if not values:
+            continue
+        start, stop = header_info.carrier_span(first_carrier, len(values))
+        window = PixelWindow(img_file.read_range(start, stop), start)
+        write_blocks(window, [block], header_info)
+        img_file.write_range(start, window.data)
+
+
+def encode_24bit(img_bytes, full_data, header_info):
+    """Encodes a message into a 24-bit BMP image using LSB steganography.
+    
+    Args:
+        img_bytes (bytearray): The image file bytes (will be modified).
+        full_data (bytes): The payload header and message bytes.
+        header_info (BmpLayout): The image layout from read_bmp_header().
+    
+    Returns:
+        bool: True if successful.
+    
+    Raises:
+        MessageTooLongError: If the message doesn't fit in the image.
+        InvalidImageError: If the file is shorter than its header says.
+    """
+    # Check the message fits, then hide it one block at a time
+    check_message_fits(len(img_bytes), full_data, header_info)
+    write_payload(img_bytes, full_data, header_info, write_blocks_24bit)
+    return True
+
+
+def encode_32bit(img_bytes, full_data, header_info):
+    """Encodes a message into a 32-bit BMP image using LSB steganography.
+    
+    In a 32-bit image, each pixel has 4 bytes: Blue, Green, Red, and Alpha.
+    We skip the Alpha channel and only use Blue, Green, and Red.
+    
+    Args:
+        img_bytes (bytearray): The image file bytes (will be modified).
+        full_data (bytes): The payload header and message bytes.
+        header_info (BmpLayout): The image layout from read_bmp_header().
+    
+    Returns:
+        bool: True if successful.
+    
+    Raises:
+        MessageTooLongError: If the message doesn't fit in the image.
+        InvalidImageError: If the file is shorter than its header says.
+    """
+    # Check the message fits, then hide it one block at a time
+    check_message_fits(len(img_bytes), full_data, header_info)
+    write_payload(img_bytes, full_data, header_info, write_blocks_32bit)
+    return True
+
+
+def write_payload(img_bytes, full_data, header_info, write_blocks):
+    """Hides the whole payload with write_blocks_24bit() or write_blocks_32bit().
+    
+    Args:
+        img_bytes (bytearray, mmap.mmap or ImageFileWriter): The image file bytes (will be modified).
+            With a key it can't be an ImageFileWriter (see open_embed_target()).
+        full_data (bytes): The payload header and message bytes.
+        header_info (BmpLayout): The image layout from read_bmp_header().
+        write_blocks (function): The block writer for this bit depth.
+    """
+    if header_info.carrier_order is not None:
+        # With a key the color bytes are spread over the whole image
+        write_blocks = write_blocks_scattered
+    elif isinstance(img_bytes, ImageFileWriter):
+        # Straight to a file, a range at a time
+        write_blocks = partial(write_blocks_to_file, write_blocks=write_blocks)
+    
+    matrix_bits = payload_matrix_bits(full_data)
+    if not matrix_bits:
+        write_blocks(img_bytes, iter_carrier_blocks(full_data), header_info)
+        return
+    
+    # With matrix embedding only the message part uses groups; the header is
+    # hidden the plain way so it can always be found
+    payload = memoryview(full_data)
+    write_blocks(img_bytes, iter_carrier_blocks(payload[:PAYLOAD_HEADER_SIZE], 0, 1), header_info)
+    write_blocks(img_bytes, iter_matrix_blocks(img_bytes, header_info, payload[PAYLOAD_HEADER_SIZE:],
+                                               PAYLOAD_HEADER_SIZE, matrix_bits), header_info)
+
+
+def plan_shards(full_data, jobs):
+    """Cuts the payload into one piece per worker for encode_parallel().
+    
+    Every cut is on a block boundary of the message part, so a shard never
+    splits a color byte between two workers, and each shard covers its own
+    run of rows in the image.
+    
+    Args:
+        full_data (bytes): The payload header and message bytes.
+        jobs (int): How many workers will share the work.
+    
+    Returns:
+        list: (first payload byte, end payload byte) for every shard.
+    """
+    blocks = -(-max(0, len(full_data) - PAYLOAD_HEADER_SIZE) // EMBED_BLOCK_SIZE)
+    blocks_per_shard = max(1, -(-blocks // jobs))
+    shard_size = blocks_per_shard * EMBED_BLOCK_SIZE
+    
+    # The first shard also takes the payload header
+    cuts = list(range(PAYLOAD_HEADER_SIZE, len(full_data), shard_size))
+    cuts[0] = 0
+    cuts.append(len(full_data))
+    return list(zip(cuts, cuts[1:]))
+
+
+def encode_shard(task):
+    """Hides one shard of the payload in the image file (runs in a worker process).
+    
+    The worker maps the file itself, so the pixels are shared through the
+    operating system's page cache and never copied between processes.
+    
+    Args:
+        task (tuple): (image path, header_info, shard bytes, first payload byte, bits per color byte).
+    """
+    image_file_path, header_info, shard, first_byte, bits_per_channel = task
+    write_blocks = choose_block_writer(header_info)
+    img_bytes = map_image_file(image_file_path, writable=True)
+    try:
+        write_blocks(img_bytes, iter_carrier_blocks(shard, first_byte, bits_per_channel), header_info)
+        img_bytes.flush()
+    finally:
+        img_bytes.close()
+
+
+def encode_parallel(image_file_path, full_data, header_info, jobs):
+    """Hides a message in an image file using several worker processes.
+    
+    The result is exactly the same as encode_24bit() or encode_32bit(): each
+    worker hides its own shard of the payload, and no two shards touch the
+    same color bytes.
+    
+    Args:
+        image_file_path (str): The image file to change.
+        full_data (bytes): The payload header and message bytes.
+        header_info (BmpLayout): The image layout from read_bmp_header().
+        jobs (int): How many worker processes to use.
+    
+    Raises:
+        MessageTooLongError: If the message doesn't fit in the image.
+        InvalidImageError: If the file is shorter than its header says.
+    """
+    check_message_fits(os.path.getsize(image_file_path), full_data, header_info)
+    
+    bits_per_channel = payload_bits_per_channel(full_data)
+    payload = memoryview(full_data)
+    tasks = [(image_file_path, header_info, bytes(payload[start:stop]), start, bits_per_channel)
+             for start, stop in plan_shards(full_data, jobs)]
+    
+    # Not worth starting processes for a single shard
+    if len(tasks) == 1:
+        encode_shard(tasks[0])
+        return
+    
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=min(jobs, len(tasks))) as executor:
+        # list() waits for every worker and passes on any error they raised
+        list(executor.map(encode_shard, tasks))
+
+
+def ask_output_path():
+    """Asks the user what to call the new image.
+    
+    Returns:
+        str: The path for the new image, always ending in .bmp.
+    """
+    # Ask the user what they want to name the new file
+    new_image_path = input("Please enter the filename for the new image with .bmp extension (e.g., secret.bmp): ")
+    
+    # Make sure it ends with .bmp (add it if the user forgot)
+    if not new_image_path.lower().endswith('.bmp'):
+        new_image_path = new_image_path + '.bmp'
+    
+    return new_image_path
+
+
+def save_encoded_image(image_file_path, new_image_path, full_data, header_info, encoder, jobs=1):
+    """Copies the image to its new name and hides the message in the copy.
+    
+    The copy is made by the operating system (see copy_file_contents()) and
+    only the pixels that hold the message are then read and written back,
+    so this works the same for small and very large images.
+    
+    Args:
+        image_file_path (str): Path to the original image.
+        new_image_path (str): Path for the new image.
+        full_data (bytes): The payload header and message bytes.
+        header_info (BmpLayout): The image layout from read_bmp_header().
+        encoder (function): encode_24bit or encode_32bit.
+        jobs (int): How many worker processes to hide the message with. Only
+            big messages without matrix embedding or a key are split up (see
+            PARALLEL_MIN_SIZE).
+    
+    Returns:
+        str: Path to the saved file.
+    
+    Raises:
+        ImageFileError: If the new image can't be written.
+        StegoError: If hiding the message fails (the copy is removed again).
+    """
+    copy_image_file(image_file_path, new_image_path)
+    
+    try:
+        with stage('embed') as record:
+            if (jobs > 1 and len(full_data) >= PARALLEL_MIN_SIZE and not payload_matrix_bits(full_data)
+                    and header_info.carrier_order is None):
+                # Big messages are shared out over several processes (matrix
+                # embedding reads the pixels it changes, so it stays in one).
+                # With a key every segment of pixels is read and written back
+                # whole, and the shards don't end on segment edges, so two
+                # workers could rewrite the same segment: keyed messages stay
+                # in one process too.
+                encode_parallel(new_image_path, full_data, header_info, jobs)
+            else:
+                # Hide the message straight in the copy, rewriting only the
+                # pixels that carry it
+                new_img_file = open_embed_target(new_image_path, header_info)
+                try:
+                    encoder(new_img_file, full_data, header_info)
+                    new_img_file.flush()  # Make sure the changes reach the disk
+                finally:
+                    new_img_file.close()
+            
+            # Every pixel byte from the first to the last one we changed was
+            # read and written back
+            carriers_needed = count_carriers_needed(full_data)
+            if carriers_needed > 0:
+                payload_end = header_info.carrier_end(carriers_needed)
+                record.bytes_read = record.bytes_written = payload_end - header_info.pixel_data_offset
+    except BaseException:
+        discard_image_copy(image_file_path, new_image_path)
+        raise
+    
+    return new_image_path
+
+
+def copy_image_file(image_file_path, new_image_path):
+    """Copies the original image to its new name, ready to hide a message in.
+    
+    If both names point at the same file nothing is copied and the message
+    is hidden in the image where it is.
+    
+    Raises:
+        ImageFileError: If the new image can't be written.
+    """
+    with stage('copy image') as record:
+        try:
+            if os.path.exists(new_image_path) and os.path.samefile(image_file_path, new_image_path):
+                return
+            with open(image_file_path, 'rb', buffering=0) as source_file:
+                with open(new_image_path, 'wb', buffering=0) as target_file:
+                    size = os.fstat(source_file.fileno()).st_size
+                    copy_file_contents(source_file, target_file, size)
+            record.bytes_read = record.bytes_written = size
+        except PermissionError:
+            raise ImageFileError(f"Permission denied. Cannot write to: {new_image_path}\n"
+                                 f"Please check file permissions or choose a different location.") from None
+        except OSError as e:
+            raise ImageFileError(f"Could not save the image file '{new_image_path}'. {str(e)}") from e
+
+
+def copy_file_contents(source_file, target_file, size):
+    """Copies a file inside the operating system, without passing it through Python.
+    
+    os.copy_file_range() is tried first: on some file systems (like NFS 4.2,
+    Btrfs or XFS) the copy then happens on the server or just shares the
+    blocks. Where it isn't supported os.sendfile() still copies inside the
+    kernel, and only if neither works is the file copied through a buffer.
+    
+    Args:
+        source_file (file): The file to copy, opened for reading bytes.
+        target_file (file): The new, empty file, opened for writing bytes.
+        size (int): How many bytes to copy.
+    
+    Returns:
+        str: How the file was copied ('copy_file_range', 'sendfile' or 'buffered').
+    """
+    source = source_file.fileno()
+    target = target_file.fileno()
+    copied = 0
+    
+    # Each way carries on from where the one before it stopped
+    for method in ('copy_file_range', 'sendfile'):
+        if not hasattr(os, method):
+            continue
+        try:
+            while copied < size:
+                if method == 'copy_file_range':
+                    sent = os.copy_file_range(source, target, size - copied, copied, copied)
+                else:
+                    os.lseek(target, copied, os.SEEK_SET)
+                    sent = os.sendfile(target, source, copied, size - copied)
+                if sent == 0:
+                    break
+                copied = copied + sent
+        except OSError as e:
+            # Not supported for these files - try the next way
+            if e.errno not in COPY_FALLBACK_ERRORS:
+                raise
+        if copied >= size:
+            return method
+    
+    import shutil
+    source_file.seek(copied)
+    target_file.seek(copied)
+    shutil.copyfileobj(source_file, target_file)
+    return 'buffered'
+
+
+def discard_image_copy(image_file_path, new_image_path):
+    """Removes a half-finished copy after hiding a message in it failed."""
+    # Never remove the original, when the message was hidden in place
+    if not os.path.samefile(image_file_path, new_image_path):
+        os.remove(new_image_path)
+
+
+def choose_encoder(header_info):
+    """Picks the right way to hide a message based on bit depth.
+    
+    Args:
+        header_info (BmpLayout): The image layout from read_bmp_header().
+    
+    Returns:
+        function: encode_24bit or encode_32bit.
+    
+    Raises:
+        UnsupportedImageError: If the image isn't 24-bit or 32-bit.
+    """
+    check_bits_per_pixel(header_info)
+    if header_info.bits_per_pixel == 24:
+        return encode_24bit
+    return encode_32bit
+
+
+def choose_block_writer(header_info):
+    """Picks the function that writes blocks of color byte values for this bit depth.
+    
+    Args:
+        header_info (BmpLayout): The image layout from read_bmp_header().
+    
+    Returns:
+        function: write_blocks_24bit or write_blocks_32bit, or
+        write_blocks_scattered when a key is used.
+    
+    Raises:
+        UnsupportedImageError: If the image isn't 24-bit or 32-bit.
+    """
+    check_bits_per_pixel(header_info)
+    if header_info.carrier_order is not None:
+        return write_blocks_scattered
+    if header_info.bits_per_pixel == 24:
+        return write_blocks_24bit
+    return write_blocks_32bit
+
+
+def read_carrier_layout(image_file_path, key=None):
+    """Checks a carrier image and reads its layout, without reading its pixels.
+    
+    Args:
+        image_file_path (str): Path to the BMP image that will carry the message.
+        key (str or bytes): Spread the message over the image in an order picked
+            by this secret key (see scatter.py), or None to hide it in order.
+    
+    Returns:
+        BmpLayout: The image layout.
+    
+    Raises:
+        StegoError: If the image can't be used.
+    """
+    with stage('read header') as record:
+        # Open the image file (read-only - the original is never changed)
+        img_bytes = map_image_file(image_file_path)
+        
+        try:
+            # Validate the BMP structure and read the header
+            validate_bmp_basic(img_bytes, image_file_path)
+            header_info = read_bmp_header(img_bytes)
+            validate_bmp_header(header_info, img_bytes)
+            record.bytes_read = header_info.pixel_data_offset
+        finally:
+            img_bytes.close()
+        
+        # Make sure we support this bit depth
+        check_bits_per_pixel(header_info)
+    
+    return apply_key(header_info, key)
+
+
+def prepare_encoding(image_file_path, secret_message, bits_per_channel=1, compression='none', matrix_bits=0,
+                     key=None):
+    """Checks an image and a message and gets them ready for hiding.
+    
+    Args:
+        image_file_path (str): Path to the BMP image that will carry the message.
+        secret_message (str or bytes): The secret message.
+        bits_per_channel (int): How many bits to hide in each color byte (1 to 4).
+        compression (str): How to compress the message ('none', 'zlib', 'lzma' or 'auto').
+        matrix_bits (int): Use matrix embedding with this many bits per group (2 to 7), or 0 for plain LSB.
+        key (str or bytes): Secret key that picks which color bytes hold the message, or None.
+    
+    Returns:
+        tuple: (full_data, header_info, encoder) ready for save_encoded_image().
+    
+    Raises:
+        StegoError: If the image or the message can't be used.
+    """
+    header_info = read_carrier_layout(image_file_path, key)
+    
+    # Pick the right way to hide the message based on bit depth
+    encoder = choose_encoder(header_info)
+    
+    # Convert the secret message to binary
+    with stage('convert message') as record:
+        full_data = convert_message_to_binary(secret_message, bits_per_channel, compression, matrix_bits)
+        record.bytes_read = len(secret_message)
+        record.bytes_written = len(full_data)
+    
+    # Make sure the message fits before we copy anything
+    message_length = len(full_data) * 8
+    available_bits = count_available_bits(header_info, bits_per_channel, matrix_bits)
+    if message_length > available_bits:
+        raise MessageTooLongError(message_length, available_bits)
+    
+    return full_data, header_info, encoder
+
+
+def encode_file(image_file_path, new_image_path, secret_message, bits_per_channel=1, compression='none', jobs=1,
+                matrix_bits=0, key=None):
+    """Hides a message in a copy of a BMP image without asking any questions.
+    
+    Args:
+        image_file_path (str): Path to the original image.
+        new_image_path (str): Path for the new image.
+        secret_message (str or bytes): The secret message.
+        bits_per_channel (int): How many bits to hide in each color byte (1 to 4).
+        compression (str): How to compress the message ('none', 'zlib', 'lzma' or 'auto').
+        jobs (int): How many worker processes to hide a big message with.
+        matrix_bits (int): Use matrix embedding with this many bits per group (2 to 7), or 0 for plain LSB.
+        key (str or bytes): Secret key that picks which color bytes hold the message, or None.
+    
+    Returns:
+        str: Path to the saved file.
+    
+    Raises:
+        StegoError: If the message can't be hidden.
+    """
+    full_data, header_info, encoder = prepare_encoding(image_file_path, secret_message, bits_per_channel, compression,
+                                                       matrix_bits, key)
+    return save_encoded_image(image_file_path, new_image_path, full_data, header_info, encoder, jobs)
+
+
+def encode_message_file(image_file_path, new_image_path, message_file_path, bits_per_channel=1, compression='none',
+                        matrix_bits=0, key=None):
+    """Hides a whole file (of any kind) in a copy of a BMP image.
+    
+    The file is hidden straight from disk a block at a time, so memory use
+    stays the same however big the file is: it is read once to build the
+    payload header (and compressed into a temporary file, if asked) and
+    once more while its bits go into the image.
+    
+    Args:
+        image_file_path (str): Path to the original image.
+        new_image_path (str): Path for the new image.
+        message_file_path (str): Path to the file to hide.
+        bits_per_channel (int): How many bits to hide in each color byte (1 to 4).
+        compression (str): How to compress the file ('none', 'zlib', 'lzma' or 'auto').
+        matrix_bits (int): Use matrix embedding with this many bits per group (2 to 7), or 0 for plain LSB.
+        key (str or bytes): Secret key that picks which color bytes hold the file, or None.
+    
+    Returns:
+        str: Path to the saved file.
+    
+    Raises:
+        StegoError: If the file can't be hidden.
+    """
+    header_info = read_carrier_layout(image_file_path, key)
+    
+    message_file = open_message_file(message_file_path)
+    stored_file = message_file
+    try:
+        with stage('convert message') as record:
+            payload_header, stored_file, payload_size = prepare_message_file(message_file, bits_per_channel,
+                                                                              compression, matrix_bits)
+            record.bytes_read = os.fstat(message_file.fileno()).st_size
+            record.bytes_written = payload_size
+        
+        embed_payload_chunks(image_file_path, new_image_path, header_info, payload_header,
+                             iter_file_chunks(stored_file), payload_size)
+    finally:
+        if stored_file is not message_file:
+            stored_file.close()
+        message_file.close()
+    
+    return new_image_path
+
+
+def embed_payload_chunks(image_file_path, new_image_path, header_info, payload_header, message_chunks, payload_size):
+    """Hides a payload that arrives in chunks in a copy of a BMP image.
+    
+    Args:
+        image_file_path (str): Path to the original image.
+        new_image_path (str): Path for the new image.
+        header_info (BmpLayout): The image layout from read_carrier_layout().
+        payload_header (bytes): The payload header.
+        message_chunks (iterable): The message bytes that follow the header, in chunks of any size.
+        payload_size (int): Size of the payload header and message in bytes.
+    
+    Raises:
+        StegoError: If the payload doesn't fit or the new image can't be written
+            (the copy is removed again).
+    """
+    bits_per_channel = payload_bits_per_channel(payload_header)
+    matrix_bits = payload_matrix_bits(payload_header)
+    
+    # Make sure the message fits before we copy anything
+    try:
+        image_size = os.path.getsize(image_file_path)
+    except OSError as e:
+        raise ImageFileError(f"Could not read the image file. {str(e)}") from e
+    carriers_needed = check_payload_fits(image_size, payload_size, bits_per_channel, header_info, matrix_bits)
+    
+    copy_image_file(image_file_path, new_image_path)
+    
+    try:
+        with stage('embed') as record:
+            # Hide the message straight in the copy, a range of pixels at a time
+            new_img_file = open_embed_target(new_image_path, header_info)
+            try:
+                write_payload_chunks(new_img_file, header_info, payload_header, message_chunks)
+                new_img_file.flush()  # Make sure the changes reach the disk
+            finally:
+                new_img_file.close()
+            
+            payload_end = header_info.carrier_end(carriers_needed)
+            record.bytes_read = record.bytes_written = payload_end - header_info.pixel_data_offset
+    except BaseException:
+        discard_image_copy(image_file_path, new_image_path)
+        raise
+
+
+def write_payload_chunks(img_bytes, header_info, payload_header, message_chunks):
+    """Hides a payload that arrives in chunks in an opened image.
+    
+    Args:
+        img_bytes (mmap.mmap or ImageFileWriter): The image from open_embed_target()
+            (or an ImageStream) (will be modified).
+        header_info (BmpLayout): The image layout from read_carrier_layout().
+        payload_header (bytes): The payload header.
+        message_chunks (iterable): The message bytes that follow the header, in chunks of any size.
+    """
+    write_blocks = choose_block_writer(header_info)
+    if header_info.carrier_order is None:
+        write_blocks = partial(write_blocks_to_file, write_blocks=write_blocks)
+    
+    matrix_bits = payload_matrix_bits(payload_header)
+    if matrix_bits:
+        write_matrix_payload(img_bytes, header_info, payload_header, message_chunks, write_blocks)
+    else:
+        write_blocks(img_bytes, iter_payload_blocks(payload_header, message_chunks,
+                                                    payload_bits_per_channel(payload_header)), header_info)
+
+
+def write_matrix_payload(img_bytes, header_info, payload_header, message_chunks, write_blocks):
+    """Hides a payload that arrives in chunks with matrix embedding.
+    
+    Args:
+        img_bytes (bytearray, mmap.mmap or ImageFileWriter): The image file bytes (will be modified).
+        header_info (BmpLayout): The image layout from read_bmp_header().
+        payload_header (bytes): The payload header.
+        message_chunks (iterable): The message bytes that follow the header, in chunks of any size.
+        write_blocks (function): The block writer (for example write_blocks_24bit).
+    """
+    matrix_bits = payload_matrix_bits(payload_header)
+    write_blocks(img_bytes, iter_carrier_blocks(payload_header, 0, 1), header_info)
+    
+    # Whole blocks keep every piece on a group boundary
+    first_byte = PAYLOAD_HEADER_SIZE
+    for piece in iter_whole_blocks(message_chunks, matrix_block_size(matrix_bits)):
+        write_blocks(img_bytes, iter_matrix_blocks(img_bytes, header_info, piece, first_byte, matrix_bits), header_info)
+        first_byte = first_byte + len(piece)
+
+
+def encode_stream(source, target, secret_message, bits_per_channel=1, compression='none', matrix_bits=0, key=None):
+    """Hides a message in a BMP image read from a stream and writes the new image to another stream.
+    
+    Nothing is saved on disk. The image is read once from start to end and
+    every row is passed on as soon as the message is done with it (see
+    ImageStream), so it works in a pipeline:
+        
+        cat photo.bmp | python cli.py encode --message "Meet at noon" - > secret.bmp
+    
+    The new image is the same, byte for byte, as the one encode_file() saves.
+    
+    Args:
+        source (file object): The binary stream the image comes from (like sys.stdin.buffer).
+        target (file object): The binary stream the new image goes to (like sys.stdout.buffer).
+        secret_message (str or bytes): The secret message.
+        bits_per_channel (int): How many bits to hide in each color byte (1 to 4).
+        compression (str): How to compress the message ('none', 'zlib', 'lzma' or 'auto').
+        matrix_bits (int): Use matrix embedding with this many bits per group (2 to 7), or 0 for plain LSB.
+        key (str or bytes): Secret key that picks which color bytes hold the message, or None.
+            The whole image is held in memory then, since the message can be anywhere in it.
+    
+    Returns:
+        int: How many bytes of the new image were written.
+    
+    Raises:
+        StegoError: If the message can't be hidden. A message that doesn't
+            fit is found before anything is written to target.
+    """
+    with stage('read header') as record:
+        header_bytes, header_info = read_stream_header(source, key)
+        record.bytes_read = len(header_bytes)
+    write_blocks = choose_block_writer(header_info)
+    
+    with stage('convert message') as record:
+        full_data = convert_message_to_binary(secret_message, bits_per_channel, compression, matrix_bits)
+        record.bytes_read = len(secret_message)
+        record.bytes_written = len(full_data)
+    
+    # As in encode_24bit() and encode_32bit(), but with the size the header
+    # gives, since a stream has no other
+    check_message_fits(header_info.pixel_array_end, full_data, header_info)
+    
+    with stage('embed') as record:
+        img_stream = ImageStream(source, target, header_info, header_bytes)
+        write_payload(img_stream, full_data, header_info, write_blocks)
+        img_stream.finish()
+        record.bytes_read = img_stream.bytes_read - len(header_bytes)
+        record.bytes_written = img_stream.bytes_written
+    
+    return img_stream.bytes_written
+
+
+def encode_message_file_stream(source, target, message_file_path, bits_per_channel=1, compression='none',
+                               matrix_bits=0, key=None):
+    """Hides a whole file in a BMP image read from a stream, like encode_stream().
+    
+    The file is hidden straight from disk a block at a time, as in encode_message_file().
+    
+    Args:
+        source (file object): The binary stream the image comes from.
+        target (file object): The binary stream the new image goes to.
+        message_file_path (str): Path to the file to hide.
+        bits_per_channel (int): How many bits to hide in each color byte (1 to 4).
+        compression (str): How to compress the file ('none', 'zlib', 'lzma' or 'auto').
+        matrix_bits (int): Use matrix embedding with this many bits per group (2 to 7), or 0 for plain LSB.
+        key (str or bytes): Secret key that picks which color bytes hold the file, or None.
+    
+    Returns:
+        int: How many bytes of the new image were written.
+    
+    Raises:
+        StegoError: If the file can't be hidden.
+    """
+    with stage('read header') as record:
+        header_bytes, header_info = read_stream_header(source, key)
+        record.bytes_read = len(header_bytes)
+    
+    message_file = open_message_file(message_file_path)
+    stored_file = message_file
+    try:
+        with stage('convert message') as record:
+            payload_header, stored_file, payload_size = prepare_message_file(message_file, bits_per_channel,
+                                                                              compression, matrix_bits)
+            record.bytes_read = os.fstat(message_file.fileno()).st_size
+            record.bytes_written = payload_size
+        
+        img_stream = ImageStream(source, target, header_info, header_bytes)
+        check_payload_fits(header_info.pixel_array_end, payload_size, payload_bits_per_channel(payload_header),
+                           header_info, payload_matrix_bits(payload_header))
+        
+        with stage('embed') as record:
+            write_payload_chunks(img_stream, header_info, payload_header, iter_file_chunks(stored_file))
+            img_stream.finish()
+            record.bytes_read = img_stream.bytes_read - len(header_bytes)
+            record.bytes_written = img_stream.bytes_written
+    finally:
+        if stored_file is not message_file:
+            stored_file.close()
+        message_file.close()
+    
+    return img_stream.bytes_written
+
+
+def Encode():
+    """This function hides a secret message inside a BMP image file.
+    
+    The steps go like this:
+    1. Get the secret message from the user
+    2. Get the image file to hide it in
+    3. Convert the message to binary (ones and zeros)
+    4. Read information from the BMP file header
+    5. Hide each bit of the message in the image pixels
+    6. Save the modified image
+    
+    We use LSB (Least Significant Bit) steganography - we change the last bit
+    of each color channel byte to store our message. Since we only change the
+    last bit, the image looks almost exactly the same to the human eye.
+    """
+    
+    # Step 1: Get the secret message from the user
+    secret_message = get_secret_message()
+    if secret_message is None:
+        return
+    secret_text, message_file_path = secret_message
+    
+    # Step 2: Get the image file from the user
+    image_file_path = input("Please enter the path to the BMP image file: ")
+    
+    # Compressing lets long messages (like logs) fit in smaller images.
+    # It is only used if it really makes the message smaller.
+    compress_choice = input("Would you like to compress the message? (y/n): ").strip().lower()
+    if compress_choice == 'y':
+        compression = 'auto'
+    else:
+        compression = 'none'
+    
+    try:
+        if message_file_path is not None:
+            # Step 3 and 4: Hide the file straight from disk in a copy of the image
+            new_image_path = ask_output_path()
+            encode_message_file(image_file_path, new_image_path, message_file_path, compression=compression)
+        else:
+            # Step 3: Check the image and the message and get them ready
+            full_data, header_info, encoder = prepare_encoding(image_file_path, secret_text, compression=compression)
+            
+            # Step 4: Save a copy of the image with the message hidden in it
+            new_image_path = ask_output_path()
+            save_encoded_image(image_file_path, new_image_path, full_data, header_info, encoder)
+    except StegoError as e:
+        print(f"Error: {e}")
         return
     
-    # Step 9: Save the modified image
-    save_encoded_image(img_bytes)
\ No newline at end of file
+    print(f"Success! Your secret message has been encoded into {new_image_path}.")
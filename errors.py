@@ -0,0 +1,67 @@
+''' Exceptions raised by the steganography functions.
+
+Every problem is reported by raising one of these instead of printing, so
+the functions can be used from other programs. The interactive menus in
+encode.py and decode.py catch StegoError and print "Error: <message>". '''
+
+
+class StegoError(Exception):
+    """Base class for every error raised by this program."""
+
+
+class ImageFileError(StegoError):
+    """An image file could not be opened, read or written."""
+
+
+class InvalidImageError(StegoError):
+    """The image is not a BMP file we can work with (bad or damaged header)."""
+
+
+class UnsupportedImageError(InvalidImageError):
+    """The image is a valid BMP, but in a format we don't support (8-bit, compressed, ...)."""
+
+
+class MessageError(StegoError):
+    """The message to hide is empty, unreadable or can't be stored."""
+
+
+class MessageTooLongError(MessageError):
+    """The message does not fit in the image.
+
+    Attributes:
+        required_bits (int): How many bits the message needs.
+        available_bits (int): How many bits the image can hold.
+    """
+
+    def __init__(self, required_bits, available_bits):
+        super().__init__(
+            f"The message is too long for this image.\n"
+            f"Message requires {required_bits} bits, but image only has {available_bits} bits available.\n"
+            f"Try using a larger image or a shorter message."
+        )
+        self.required_bits = required_bits
+        self.available_bits = available_bits
+
+
+class NoMessageFoundError(StegoError):
+    """The image does not contain a hidden message."""
+
+
+class DamagedMessageError(StegoError):
+    """The image has a hidden message, but it is damaged or cut short."""
+
+
+class IncompleteMessageError(StegoError):
+    """The message was split over several images and not all of them were given."""
+
+
+class UnsupportedFormatError(StegoError):
+    """The hidden message uses a format version this program doesn't know."""
+
+
+class InvalidKeyError(StegoError):
+    """The secret key can't be used (it is empty)."""
+
+
+class CacheError(StegoError):
+    """The decode cache file could not be read or written."""
@@ -0,0 +1,216 @@
+''' Timing and memory measurements for the steps of hiding and finding messages.
+
+The encoder and decoder wrap each of their steps (reading the header,
+converting the message, copying the image, hiding the bits, ...) in
+stage(). That does two things:
+
+1. It always adds the step to a set of cheap running totals (number of
+   calls, time, bytes read and written) that counters() gives back. This
+   only costs a couple of clock reads per step.
+
+2. If a Recorder is active, the step is also recorded on its own, with
+   its peak memory if asked for, and passed to the recorder's callback.
+
+    from instrument import Recorder
+
+    with Recorder(callback=print, trace_memory=True) as recorder:
+        encode_file('carrier.bmp', 'secret.bmp', 'meet at noon')
+    print(recorder.summary()) '''
+
+import time
+from contextlib import contextmanager
+
+# tracemalloc is only imported when memory is measured: it pulls in several
+# other modules, and every program that hides or finds a message imports this one
+
+
+# Running totals for every stage name: {name: {'calls', 'seconds', 'bytes_read', 'bytes_written'}}
+stage_totals = {}
+
+# The Recorder that is collecting stages right now, if any
+active_recorder = None
+
+
+class StageRecord:
+    """What happened during one step.
+
+    Attributes:
+        name (str): The name of the step, like 'read header'.
+        seconds (float): How long it took.
+        bytes_read (int): How many bytes the step read (from a file or its input).
+        bytes_written (int): How many bytes it wrote (to a file or its output).
+        peak_memory (int): The most memory Python allocated during the step,
+            or None if memory wasn't being traced.
+    """
+
+    __slots__ = ('name', 'seconds', 'bytes_read', 'bytes_written', 'peak_memory')
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.peak_memory = None
+
+    def __repr__(self):
+        return (f"StageRecord({self.name!r}, seconds={self.seconds:.6f}, bytes_read={self.bytes_read}, "
+                f"bytes_written={self.bytes_written}, peak_memory={self.peak_memory})")
+
+    def as_dict(self):
+        """Returns the record as a plain dictionary (for JSON output)."""
+        return {
+            'stage': self.name,
+            'seconds': self.seconds,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'peak_memory': self.peak_memory,
+        }
+
+
+class Recorder:
+    """Collects a StageRecord for every step run while it is active.
+
+    Use it as a context manager around the work you want to measure.
+
+    Args:
+        callback (function): Called with each StageRecord as soon as its step ends.
+        trace_memory (bool): Also measure the peak memory of every step. This
+            uses tracemalloc, which makes everything noticeably slower.
+    """
+
+    def __init__(self, callback=None, trace_memory=False):
+        self.callback = callback
+        self.trace_memory = trace_memory
+        self.records = []
+        self.previous_recorder = None
+        self.started_tracing = False
+
+    def __enter__(self):
+        global active_recorder
+        self.previous_recorder = active_recorder
+        active_recorder = self
+        if self.trace_memory:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.started_tracing = True
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global active_recorder
+        active_recorder = self.previous_recorder
+        if self.started_tracing:
+            import tracemalloc
+            tracemalloc.stop()
+            self.started_tracing = False
+        return False
+
+    def add(self, record):
+        """Stores a finished step and passes it to the callback."""
+        self.records.append(record)
+        if self.callback is not None:
+            self.callback(record)
+
+    def totals(self):
+        """Adds up the recorded steps by name.
+
+        Returns:
+            dict: {name: {'calls', 'seconds', 'bytes_read', 'bytes_written', 'peak_memory'}}
+        """
+        totals = {}
+        for record in self.records:
+            add_to_totals(totals, record)
+        return totals
+
+    def summary(self):
+        """Returns a table of the recorded steps, slowest first."""
+        return format_report(self.totals())
+
+
+def add_to_totals(totals, record):
+    """Adds one finished step to a dictionary of running totals."""
+    entry = totals.get(record.name)
+    if entry is None:
+        entry = {'calls': 0, 'seconds': 0.0, 'bytes_read': 0, 'bytes_written': 0, 'peak_memory': None}
+        totals[record.name] = entry
+    entry['calls'] += 1
+    entry['seconds'] += record.seconds
+    entry['bytes_read'] += record.bytes_read
+    entry['bytes_written'] += record.bytes_written
+    if record.peak_memory is not None:
+        entry['peak_memory'] = max(entry['peak_memory'] or 0, record.peak_memory)
+
+
+@contextmanager
+def stage(name):
+    """Measures one step of the work.
+
+    The step can fill in bytes_read and bytes_written on the record it gets.
+
+        with stage('copy image') as record:
+            ...
+            record.bytes_written = size
+
+    Args:
+        name (str): The name of the step.
+
+    Yields:
+        StageRecord: The record for this step.
+    """
+    record = StageRecord(name)
+    recorder = active_recorder
+    tracing = recorder is not None and recorder.trace_memory
+    if tracing:
+        import tracemalloc
+        tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+        memory_before = tracemalloc.get_traced_memory()[0]
+
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record.seconds = time.perf_counter() - start
+        if tracing:
+            record.peak_memory = max(0, tracemalloc.get_traced_memory()[1] - memory_before)
+
+        # The cheap totals are always kept
+        add_to_totals(stage_totals, record)
+        if recorder is not None:
+            recorder.add(record)
+
+
+def counters():
+    """Returns a copy of the running totals for every step since the program started.
+
+    Returns:
+        dict: {name: {'calls', 'seconds', 'bytes_read', 'bytes_written', 'peak_memory'}}
+    """
+    return {name: dict(entry) for name, entry in stage_totals.items()}
+
+
+def reset_counters():
+    """Sets the running totals back to zero."""
+    stage_totals.clear()
+
+
+def format_report(totals):
+    """Formats stage totals as a table, slowest step first.
+
+    Args:
+        totals (dict): Totals from counters() or Recorder.totals().
+
+    Returns:
+        str: The table.
+    """
+    lines = [f"{'Stage':<22}{'Calls':>7}{'Time (ms)':>12}{'Read (KB)':>12}{'Written (KB)':>14}{'Peak (KB)':>11}"]
+    total_seconds = 0.0
+    for name, entry in sorted(totals.items(), key=lambda item: item[1]['seconds'], reverse=True):
+        peak = entry.get('peak_memory')
+        peak_text = f"{peak / 1024:.1f}" if peak is not None else '-'
+        lines.append(f"{name:<22}{entry['calls']:>7}{entry['seconds'] * 1000:>12.2f}"
+                     f"{entry['bytes_read'] / 1024:>12.1f}{entry['bytes_written'] / 1024:>14.1f}{peak_text:>11}")
+        total_seconds += entry['seconds']
+    lines.append(f"{'Total':<22}{'':>7}{total_seconds * 1000:>12.2f}")
+    return '\n'.join(lines)
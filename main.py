@@ -5,9 +5,6 @@ into the image, and returns it.
 It can also decode BMP images with secret messages hidden within. 
 Made by Mostafa Hekal. '''
 
-from encode import Encode
-from decode import Decode
-
 # Main Program
 
 def main():
@@ -23,9 +20,13 @@ def main():
         
         user_choice = input("Enter your choice (1, 2, or 3): ")
         
+        # Encode and Decode are only imported once the user picks one, so
+        # the menu shows up straight away
         if user_choice == '1':
+            from encode import Encode
             Encode()
         elif user_choice == '2':
+            from decode import Decode
             Decode()
         elif user_choice == '3':
             print("Goodbye! I hope you enjoyed your stay. <3")
@@ -34,5 +35,6 @@ def main():
             print("Invalid choice. Please enter 1, 2, or 3.")
 
 
-# Start the program
-main()
\ No newline at end of file
+# Start the program (only when run directly, not when imported)
+if __name__ == '__main__':
+    main()
\ No newline at end of file
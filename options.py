@@ -0,0 +1,28 @@
+''' The choices and defaults the user can pick from.
+
+They are shared by the codec and the command line. This module imports
+nothing, so cli.py can build its argument parser (and print --help)
+without loading encode.py, decode.py or scan.py (see benchmark.py
+--startup). '''
+
+
+# Ways a message can be compressed before it is hidden. 'auto' tries them
+# all and keeps the smallest (see COMPRESSION_METHODS in encode.py).
+COMPRESSION_CHOICES = ['none', 'zlib', 'lzma', 'auto']
+
+# We can hide up to this many bits in each color byte. More than 4 starts to
+# change the colors enough to see.
+MAX_BITS_PER_CHANNEL = 4
+
+# Matrix embedding hides matrix_bits message bits in a group of
+# 2 ** matrix_bits - 1 color bytes (a Hamming code) by changing the last bit
+# of at most one of them. With 3 bits, for example, 7 color bytes carry 3
+# bits with at most 1 change instead of about 1.5, so far fewer bytes change
+# for every bit hidden - but more color bytes are needed.
+MIN_MATRIX_BITS = 2
+MAX_MATRIX_BITS = 7
+
+# How many threads scan.py reads files with at the same time by default.
+# Most of their time is spent waiting for the disk, so this is more than the
+# number of CPUs.
+SCAN_THREADS = 16
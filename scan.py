@@ -0,0 +1,223 @@
+''' Quick check of many images for a hidden message, without decoding anything.
+
+Only the BMP header and the first 112 color bytes (which hold the payload
+header) are read from each file - usually a single small read - so a
+whole directory tree can be checked far faster than decoding every image.
+Images hidden the old way (ending in a delimiter, without a payload
+header) can't be recognised this quickly and show up as having no message,
+and so do images hidden with a key (see scatter.py), which is the point.
+
+The files are read by a pool of threads. Reading a file doesn't hold up
+the other threads, so while one thread waits for the disk the others keep
+going; only a limited number of files are waiting at any time, so memory
+use stays the same however many files there are.
+
+    from scan import iter_image_paths, scan_images, ScanReport
+
+    report = ScanReport()
+    for path, details, error in scan_images(iter_image_paths(['archive/']), report=report):
+        if details and details['has_payload']:
+            print(path, details['length'])
+    print(report.summary()) '''
+
+import glob
+import os
+import time
+from collections import deque
+
+from encode import validate_bmp_basic, read_bmp_header, validate_bmp_header, check_bits_per_pixel, FLAG_FRAGMENT
+from decode import open_image_reader, read_payload_header, check_payload_header, count_file_bytes_read
+from decode import INSPECT_READ_SIZE
+from errors import StegoError
+from options import SCAN_THREADS
+
+
+# How many files each thread may have waiting, so the pool never runs dry
+# but millions of files are never all queued at once
+SCAN_QUEUE_PER_THREAD = 4
+
+
+class ScanReport:
+    """Counts what a scan found and how fast it went.
+
+    Attributes:
+        files (int): How many files were checked.
+        with_payload (int): How many of them hold a message.
+        failed (int): How many couldn't be read or aren't images we support.
+        bytes_read (int): How many bytes were read from all the files together.
+        seconds (float): How long the scan has taken so far.
+    """
+
+    def __init__(self):
+        self.files = 0
+        self.with_payload = 0
+        self.failed = 0
+        self.bytes_read = 0
+        self.seconds = 0.0
+        self.start = time.perf_counter()
+
+    def add(self, details, error):
+        """Counts the result of one file."""
+        self.files += 1
+        if error is not None:
+            self.failed += 1
+        else:
+            self.bytes_read += details['bytes_read']
+            if details['has_payload']:
+                self.with_payload += 1
+        self.seconds = time.perf_counter() - self.start
+
+    def files_per_second(self):
+        """Returns how many files were checked per second."""
+        return self.files / self.seconds if self.seconds > 0 else 0.0
+
+    def as_dict(self):
+        """Returns the counts as a plain dictionary (for JSON output)."""
+        return {
+            'files': self.files,
+            'with_payload': self.with_payload,
+            'failed': self.failed,
+            'bytes_read': self.bytes_read,
+            'seconds': self.seconds,
+            'files_per_second': self.files_per_second(),
+        }
+
+    def summary(self):
+        """Returns a one-line summary of the scan."""
+        return (f"Scanned {self.files} files in {self.seconds:.2f} s ({self.files_per_second():.0f} files/s): "
+                f"{self.with_payload} with a message, {self.failed} failed, "
+                f"{self.bytes_read / 1024:.1f} KB read")
+
+
+def iter_image_paths(patterns):
+    """Finds the .bmp files under directories, glob patterns and plain paths.
+
+    Unlike cli.find_carrier_files() nothing is sorted or collected first:
+    paths are handed out as they are found, so the scan can start at once.
+
+    Args:
+        patterns (list): Paths, directories or glob patterns.
+
+    Yields:
+        str: One image path at a time.
+    """
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            yield from iter_directory_images(pattern)
+        elif glob.has_magic(pattern):
+            yield from glob.iglob(pattern, recursive=True)
+        else:
+            # A plain path - if it doesn't exist the scan reports it
+            yield pattern
+
+
+def iter_directory_images(folder):
+    """Yields every .bmp file in a directory and the ones below it."""
+    folders = [folder]
+    while folders:
+        try:
+            entries = os.scandir(folders.pop())
+        except OSError:
+            # A folder we aren't allowed to read is skipped, like os.walk() does
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append(entry.path)
+                elif entry.name.lower().endswith('.bmp'):
+                    yield entry.path
+
+
+def scan_image(image_file_path):
+    """Checks whether one image holds a message, reading as little of it as possible.
+
+    Args:
+        image_file_path (str): Path to the image file.
+
+    Returns:
+        dict: 'has_payload', the message 'length' in bytes (None without a
+        message), 'fragment' (True for one part of a split message) and
+        'bytes_read' (how much of the file was read).
+
+    Raises:
+        StegoError: If the image can't be read or used.
+    """
+    img_bytes = open_image_reader(image_file_path, INSPECT_READ_SIZE)
+    try:
+        validate_bmp_basic(img_bytes, image_file_path)
+        header_info = read_bmp_header(img_bytes)
+        validate_bmp_header(header_info, img_bytes)
+        check_bits_per_pixel(header_info)
+
+        payload_header = read_payload_header(img_bytes, header_info)
+        if payload_header is not None:
+            # Random pixels can look like a payload header now and then, so
+            # only count it if the options are ones we know and the message fits
+            try:
+                check_payload_header(header_info, payload_header)
+            except StegoError:
+                payload_header = None
+
+        bytes_read = count_file_bytes_read(img_bytes)
+    finally:
+        img_bytes.close()
+
+    if payload_header is None:
+        return {'has_payload': False, 'length': None, 'fragment': False, 'bytes_read': bytes_read}
+    return {
+        'has_payload': True,
+        'length': payload_header['payload_length'],
+        'fragment': bool(payload_header['flags'] & FLAG_FRAGMENT),
+        'bytes_read': bytes_read,
+    }
+
+
+def scan_one(image_file_path):
+    """Scans one image and catches its errors (runs in a pool thread).
+
+    Returns:
+        tuple: (path, details from scan_image() or None, the StegoError or None).
+    """
+    try:
+        return image_file_path, scan_image(image_file_path), None
+    except StegoError as e:
+        return image_file_path, None, e
+
+
+def scan_images(image_paths, threads=SCAN_THREADS, report=None):
+    """Checks many images for a hidden message using a pool of threads.
+
+    Args:
+        image_paths (iterable): The image paths, for example from iter_image_paths().
+        threads (int): How many files to read at the same time.
+        report (ScanReport): Counts the results as they come in, if given.
+
+    Yields:
+        tuple: (path, details from scan_image() or None, the StegoError or None),
+        in the same order as image_paths.
+    """
+    if threads < 1:
+        raise ValueError("threads must be at least 1")
+
+    def finish(result):
+        if report is not None:
+            report.add(result[1], result[2])
+        return result
+
+    if threads == 1:
+        for image_file_path in image_paths:
+            yield finish(scan_one(image_file_path))
+        return
+
+    # Keep a limited number of files waiting; as each result is handed out
+    # in order, the next file goes to the pool
+    waiting = deque()
+    queue_size = threads * SCAN_QUEUE_PER_THREAD
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for image_file_path in image_paths:
+            waiting.append(executor.submit(scan_one, image_file_path))
+            if len(waiting) >= queue_size:
+                yield finish(waiting.popleft().result())
+        while waiting:
+            yield finish(waiting.popleft().result())
@@ -0,0 +1,319 @@
+''' Keyed scatter: hiding the payload in pixels picked by a secret key.
+
+Without a key the payload fills the color bytes in order from the first
+pixel, so the changes all sit together at the start of the pixel data and
+anyone can read the payload header there. With a key the pixels are used
+in a keyed, shuffled order, so the changes are spread evenly over the whole
+image and nothing can be found (or even detected by its header) without
+the same key.
+
+The image is shuffled in short segments of a few pixels (see
+MAX_SEGMENT_PIXELS): the payload still fills each segment in order, but
+segment number i of the payload goes to a segment picked by the key. A
+segment is (row, column), where column counts segments inside the row, and
+the shuffle is a small Feistel network. Each round moves the column along
+by an amount worked out from the row, or the row along by an amount worked
+out from the column:
+
+    column = (column + F1(row)) % columns
+    row    = (row + F2(column)) % rows
+    column = (column + F3(row)) % columns
+    row    = (row + F4(column)) % rows
+
+Every round can be undone, so no two segments ever land in the same place,
+and since the pairs cover exactly the segments of the image no index ever
+falls outside it. The full shuffle is never built: the positions of a
+block of segments are worked out only when they are needed.
+
+To keep this fast in plain Python, a whole block of indexes is packed into
+one big integer, 64 bits per index, and every step works on all of them at
+once with a single multiplication, addition, shift or mask. The values are
+kept small enough that no step ever carries into the next index. The
+segments themselves are read and written as slices, like the plain order.
+
+    from scatter import apply_key
+
+    header_info = read_bmp_header(img_bytes)
+    apply_key(header_info, 'correct horse battery staple') '''
+
+import sys
+from array import array
+
+from errors import InvalidKeyError, UnsupportedImageError
+
+
+# Bits per packed index
+LANE_BITS = 64
+LANE_BYTES = LANE_BITS // 8
+
+# Mixed into the key so the round keys differ from any other use of it
+KEY_SALT = b'bmp-lsb-scatter-1'
+
+# The most pixels in one segment. Segments are as long as possible (up to
+# this) while still dividing the width evenly, so none crosses into the
+# next row. Shorter segments spread the payload more finely but cost more
+# Python work per byte.
+MAX_SEGMENT_PIXELS = 16
+
+# Narrow images get shorter segments so every row still has at least this
+# many to shuffle (with a single segment per row, only whole rows would move)
+MIN_SEGMENTS_PER_ROW = 4
+
+# Rows and segments per row must fit in 31 bits for the packed steps not to overflow
+MAX_SIDE = 1 << 31
+
+
+class CarrierOrder:
+    """The keyed order of the pixels of one image.
+
+    Args:
+        key (str or bytes): The secret key. Text is used as UTF-8.
+        header_info (BmpLayout): The image layout from read_bmp_header().
+
+    Raises:
+        InvalidKeyError: If the key is empty.
+        UnsupportedImageError: If the image is too big to shuffle.
+    """
+
+    def __init__(self, key, header_info):
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+        if not key:
+            raise InvalidKeyError("The key must not be empty.")
+
+        # The longest segment that fits a whole number of times in a row
+        self.segment_pixels = max(pixels for pixels in range(1, MAX_SEGMENT_PIXELS + 1)
+                                  if header_info.width % pixels == 0
+                                  and (pixels == 1 or header_info.width // pixels >= MIN_SEGMENTS_PER_ROW))
+        self.segment_carriers = self.segment_pixels * len(header_info.channel_offsets)
+        self.segment_bytes = self.segment_pixels * header_info.bytes_per_pixel
+
+        self.rows = header_info.number_of_rows
+        self.columns = header_info.width // self.segment_pixels
+        if self.rows >= MAX_SIDE or self.columns >= MAX_SIDE:
+            raise UnsupportedImageError("The image is too big to scatter the message over.")
+
+        self.pixel_data_offset = header_info.pixel_data_offset
+        self.bytes_per_row = header_info.bytes_per_row
+        self.bytes_per_pixel = header_info.bytes_per_pixel
+        self.channel_offsets = header_info.channel_offsets
+
+        # Four rounds, each with a multiplier, an offset and a mixing multiplier.
+        # hashlib is slow to import and most images have no key, so it is
+        # only imported here.
+        import hashlib
+        digest = hashlib.sha512(KEY_SALT + key).digest()
+        words = [int.from_bytes(digest[i:i + 4], 'big') for i in range(0, 48, 4)]
+        self.round_keys = [((words[i] & 0x7FFFFFFF) | 1, words[i + 1], words[i + 2] | 1) for i in range(0, 12, 3)]
+
+        # The column numbers of one row, and lane masks, kept between blocks
+        self.row_template = None
+        self.lane_constants = {}
+
+    def __getstate__(self):
+        # The cached template and masks are big and easy to rebuild, so
+        # don't send them to worker processes
+        state = self.__dict__.copy()
+        state['row_template'] = None
+        state['lane_constants'] = {}
+        return state
+
+    def segment_range(self, first_carrier, carrier_count):
+        """Finds the segments that hold a run of payload color bytes.
+
+        Returns:
+            tuple: (first segment, number of segments, how many color bytes
+            of the first segment come before first_carrier).
+        """
+        first_segment = first_carrier // self.segment_carriers
+        end_segment = -(-(first_carrier + carrier_count) // self.segment_carriers)
+        return first_segment, end_segment - first_segment, first_carrier - first_segment * self.segment_carriers
+
+    def segment_starts(self, first_segment, segment_count):
+        """Works out where in the file a run of payload segments goes.
+
+        Args:
+            first_segment (int): Index of the first payload segment.
+            segment_count (int): How many segments.
+
+        Returns:
+            array: The file position of the first byte of every segment, in payload order.
+        """
+        if segment_count <= 0:
+            return array('Q')
+
+        rows, columns = self.split_segments(first_segment, segment_count)
+        row = pack_lanes(rows)
+        column = pack_lanes(columns)
+
+        # Alternate between moving the column along and moving the row along
+        for round_number, round_key in enumerate(self.round_keys):
+            if round_number % 2 == 0:
+                column = self.add_modulo(column, self.round_function(row, round_key, self.columns, segment_count),
+                                         self.columns, segment_count)
+            else:
+                row = self.add_modulo(row, self.round_function(column, round_key, self.rows, segment_count),
+                                      self.rows, segment_count)
+
+        starts = (self.lane(self.pixel_data_offset, segment_count) + row * self.bytes_per_row
+                  + column * self.segment_bytes)
+        return unpack_lanes(starts, segment_count)
+
+    def split_segments(self, first_segment, segment_count):
+        """Splits a run of segment indexes into rows and columns."""
+        if self.row_template is None:
+            self.row_template = array('Q', range(self.columns))
+
+        rows = array('Q')
+        columns = array('Q')
+        row, column = divmod(first_segment, self.columns)
+        segments_left = segment_count
+        while segments_left > 0:
+            length = min(self.columns - column, segments_left)
+            columns += self.row_template[column:column + length]
+            rows += array('Q', [row]) * length
+            segments_left = segments_left - length
+            row = row + 1
+            column = 0
+        return rows, columns
+
+    def lane(self, value, count):
+        """Returns value repeated in every one of count packed lanes (cached)."""
+        key = (value, count)
+        packed = self.lane_constants.get(key)
+        if packed is None:
+            # Only the sizes of the current block are worth keeping
+            if len(self.lane_constants) > 32:
+                self.lane_constants.clear()
+            packed = int.from_bytes(value.to_bytes(LANE_BYTES, 'little') * count, 'little')
+            self.lane_constants[key] = packed
+        return packed
+
+    def round_function(self, packed, round_key, modulus, count):
+        """Turns every packed value into a keyed pseudorandom number below modulus."""
+        multiplier, offset, mixer = round_key
+        mask_32 = self.lane(0xFFFFFFFF, count)
+
+        # A multiply-add and an xorshift, both cut back to 32 bits
+        mixed = (packed * multiplier + self.lane(offset, count)) & mask_32
+        mixed = (mixed ^ (mixed >> 15)) & mask_32
+        mixed = (mixed * mixer) & mask_32
+
+        # Keep the best-mixed top 24 bits, then scale them down to the range
+        # 0 to modulus - 1 with a multiply and shift (no division needed)
+        top_bits = (mixed >> 8) & self.lane(0xFFFFFF, count)
+        return ((top_bits * modulus) >> 24) & mask_32
+
+    def add_modulo(self, packed, amounts, modulus, count):
+        """Adds two sets of packed values below modulus, wrapping around at modulus."""
+        total = packed + amounts
+
+        # 1 in every lane whose total reached modulus (it then reaches bit 40)
+        wrapped = ((total + self.lane((1 << 40) - modulus, count)) >> 40) & self.lane(1, count)
+        return total - wrapped * modulus
+
+    def read_segments(self, img_bytes, starts):
+        """Reads the pixels of some segments, one after the other.
+
+        Args:
+            img_bytes (bytearray or mmap.mmap): The image file bytes.
+            starts (array): Segment positions from segment_starts().
+
+        Returns:
+            bytearray: The pixel bytes of every segment (Alpha bytes included).
+        """
+        segment_bytes = self.segment_bytes
+        return bytearray(b''.join([img_bytes[start:start + segment_bytes] for start in starts]))
+
+    def write_segments(self, img_bytes, starts, pixel_bytes):
+        """Puts the pixels from read_segments() back where they came from."""
+        segment_bytes = self.segment_bytes
+        position = 0
+        for start in starts:
+            img_bytes[start:start + segment_bytes] = pixel_bytes[position:position + segment_bytes]
+            position = position + segment_bytes
+
+    def take_colors(self, pixel_bytes):
+        """Returns the color bytes of some pixels, with the Alpha bytes left out.
+
+        For a 24-bit image every byte is a color byte, so the same bytearray
+        comes back and changes to it are changes to the pixels.
+        """
+        if self.bytes_per_pixel == 3:
+            return pixel_bytes
+
+        # Take each color channel as a strided slice and weave them together
+        channels = len(self.channel_offsets)
+        color_bytes = bytearray(len(pixel_bytes) // self.bytes_per_pixel * channels)
+        for channel, channel_offset in enumerate(self.channel_offsets):
+            color_bytes[channel::channels] = pixel_bytes[channel_offset::self.bytes_per_pixel]
+        return color_bytes
+
+    def put_colors(self, pixel_bytes, color_bytes):
+        """Copies changed color bytes from take_colors() back into the pixels."""
+        if color_bytes is pixel_bytes:
+            return
+
+        channels = len(self.channel_offsets)
+        for channel, channel_offset in enumerate(self.channel_offsets):
+            pixel_bytes[channel_offset::self.bytes_per_pixel] = color_bytes[channel::channels]
+
+    def gather(self, img_bytes, first_carrier, carrier_count):
+        """Reads a run of payload color bytes from wherever the key put them.
+
+        Args:
+            img_bytes (bytearray or mmap.mmap): The image file bytes.
+            first_carrier (int): Index of the first payload color byte.
+            carrier_count (int): How many color bytes.
+
+        Returns:
+            bytes: The color bytes, in payload order. In a file that is cut
+            short they stop at the first segment that is missing.
+        """
+        first_segment, segment_count, skip = self.segment_range(first_carrier, carrier_count)
+        starts = self.segment_starts(first_segment, segment_count)
+
+        # The segments are spread over the whole image, so in a truncated file
+        # any of them can be missing
+        image_size = len(img_bytes)
+        if starts and max(starts) + self.segment_bytes > image_size:
+            whole = next(index for index, start in enumerate(starts) if start + self.segment_bytes > image_size)
+            starts = starts[:whole]
+
+        color_bytes = self.take_colors(self.read_segments(img_bytes, starts))
+        return bytes(color_bytes[skip:skip + carrier_count])
+
+
+def pack_lanes(values):
+    """Packs an array of numbers into one big integer, LANE_BITS bits each."""
+    if sys.byteorder == 'big':
+        values = array('Q', values)
+        values.byteswap()
+    return int.from_bytes(values.tobytes(), 'little')
+
+
+def unpack_lanes(packed, count):
+    """Unpacks a big integer from pack_lanes() back into an array of numbers."""
+    values = array('Q')
+    values.frombytes(packed.to_bytes(count * LANE_BYTES, 'little'))
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def apply_key(header_info, key):
+    """Makes every function that reads or writes color bytes use the keyed order.
+
+    Args:
+        header_info (BmpLayout): The image layout from read_bmp_header().
+        key (str or bytes): The secret key, or None to keep the plain order.
+
+    Returns:
+        BmpLayout: The same layout.
+
+    Raises:
+        InvalidKeyError: If the key is empty.
+        UnsupportedImageError: If the image is too big to shuffle.
+    """
+    header_info.carrier_order = None if key is None else CarrierOrder(key, header_info)
+    return header_info
@@ -0,0 +1,605 @@
+''' Hiding one message in several images, for messages too big for any one image.
+
+The message (compressed first, if asked) is cut into one part per carrier
+image. Every image gets an ordinary payload with the FLAG_FRAGMENT flag set,
+and its message starts with a fragment header:
+
+    set id (8 bytes)       - random, the same in every part of one message
+    part (2 bytes)         - which part this is, counting from 0
+    parts (2 bytes)        - how many parts there are
+    offset (8 bytes)       - where this part goes in the whole message
+    total length (8 bytes) - length of the whole message, as it was stored
+
+Each part has its own checksum in its payload header.
+
+The parts are hidden in all the images at once by a pool of worker
+processes. They are sized so the biggest part is as small as the images
+allow, which makes the whole job take about as long as hiding that one part.
+The images can be given back in any order: every worker reads its own image
+and writes its part straight to its place in the output file.
+
+    from split import split_file, join_files
+
+    split_file(['a.bmp', 'b.bmp', 'c.bmp'], ['out/a.bmp', 'out/b.bmp', 'out/c.bmp'], 'archive.zip', jobs=3)
+    join_files(['out/c.bmp', 'out/a.bmp', 'out/b.bmp'], 'archive.zip', jobs=3) '''
+
+import os
+import struct
+import zlib
+
+from encode import read_carrier_layout, count_available_bits, check_bits_per_channel, encode_message_text
+from encode import compress_message, compress_message_file, open_message_file, iter_file_chunks
+from encode import make_payload_flags, pack_payload_header, embed_payload_chunks, discard_image_copy
+from encode import PAYLOAD_HEADER_SIZE, FLAG_FRAGMENT, FLAG_COMPRESSION, FLAG_COMPRESSION_SHIFT, MESSAGE_READ_SIZE
+from encode import validate_bmp_basic, read_bmp_header, validate_bmp_header, check_bits_per_pixel
+from decode import open_image_reader, read_payload_header, check_payload_header, read_hidden_range
+from decode import iter_stored_chunks, iter_decompressed, write_message_chunks, INSPECT_READ_SIZE
+from errors import MessageError, MessageTooLongError, NoMessageFoundError, DamagedMessageError
+from errors import IncompleteMessageError
+
+# tempfile, shutil and the process pool are only needed for compressed
+# messages and for several images, so they are imported where they are used
+# (like in encode.py)
+
+
+# The fragment header at the start of every part (see the top of this file)
+FRAGMENT_HEADER_FORMAT = '>8sHHQQ'
+FRAGMENT_HEADER_SIZE = struct.calcsize(FRAGMENT_HEADER_FORMAT)
+SET_ID_SIZE = 8
+
+# The part numbers are stored in 2 bytes
+MAX_PARTS = 0xFFFF
+
+
+def fragment_capacity(header_info, bits_per_channel=1):
+    """Works out how many bytes of the message one image can hold as a part.
+
+    Args:
+        header_info (BmpLayout): The image layout from read_bmp_header().
+        bits_per_channel (int): How many bits to hide in each color byte.
+
+    Returns:
+        int: The biggest part, in bytes (0 if not even the headers fit).
+    """
+    available_bytes = count_available_bits(header_info, bits_per_channel) // 8
+    return max(0, available_bytes - PAYLOAD_HEADER_SIZE - FRAGMENT_HEADER_SIZE)
+
+
+def plan_fragments(message_length, capacities):
+    """Shares a message out over the images so the biggest part is as small as possible.
+
+    Every image gets the same share, except images too small for it, which
+    are filled up and leave the rest to share out over the others.
+
+    Args:
+        message_length (int): Length of the whole message in bytes.
+        capacities (list): The most bytes each image can hold (see fragment_capacity()).
+
+    Returns:
+        list: The size of every part, in the same order as capacities.
+
+    Raises:
+        MessageTooLongError: If the images can't hold the message between them.
+    """
+    if message_length > sum(capacities):
+        raise MessageTooLongError(message_length * 8, sum(capacities) * 8)
+
+    sizes = [0] * len(capacities)
+    bytes_left = message_length
+
+    # Go from the smallest image to the biggest, each time sharing what is
+    # left evenly over the images that haven't had their part yet
+    smallest_first = sorted(range(len(capacities)), key=lambda index: capacities[index])
+    for position, index in enumerate(smallest_first):
+        images_left = len(capacities) - position
+        share = -(-bytes_left // images_left)
+        sizes[index] = min(capacities[index], share)
+        bytes_left = bytes_left - sizes[index]
+
+    return sizes
+
+
+def build_fragment_header(set_id, part, parts, offset, total_length):
+    """Packs the fragment header that starts every part.
+
+    Args:
+        set_id (bytes): Random bytes shared by every part of one message.
+        part (int): Which part this is, counting from 0.
+        parts (int): How many parts there are.
+        offset (int): Where this part goes in the whole message.
+        total_length (int): Length of the whole message in bytes.
+
+    Returns:
+        bytes: The packed header.
+    """
+    return struct.pack(FRAGMENT_HEADER_FORMAT, set_id, part, parts, offset, total_length)
+
+
+def read_fragment_header(fragment_bytes):
+    """Unpacks a fragment header.
+
+    Args:
+        fragment_bytes (bytes): The first FRAGMENT_HEADER_SIZE bytes of a part.
+
+    Returns:
+        dict: The header fields.
+
+    Raises:
+        DamagedMessageError: If the header is cut short.
+    """
+    if len(fragment_bytes) < FRAGMENT_HEADER_SIZE:
+        raise DamagedMessageError("The hidden message part is damaged (its fragment header is cut short).")
+
+    set_id, part, parts, offset, total_length = struct.unpack(FRAGMENT_HEADER_FORMAT,
+                                                              fragment_bytes[:FRAGMENT_HEADER_SIZE])
+    return {
+        'set_id': set_id,
+        'part': part,
+        'parts': parts,
+        'offset': offset,
+        'total_length': total_length,
+    }
+
+
+def check_image_lists(image_file_paths, new_image_paths):
+    """Makes sure there is one new image for every carrier and not too many of them.
+
+    Raises:
+        ValueError: If the lists don't match up.
+    """
+    if not image_file_paths:
+        raise ValueError("At least one carrier image is needed.")
+    if len(image_file_paths) != len(new_image_paths):
+        raise ValueError("Every carrier image needs exactly one new image path.")
+    if len(set(new_image_paths)) != len(new_image_paths):
+        raise ValueError("Two parts would be saved to the same new image path.")
+    if len(image_file_paths) > MAX_PARTS:
+        raise ValueError(f"A message can be split over at most {MAX_PARTS} images.")
+
+
+def read_carrier_capacities(image_file_paths, bits_per_channel):
+    """Reads the layout of every carrier image and how much of a message each can hold.
+
+    Returns:
+        tuple: (list of BmpLayout, list of capacities in bytes).
+
+    Raises:
+        StegoError: If one of the images can't be used.
+    """
+    layouts = [read_carrier_layout(image_file_path) for image_file_path in image_file_paths]
+    capacities = [fragment_capacity(header_info, bits_per_channel) for header_info in layouts]
+    return layouts, capacities
+
+
+def make_fragment_tasks(image_file_paths, new_image_paths, layouts, sizes, flags, sources, total_length):
+    """Builds one task for encode_fragment() per part.
+
+    Args:
+        image_file_paths (list): The carrier images, in part order.
+        new_image_paths (list): Where to save each new image.
+        layouts (list): The BmpLayout of every carrier.
+        sizes (list): The size of every part from plan_fragments().
+        flags (int): Payload header flags for every part.
+        sources (list): Where the bytes of every part come from (see encode_fragment()).
+        total_length (int): Length of the whole message in bytes.
+
+    Returns:
+        list: The tasks.
+    """
+    set_id = os.urandom(SET_ID_SIZE)
+    tasks = []
+    offset = 0
+    for part, size in enumerate(sizes):
+        fragment_header = build_fragment_header(set_id, part, len(sizes), offset, total_length)
+        tasks.append((image_file_paths[part], new_image_paths[part], layouts[part], fragment_header,
+                      sources[part], flags))
+        offset = offset + size
+    return tasks
+
+
+def iter_fragment_chunks(fragment_header, source, message_file):
+    """Gives the bytes of one part (its fragment header first) in chunks.
+
+    Args:
+        fragment_header (bytes): The fragment header of the part.
+        source (bytes or tuple): The bytes of the part, or (file path, offset, length).
+        message_file (file): The file named in source, already opened (None for bytes).
+
+    Yields:
+        bytes or memoryview: The next chunk.
+    """
+    yield fragment_header
+    if message_file is None:
+        part_bytes = memoryview(source)
+        for start in range(0, len(part_bytes), MESSAGE_READ_SIZE):
+            yield part_bytes[start:start + MESSAGE_READ_SIZE]
+    else:
+        _, offset, length = source
+        yield from iter_file_chunks(message_file, start=offset, length=length)
+
+
+def encode_fragment(task):
+    """Hides one part of a message in a copy of its carrier (runs in a worker process).
+
+    The part is read twice, once for its checksum and once while hiding it,
+    so a part that comes from a file is never held in memory.
+
+    Args:
+        task (tuple): (image path, new image path, header_info, fragment header,
+            source, flags). The source is the bytes of the part, or
+            (file path, offset, length) to read them from a file.
+
+    Returns:
+        str: Path to the saved image.
+    """
+    image_file_path, new_image_path, header_info, fragment_header, source, flags = task
+
+    message_file = None
+    if isinstance(source, tuple):
+        message_file = open_message_file(source[0])
+
+    try:
+        # The payload header needs the checksum of the part first
+        fragment_length = 0
+        checksum = 0
+        for chunk in iter_fragment_chunks(fragment_header, source, message_file):
+            fragment_length = fragment_length + len(chunk)
+            checksum = zlib.crc32(chunk, checksum)
+
+        payload_header = pack_payload_header(fragment_length, checksum, flags)
+        embed_payload_chunks(image_file_path, new_image_path, header_info, payload_header,
+                             iter_fragment_chunks(fragment_header, source, message_file),
+                             PAYLOAD_HEADER_SIZE + fragment_length)
+    finally:
+        if message_file is not None:
+            message_file.close()
+
+    return new_image_path
+
+
+def run_fragment_tasks(tasks, jobs):
+    """Hides every part, in parallel when jobs is more than 1.
+
+    Either every new image is saved or none is: if one part fails, the
+    images already saved for the other parts are removed again.
+
+    Args:
+        tasks (list): Tasks from make_fragment_tasks().
+        jobs (int): How many worker processes to use.
+
+    Raises:
+        StegoError: The first error from any of the parts.
+    """
+    finished = []
+    first_error = None
+
+    if jobs == 1 or len(tasks) == 1:
+        for task in tasks:
+            try:
+                encode_fragment(task)
+            except Exception as e:
+                first_error = e
+                break
+            finished.append(task)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=min(jobs, len(tasks))) as executor:
+            futures = [executor.submit(encode_fragment, task) for task in tasks]
+
+        # Every worker has finished here, so we know which parts made it
+        for task, future in zip(tasks, futures):
+            error = future.exception()
+            if error is None:
+                finished.append(task)
+            elif first_error is None:
+                first_error = error
+
+    if first_error is not None:
+        for task in finished:
+            discard_image_copy(task[0], task[1])
+        raise first_error
+
+
+def split_message(image_file_paths, new_image_paths, secret_message, bits_per_channel=1, compression='none', jobs=1):
+    """Hides one message in copies of several BMP images, one part in each.
+
+    Args:
+        image_file_paths (list): The carrier images, in order.
+        new_image_paths (list): Where to save each new image.
+        secret_message (str or bytes): The secret message. Text is stored as UTF-8.
+        bits_per_channel (int): How many bits to hide in each color byte (1 to 4).
+        compression (str): How to compress the whole message ('none', 'zlib', 'lzma' or 'auto').
+        jobs (int): How many worker processes to hide the parts with.
+
+    Returns:
+        list: The size of every part in bytes, in image order.
+
+    Raises:
+        StegoError: If an image can't be used or the message doesn't fit in all of them together.
+        ValueError: If the image lists don't match up or an option is out of range.
+    """
+    check_image_lists(image_file_paths, new_image_paths)
+    check_bits_per_channel(bits_per_channel)
+
+    # Compress the whole message before it is cut up
+    stored_bytes, method = compress_message(encode_message_text(secret_message), compression)
+
+    layouts, capacities = read_carrier_capacities(image_file_paths, bits_per_channel)
+    sizes = plan_fragments(len(stored_bytes), capacities)
+
+    sources = []
+    offset = 0
+    for size in sizes:
+        sources.append(bytes(stored_bytes[offset:offset + size]))
+        offset = offset + size
+
+    flags = make_payload_flags(bits_per_channel, method) | FLAG_FRAGMENT
+    run_fragment_tasks(make_fragment_tasks(image_file_paths, new_image_paths, layouts, sizes, flags, sources,
+                                           len(stored_bytes)), jobs)
+    return sizes
+
+
+def split_file(image_file_paths, new_image_paths, message_file_path, bits_per_channel=1, compression='none', jobs=1):
+    """Hides a whole file (of any kind) in copies of several BMP images, one part in each.
+
+    The file is never loaded as a whole: every worker reads just its own
+    part of it. When the file is compressed, the compressed copy is kept in a
+    temporary file for the workers to read.
+
+    Args:
+        image_file_paths (list): The carrier images, in order.
+        new_image_paths (list): Where to save each new image.
+        message_file_path (str): Path to the file to hide.
+        bits_per_channel (int): How many bits to hide in each color byte (1 to 4).
+        compression (str): How to compress the file ('none', 'zlib', 'lzma' or 'auto').
+        jobs (int): How many worker processes to hide the parts with.
+
+    Returns:
+        list: The size of every part in bytes, in image order.
+
+    Raises:
+        StegoError: If an image or the file can't be used or the file doesn't fit in all the images together.
+        ValueError: If the image lists don't match up or an option is out of range.
+    """
+    check_image_lists(image_file_paths, new_image_paths)
+    check_bits_per_channel(bits_per_channel)
+    layouts, capacities = read_carrier_capacities(image_file_paths, bits_per_channel)
+
+    stored_file_path = message_file_path
+    with open_message_file(message_file_path) as message_file:
+        stored_file, method = compress_message_file(message_file, compression)
+        if stored_file is not message_file:
+            # The workers open the compressed copy by name, so move it to a
+            # named temporary file
+            import shutil
+            import tempfile
+            with stored_file, tempfile.NamedTemporaryFile(delete=False) as named_file:
+                stored_file.seek(0)
+                shutil.copyfileobj(stored_file, named_file)
+                stored_file_path = named_file.name
+
+    try:
+        total_length = os.path.getsize(stored_file_path)
+        sizes = plan_fragments(total_length, capacities)
+
+        sources = []
+        offset = 0
+        for size in sizes:
+            sources.append((stored_file_path, offset, size))
+            offset = offset + size
+
+        flags = make_payload_flags(bits_per_channel, method) | FLAG_FRAGMENT
+        run_fragment_tasks(make_fragment_tasks(image_file_paths, new_image_paths, layouts, sizes, flags, sources,
+                                               total_length), jobs)
+    finally:
+        if stored_file_path != message_file_path:
+            os.remove(stored_file_path)
+
+    return sizes
+
+
+def read_fragment_info(image_file_path):
+    """Reads the payload header and fragment header of one part (runs in a worker process).
+
+    Only the start of the image is read.
+
+    Args:
+        image_file_path (str): Path to the image file.
+
+    Returns:
+        tuple: (payload header fields, fragment header fields).
+
+    Raises:
+        StegoError: If the image can't be read or doesn't hold a part of a message.
+    """
+    img_bytes = open_image_reader(image_file_path, INSPECT_READ_SIZE)
+    try:
+        validate_bmp_basic(img_bytes, image_file_path)
+        header_info = read_bmp_header(img_bytes)
+        validate_bmp_header(header_info, img_bytes)
+        check_bits_per_pixel(header_info)
+
+        payload_header = read_payload_header(img_bytes, header_info)
+        if payload_header is None:
+            raise NoMessageFoundError(f"No valid hidden message found in {image_file_path}.")
+        if not payload_header['flags'] & FLAG_FRAGMENT:
+            raise IncompleteMessageError(f"{image_file_path} holds a whole message, not a part of a split one.")
+
+        bits_per_channel, matrix_bits = check_payload_header(header_info, payload_header)
+        if payload_header['payload_length'] < FRAGMENT_HEADER_SIZE:
+            raise DamagedMessageError(f"The hidden message part in {image_file_path} is damaged.")
+
+        fragment_bytes = read_hidden_range(img_bytes, header_info, PAYLOAD_HEADER_SIZE * 8, FRAGMENT_HEADER_SIZE,
+                                           bits_per_channel, matrix_bits)
+    finally:
+        img_bytes.close()
+
+    return payload_header, read_fragment_header(fragment_bytes)
+
+
+def check_fragment_set(image_file_paths, fragment_infos):
+    """Makes sure the images hold every part of one message, once each.
+
+    Args:
+        image_file_paths (list): The images, in the order they were given.
+        fragment_infos (list): (payload header, fragment header) for every image.
+
+    Returns:
+        list: The index of the image holding each part, in part order.
+
+    Raises:
+        IncompleteMessageError: If parts are missing, repeated or from different messages.
+        DamagedMessageError: If the parts don't fit together.
+    """
+    first_payload, first_fragment = fragment_infos[0]
+    image_for_part = {}
+    for index, (payload_header, fragment_header) in enumerate(fragment_infos):
+        if (fragment_header['set_id'] != first_fragment['set_id']
+                or fragment_header['parts'] != first_fragment['parts']
+                or fragment_header['total_length'] != first_fragment['total_length']
+                or payload_header['flags'] & FLAG_COMPRESSION != first_payload['flags'] & FLAG_COMPRESSION):
+            raise IncompleteMessageError(f"{image_file_paths[index]} holds a part of a different message than "
+                                         f"{image_file_paths[0]}.")
+
+        part = fragment_header['part']
+        if part in image_for_part:
+            raise IncompleteMessageError(f"{image_file_paths[image_for_part[part]]} and {image_file_paths[index]} "
+                                         f"both hold part {part + 1}.")
+        image_for_part[part] = index
+
+    parts = first_fragment['parts']
+    missing = [part + 1 for part in range(parts) if part not in image_for_part]
+    if missing:
+        raise IncompleteMessageError(f"The message was split over {parts} images. "
+                                     f"Missing part(s): {', '.join(str(part) for part in missing)}.")
+
+    # Every part must start exactly where the one before it ends
+    expected_offset = 0
+    for part in range(parts):
+        payload_header, fragment_header = fragment_infos[image_for_part[part]]
+        if fragment_header['offset'] != expected_offset:
+            raise DamagedMessageError("The hidden message parts don't fit together.")
+        expected_offset = expected_offset + payload_header['payload_length'] - FRAGMENT_HEADER_SIZE
+    if expected_offset != first_fragment['total_length']:
+        raise DamagedMessageError("The hidden message parts don't fit together.")
+
+    return [image_for_part[part] for part in range(parts)]
+
+
+def extract_fragment(task):
+    """Writes one part of a message to its place in the output file (runs in a worker process).
+
+    Args:
+        task (tuple): (image path, output file path, offset of the part).
+
+    Returns:
+        int: How many bytes were written.
+    """
+    image_file_path, output_path, offset = task
+
+    img_bytes = open_image_reader(image_file_path)
+    try:
+        header_info = read_bmp_header(img_bytes)
+        payload_header = read_payload_header(img_bytes, header_info)
+
+        with open(output_path, 'r+b') as output_file:
+            output_file.seek(offset)
+
+            # Skip the fragment header at the start of the part, then write
+            # the rest as it comes in
+            header_bytes_left = FRAGMENT_HEADER_SIZE
+            bytes_written = 0
+            for chunk in iter_stored_chunks(img_bytes, header_info, payload_header):
+                if header_bytes_left:
+                    skipped = min(header_bytes_left, len(chunk))
+                    chunk = chunk[skipped:]
+                    header_bytes_left = header_bytes_left - skipped
+                output_file.write(chunk)
+                bytes_written = bytes_written + len(chunk)
+    except OSError as e:
+        raise MessageError(f"Could not save the message to '{output_path}'. {str(e)}") from e
+    finally:
+        img_bytes.close()
+
+    return bytes_written
+
+
+def join_files(image_file_paths, output_path, jobs=1):
+    """Puts a message that was split over several images back together.
+
+    The images can be given in any order. Every part is checked against its
+    own checksum and written straight to its place in the output file, so
+    the message is never held in memory as a whole. If anything is wrong,
+    nothing is left at output_path.
+
+    Args:
+        image_file_paths (list): Every image holding a part of the message.
+        output_path (str): Where to save the message.
+        jobs (int): How many worker processes to use.
+
+    Returns:
+        tuple: (size of the saved message in bytes, part number (from 1) of every image, in the order given).
+
+    Raises:
+        StegoError: If an image can't be read, parts are missing or the message is damaged.
+        ValueError: If no images are given.
+    """
+    if not image_file_paths:
+        raise ValueError("At least one image is needed.")
+
+    if jobs == 1 or len(image_file_paths) == 1:
+        executor = None
+        run = map
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=min(jobs, len(image_file_paths)))
+        run = executor.map
+
+    try:
+        # First read just the headers, to check that every part is there
+        fragment_infos = list(run(read_fragment_info, image_file_paths))
+        image_order = check_fragment_set(image_file_paths, fragment_infos)
+        payload_header, fragment_header = fragment_infos[0]
+        total_length = fragment_header['total_length']
+        compression_code = (payload_header['flags'] & FLAG_COMPRESSION) >> FLAG_COMPRESSION_SHIFT
+
+        # The parts are put together as they were stored. A compressed
+        # message goes to a temporary file first and is unpacked from there.
+        if compression_code:
+            import tempfile
+            handle, stored_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output_path)))
+            os.close(handle)
+        else:
+            stored_path = output_path
+
+        try:
+            try:
+                with open(stored_path, 'wb') as stored_file:
+                    stored_file.truncate(total_length)
+            except OSError as e:
+                raise MessageError(f"Could not save the message to '{output_path}'. {str(e)}") from e
+
+            tasks = [(image_file_paths[index], stored_path, fragment_infos[index][1]['offset'])
+                     for index in image_order]
+            list(run(extract_fragment, tasks))
+
+            if compression_code:
+                with open(stored_path, 'rb') as stored_file:
+                    message_size = write_message_chunks(iter_decompressed(iter_file_chunks(stored_file),
+                                                                          compression_code), output_path)
+            else:
+                message_size = total_length
+        except BaseException:
+            # Don't leave a half-finished (or damaged) message behind
+            if os.path.exists(stored_path):
+                os.remove(stored_path)
+            raise
+
+        if compression_code:
+            os.remove(stored_path)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    part_numbers = [fragment_header['part'] + 1 for _, fragment_header in fragment_infos]
+    return message_size, part_numbers
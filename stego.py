@@ -0,0 +1,439 @@
+''' Library interface for hiding messages in BMP images and getting them back.
+
+This is the way to use the program from other Python code. Nothing here
+asks questions or prints anything - problems are raised as the exceptions
+in errors.py (all subclasses of StegoError).
+
+    import stego
+
+    stego_image = stego.embed('carrier.bmp', b'meet at noon')
+    assert stego.extract(stego_image) == b'meet at noon'
+
+    stego.embed_file('carrier.bmp', 'secret.bmp', 'meet at noon')
+    print(stego.extract_text('secret.bmp'))
+
+Images can be given as a file path or as the bytes of a BMP file, and
+embed_stream() and extract_stream() work on open binary streams (like
+sys.stdin.buffer and sys.stdout.buffer) without any files at all. Images
+that are decoded again and again can share a DecodeCache (see cache.py):
+
+    cache = stego.DecodeCache(path='decoded.cache')
+    print(stego.extract_text('secret.bmp', cache=cache))
+    cache.save() '''
+
+import os
+
+from encode import read_image_file, validate_bmp_basic, read_bmp_header, validate_bmp_header
+from encode import choose_encoder, convert_message_to_binary, count_available_bits, encode_file
+from encode import encode_message_file, encode_stream, PAYLOAD_HEADER_SIZE
+from decode import extract_message_bytes, extract_file, convert_binary_to_text, open_image_reader
+from decode import save_message_file, save_message_stream
+from split import split_message, split_file, join_files
+from decode import inspect_image, inspect_file
+from scan import scan_image, scan_images, iter_image_paths, SCAN_THREADS
+from analysis import analyze_image, analyze_images
+from scatter import apply_key
+from cache import DecodeCache
+from errors import (StegoError, ImageFileError, InvalidImageError, UnsupportedImageError,
+                    MessageError, MessageTooLongError, NoMessageFoundError,
+                    DamagedMessageError, IncompleteMessageError, UnsupportedFormatError, CacheError,
+                    InvalidKeyError)
+
+
+__all__ = [
+    'embed', 'embed_file', 'embed_from_file', 'embed_stream', 'extract', 'extract_text', 'extract_to_file',
+    'extract_stream',
+    'embed_split', 'embed_split_from_file', 'extract_split', 'capacity', 'inspect', 'has_payload', 'scan',
+    'analyze', 'analyze_many', 'DecodeCache',
+    'StegoError', 'ImageFileError', 'InvalidImageError', 'UnsupportedImageError',
+    'MessageError', 'MessageTooLongError', 'NoMessageFoundError',
+    'DamagedMessageError', 'IncompleteMessageError', 'UnsupportedFormatError', 'CacheError', 'InvalidKeyError',
+]
+
+
+def is_path(carrier):
+    """Tells a file path apart from the bytes of an image."""
+    return isinstance(carrier, (str, os.PathLike))
+
+
+def embed(carrier, payload, bits_per_channel=1, compression='none', matrix_bits=0, key=None):
+    """Hides a payload in a BMP image and returns the new image.
+
+    Args:
+        carrier (str, os.PathLike or bytes-like): The BMP image, as a path or its bytes.
+        payload (bytes or str): What to hide. Text is stored as UTF-8.
+        bits_per_channel (int): How many bits to hide in each color byte (1 to 4).
+            More bits hold a bigger payload but change the colors more.
+        compression (str): 'none', 'zlib', 'lzma' or 'auto' (whichever is smallest).
+            The payload is only stored compressed if that makes it smaller.
+        matrix_bits (int): Use matrix embedding, hiding this many bits (2 to 7)
+            in every 2 ** matrix_bits - 1 color bytes while changing at most
+            one of them. Holds less but changes far fewer bytes. 0 = off.
+        key (str or bytes): Spread the payload over the whole image in an
+            order picked by this secret key. The same key is needed to get it
+            back, and without it the image shows no sign of a payload.
+
+    Returns:
+        bytes: The new BMP image with the payload hidden in it.
+
+    Raises:
+        StegoError: If the image can't be used or the payload doesn't fit.
+    """
+    if is_path(carrier):
+        img_bytes = read_image_file(carrier)
+        name = os.fspath(carrier)
+    else:
+        img_bytes = bytearray(carrier)
+        name = '<bytes>'
+
+    validate_bmp_basic(img_bytes, name)
+    header_info = read_bmp_header(img_bytes)
+    validate_bmp_header(header_info, img_bytes)
+
+    encoder = choose_encoder(header_info)
+    apply_key(header_info, key)
+    encoder(img_bytes, convert_message_to_binary(payload, bits_per_channel, compression, matrix_bits), header_info)
+    return bytes(img_bytes)
+
+
+def embed_file(carrier_path, output_path, payload, bits_per_channel=1, compression='none', jobs=1, matrix_bits=0,
+               key=None):
+    """Hides a payload in a copy of a BMP image file.
+
+    Unlike embed(), the image is never loaded as a whole: the file is copied
+    and only the part holding the payload is changed.
+
+    Args:
+        carrier_path (str or os.PathLike): The original image.
+        output_path (str or os.PathLike): Where to save the new image.
+        payload (bytes or str): What to hide. Text is stored as UTF-8.
+        bits_per_channel (int): How many bits to hide in each color byte (1 to 4).
+        compression (str): 'none', 'zlib', 'lzma' or 'auto' (whichever is smallest).
+        jobs (int): How many processes to hide a big payload with. The new
+            image is the same whatever the number. Payloads hidden with a
+            key or matrix embedding always use one.
+        matrix_bits (int): Use matrix embedding with this many bits per group
+            (2 to 7, see embed()). 0 = off.
+        key (str or bytes): Secret key to spread the payload with (see embed()).
+
+    Returns:
+        str: The path of the new image.
+
+    Raises:
+        StegoError: If the image can't be used or the payload doesn't fit.
+    """
+    return encode_file(os.fspath(carrier_path), os.fspath(output_path), payload, bits_per_channel, compression, jobs,
+                       matrix_bits, key)
+
+
+def embed_stream(source, target, payload, bits_per_channel=1, compression='none', matrix_bits=0, key=None):
+    """Hides a payload in a BMP image read from a stream and writes the new image to another stream.
+
+    The image is read once from start to end and passed on a few rows at a
+    time, so it is never held in memory as a whole (unless a key is used)
+    and nothing is written to disk. The new image is the same as the one
+    embed() returns.
+
+    Args:
+        source (binary file object): Where the BMP image comes from (like sys.stdin.buffer).
+        target (binary file object): Where the new image goes (like sys.stdout.buffer).
+        payload (bytes or str): What to hide. Text is stored as UTF-8.
+        bits_per_channel (int): How many bits to hide in each color byte (1 to 4).
+        compression (str): 'none', 'zlib', 'lzma' or 'auto' (whichever is smallest).
+        matrix_bits (int): Use matrix embedding with this many bits per group
+            (2 to 7, see embed()). 0 = off.
+        key (str or bytes): Secret key to spread the payload with (see embed()).
+
+    Returns:
+        int: How many bytes of the new image were written.
+
+    Raises:
+        StegoError: If the image can't be used or the payload doesn't fit.
+    """
+    return encode_stream(source, target, payload, bits_per_channel, compression, matrix_bits, key)
+
+
+def embed_from_file(carrier_path, output_path, payload_path, bits_per_channel=1, compression='none', matrix_bits=0,
+                    key=None):
+    """Hides a whole file (of any kind) in a copy of a BMP image file.
+
+    The payload file is read a block at a time and never loaded as a whole,
+    so memory use stays the same however big it is.
+
+    Args:
+        carrier_path (str or os.PathLike): The original image.
+        output_path (str or os.PathLike): Where to save the new image.
+        payload_path (str or os.PathLike): The file to hide.
+        bits_per_channel (int): How many bits to hide in each color byte (1 to 4).
+        compression (str): 'none', 'zlib', 'lzma' or 'auto' (whichever is smallest).
+        matrix_bits (int): Use matrix embedding with this many bits per group
+            (2 to 7, see embed()). 0 = off.
+        key (str or bytes): Secret key to spread the payload with (see embed()).
+
+    Returns:
+        str: The path of the new image.
+
+    Raises:
+        StegoError: If the image or the file can't be used or the file doesn't fit.
+    """
+    return encode_message_file(os.fspath(carrier_path), os.fspath(output_path), os.fspath(payload_path),
+                               bits_per_channel, compression, matrix_bits, key)
+
+
+def extract(carrier, key=None, cache=None):
+    """Gets the hidden payload out of a BMP image.
+
+    Args:
+        carrier (str, os.PathLike or bytes-like): The BMP image, as a path or its bytes.
+        key (str or bytes): The secret key the payload was hidden with, or None.
+        cache (DecodeCache): Payloads already found, for images given as a path.
+
+    Returns:
+        bytes: The hidden payload.
+
+    Raises:
+        StegoError: If the image can't be read or has no valid payload.
+    """
+    if is_path(carrier):
+        return extract_file(os.fspath(carrier), key, cache)
+    return extract_message_bytes(bytes(carrier), '<bytes>', key)
+
+
+def extract_text(carrier, key=None, cache=None):
+    """Gets a hidden text message out of a BMP image.
+
+    Args:
+        carrier (str, os.PathLike or bytes-like): The BMP image, as a path or its bytes.
+        key (str or bytes): The secret key the message was hidden with, or None.
+        cache (DecodeCache): Messages already found, for images given as a path.
+
+    Returns:
+        str: The hidden message.
+
+    Raises:
+        StegoError: If the image can't be read or has no valid payload.
+    """
+    return convert_binary_to_text(extract(carrier, key, cache))
+
+
+def extract_to_file(carrier_path, output_path, key=None):
+    """Saves the hidden payload of a BMP image file to another file.
+
+    The payload is written a chunk at a time, so memory use stays the same
+    however big it is. Nothing is left at output_path if the payload turns
+    out to be damaged.
+
+    Args:
+        carrier_path (str or os.PathLike): The BMP image.
+        output_path (str or os.PathLike): Where to save the payload.
+        key (str or bytes): The secret key the payload was hidden with, or None.
+
+    Returns:
+        int: The size of the payload in bytes.
+
+    Raises:
+        StegoError: If the image can't be read or has no valid payload.
+    """
+    return save_message_file(os.fspath(carrier_path), os.fspath(output_path), key)
+
+
+def extract_stream(source, target, key=None):
+    """Writes the hidden payload of a BMP image read from a stream to another stream.
+
+    The image is only read as far as the payload goes, and the payload is
+    written a chunk at a time. If it turns out to be damaged, the chunks
+    before that are already written, but StegoError is still raised.
+
+    Args:
+        source (binary file object): Where the BMP image comes from (like sys.stdin.buffer).
+        target (binary file object): Where the payload goes (like sys.stdout.buffer).
+        key (str or bytes): The secret key the payload was hidden with, or None.
+
+    Returns:
+        int: The size of the payload in bytes.
+
+    Raises:
+        StegoError: If the image can't be read or has no valid payload.
+    """
+    return save_message_stream(source, target, key)
+
+
+def embed_split(carrier_paths, output_paths, payload, bits_per_channel=1, compression='none', jobs=1):
+    """Hides one payload spread over copies of several BMP image files.
+
+    For payloads too big for any one image. The parts are hidden in all the
+    images at once when jobs is more than 1.
+
+    Args:
+        carrier_paths (list): The original images, in order.
+        output_paths (list): Where to save each new image.
+        payload (bytes or str): What to hide. Text is stored as UTF-8.
+        bits_per_channel (int): How many bits to hide in each color byte (1 to 4).
+        compression (str): 'none', 'zlib', 'lzma' or 'auto' (whichever is smallest).
+        jobs (int): How many processes to hide the parts with.
+
+    Returns:
+        list: The size of the part hidden in each image, in bytes.
+
+    Raises:
+        StegoError: If an image can't be used or the payload doesn't fit in all of them together.
+    """
+    return split_message([os.fspath(path) for path in carrier_paths], [os.fspath(path) for path in output_paths],
+                         payload, bits_per_channel, compression, jobs)
+
+
+def embed_split_from_file(carrier_paths, output_paths, payload_path, bits_per_channel=1, compression='none', jobs=1):
+    """Hides a whole file spread over copies of several BMP image files.
+
+    Like embed_split(), but the payload file is never loaded as a whole.
+
+    Returns:
+        list: The size of the part hidden in each image, in bytes.
+
+    Raises:
+        StegoError: If an image or the file can't be used or the file doesn't fit in all the images together.
+    """
+    return split_file([os.fspath(path) for path in carrier_paths], [os.fspath(path) for path in output_paths],
+                      os.fspath(payload_path), bits_per_channel, compression, jobs)
+
+
+def extract_split(carrier_paths, output_path, jobs=1):
+    """Puts a payload spread over several BMP image files back together and saves it.
+
+    The images can be given in any order.
+
+    Args:
+        carrier_paths (list): Every image holding a part of the payload.
+        output_path (str or os.PathLike): Where to save the payload.
+        jobs (int): How many processes to read the parts with.
+
+    Returns:
+        int: The size of the payload in bytes.
+
+    Raises:
+        StegoError: If an image can't be read, parts are missing or the payload is damaged.
+    """
+    message_size, _ = join_files([os.fspath(path) for path in carrier_paths], os.fspath(output_path), jobs)
+    return message_size
+
+
+def capacity(carrier, bits_per_channel=1, matrix_bits=0):
+    """Works out the biggest payload a BMP image can hold.
+
+    Args:
+        carrier (str, os.PathLike or bytes-like): The BMP image, as a path or its bytes.
+        bits_per_channel (int): How many bits would be hidden in each color byte.
+        matrix_bits (int): Bits per group if matrix embedding would be used (0 = off).
+
+    Returns:
+        int: The largest payload, in bytes.
+
+    Raises:
+        StegoError: If the image can't be used.
+    """
+    if is_path(carrier):
+        # Only the BMP header is read from the file
+        name = os.fspath(carrier)
+        img_bytes = open_image_reader(name)
+    else:
+        name = '<bytes>'
+        img_bytes = carrier
+
+    try:
+        validate_bmp_basic(img_bytes, name)
+        header_info = read_bmp_header(img_bytes)
+        validate_bmp_header(header_info, img_bytes)
+    finally:
+        if is_path(carrier):
+            img_bytes.close()
+
+    choose_encoder(header_info)
+    return max(0, count_available_bits(header_info, bits_per_channel, matrix_bits) // 8 - PAYLOAD_HEADER_SIZE)
+
+
+def inspect(carrier):
+    """Describes a BMP image without reading its pixels.
+
+    Only the BMP header and the first few dozen pixels are read, which makes
+    this fast enough to run over a whole folder of images.
+
+    Args:
+        carrier (str, os.PathLike or bytes-like): The BMP image, as a path or its bytes.
+
+    Returns:
+        dict: The image size and layout, how many bytes fit with 1 to 4 bits
+        per color byte ('modes'), and whether it already has a payload.
+
+    Raises:
+        StegoError: If the image can't be used.
+    """
+    if is_path(carrier):
+        return inspect_file(os.fspath(carrier))
+    return inspect_image(carrier, '<bytes>')
+
+
+def has_payload(carrier_path):
+    """Tells whether a BMP image file holds a message, reading only its first few pixels.
+
+    Args:
+        carrier_path (str or os.PathLike): The image file.
+
+    Returns:
+        dict: 'has_payload', the message 'length' in bytes (None without one),
+        'fragment' (part of a split message) and 'bytes_read'.
+
+    Raises:
+        StegoError: If the image can't be read or used.
+    """
+    return scan_image(os.fspath(carrier_path))
+
+
+def scan(paths, threads=SCAN_THREADS):
+    """Checks every BMP image under some paths for a message, many files at a time.
+
+    Args:
+        paths (list): Image files, directories (searched with all their
+            subdirectories) or glob patterns.
+        threads (int): How many files to read at the same time.
+
+    Yields:
+        tuple: (path, details like has_payload() gives or None, the StegoError or None).
+        A file that can't be read doesn't stop the scan.
+    """
+    yield from scan_images(iter_image_paths([os.fspath(path) for path in paths]), threads)
+
+
+def analyze(carrier_path, early_stop=True):
+    """Looks for signs of an LSB payload in the pixels of a BMP image file.
+
+    This works on any image, whatever hid the payload (see analysis.py).
+
+    Args:
+        carrier_path (str or os.PathLike): The image file.
+        early_stop (bool): Stop reading once the result is clear.
+
+    Returns:
+        dict: The chi-square, rs and spa scores of every channel, the overall
+        'score' (estimated share of color bytes carrying a payload) and
+        whether the image is 'suspicious'.
+
+    Raises:
+        StegoError: If the image can't be read or used.
+    """
+    return analyze_image(os.fspath(carrier_path), early_stop)
+
+
+def analyze_many(paths, jobs=None, early_stop=True, stop_after=None):
+    """Analyzes every BMP image under some paths, using several processes.
+
+    Args:
+        paths (list): Image files, directories or glob patterns.
+        jobs (int): How many processes to use (default: number of CPUs).
+        early_stop (bool): Stop reading each image once its result is clear.
+        stop_after (int): Stop once this many suspicious images were found.
+
+    Yields:
+        tuple: (path, result like analyze() gives or None, the StegoError or None).
+    """
+    yield from analyze_images(iter_image_paths([os.fspath(path) for path in paths]), jobs,
+                              early_stop=early_stop, stop_after=stop_after)
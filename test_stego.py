@@ -0,0 +1,82 @@
+''' Tests for the library interface (run with python -m unittest). '''
+
+import io
+import os
+import struct
+import tempfile
+import unittest
+
+import stego
+from encode import PARALLEL_MIN_SIZE
+
+
+def make_bmp(width, height, bits_per_pixel=24):
+    """Returns the bytes of a BMP image filled with random pixels."""
+    bytes_per_row = (width * bits_per_pixel // 8 + 3) // 4 * 4
+    pixels = os.urandom(bytes_per_row * height)
+    file_header = b'BM' + struct.pack('<IHHI', 54 + len(pixels), 0, 0, 54)
+    info_header = struct.pack('<IiiHHIIiiII', 40, width, height, 1, bits_per_pixel, 0, len(pixels), 2835, 2835, 0, 0)
+    return file_header + info_header + pixels
+
+
+class ParallelEmbedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.carrier_path = os.path.join(self.folder.name, 'carrier.bmp')
+        with open(self.carrier_path, 'wb') as carrier_file:
+            carrier_file.write(make_bmp(2400, 2400))
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_keyed_jobs_match_one_job(self):
+        # Big enough to be split over workers without a key
+        payload = os.urandom(PARALLEL_MIN_SIZE + 1000)
+        one_path = os.path.join(self.folder.name, 'one.bmp')
+        three_path = os.path.join(self.folder.name, 'three.bmp')
+
+        stego.embed_file(self.carrier_path, one_path, payload, bits_per_channel=2, jobs=1, key='pw')
+        stego.embed_file(self.carrier_path, three_path, payload, bits_per_channel=2, jobs=3, key='pw')
+
+        with open(one_path, 'rb') as one_file, open(three_path, 'rb') as three_file:
+            self.assertEqual(one_file.read(), three_file.read())
+        self.assertEqual(stego.extract(three_path, key='pw'), payload)
+
+
+class KeyTest(unittest.TestCase):
+
+    def test_empty_key_is_a_stego_error(self):
+        carrier = make_bmp(32, 32)
+        with self.assertRaises(stego.InvalidKeyError):
+            stego.embed(carrier, b'hello', key='')
+        with self.assertRaises(stego.InvalidKeyError):
+            stego.extract(stego.embed(carrier, b'hello', key='pw'), key=b'')
+
+
+class StreamTest(unittest.TestCase):
+
+    def test_matrix_stream_matches_embed(self):
+        # A matrix block of a payload this size spans far more than the
+        # bytes an ImageStream keeps behind its latest read
+        carrier = make_bmp(1001, 300)
+        payload = os.urandom(8000)
+        target = io.BytesIO()
+
+        stego.embed_stream(io.BytesIO(carrier), target, payload, matrix_bits=3)
+
+        self.assertEqual(target.getvalue(), stego.embed(carrier, payload, matrix_bits=3))
+
+    def test_huge_header_is_an_invalid_image(self):
+        # A width and height whose pixels would end far past any index
+        carrier = bytearray(make_bmp(32, 32))
+        carrier[18:26] = struct.pack('<Ii', 3103784980, 0x7FFFFFFF)
+
+        with self.assertRaises(stego.InvalidImageError):
+            stego.embed_stream(io.BytesIO(carrier), io.BytesIO(), b'hello')
+        with self.assertRaises(stego.InvalidImageError):
+            stego.extract_stream(io.BytesIO(carrier), io.BytesIO())
+
+
+if __name__ == '__main__':
+    unittest.main()